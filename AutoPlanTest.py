@@ -1,7 +1,11 @@
 import os
 import requests
+import clients
+import logs
 import base64
 
+log = logs.get_logger(__name__)
+
 def create_encoded_custom_field(location="fixzed", email="", planregel=""):
     """
     Creates a base64 encoded string from the custom field parameters and combines it with the base URL.
@@ -50,14 +54,14 @@ def send_initial_template_message(email, planregel, phone_number, name):
 
     try:
         # Step 1: Send the template message
-        template_response = requests.post(url, json=template_payload, headers=headers)
+        template_response = clients.trengo.post(url, json=template_payload, headers=headers)
         template_response.raise_for_status()
-        print("Template message sent successfully")
+        log.info("Template message sent successfully")
 
         ticket_id = template_response.json().get('message', {}).get('ticket_id')
 
         if ticket_id:
-            print(f"Ticket ID received: {ticket_id}")
+            log.info(f"Ticket ID received: {ticket_id}")
 
             custom_field_url = f"https://app.trengo.com/api/v2/tickets/{ticket_id}/custom_fields"
             complete_url = create_encoded_custom_field(email=email, planregel=planregel)
@@ -67,19 +71,19 @@ def send_initial_template_message(email, planregel, phone_number, name):
                 "value": complete_url
             }
 
-            field_response = requests.post(custom_field_url, json=custom_field_payload, headers=headers)
+            field_response = clients.trengo.post(custom_field_url, json=custom_field_payload, headers=headers)
             field_response.raise_for_status()
-            print("Custom field updated successfully")
+            log.info("Custom field updated successfully")
 
             return ticket_id
         else:
-            print("No ticket ID received in template response")
+            log.error("No ticket ID received in template response")
             return None
 
     except requests.exceptions.RequestException as e:
-        print(f"Error occurred: {str(e)}")
+        log.error(f"Error occurred: {str(e)}")
         if hasattr(e, 'response') and e.response is not None:
-            print(f"Response content: {e.response.text}")
+            log.error(f"Response content: {e.response.text}")
         return None
 
 def main():
@@ -87,7 +91,7 @@ def main():
     Main function to orchestrate the process of sending the template
     and updating the custom field.
     """
-    print("Starting WhatsApp template message process...")
+    log.info("Starting WhatsApp template message process...")
 
     required_env_vars = [
         'TRENGO_API_KEY',
@@ -100,7 +104,7 @@ def main():
 
     missing_vars = [var for var in required_env_vars if not os.environ.get(var)]
     if missing_vars:
-        print(f"Error: Missing environment variables: {', '.join(missing_vars)}")
+        log.error(f"Missing environment variables: {', '.join(missing_vars)}")
         return
 
     email = os.environ['TEST_EMAIL']
@@ -111,9 +115,9 @@ def main():
     ticket_id = send_initial_template_message(email, planregel, phone_number, name)
 
     if ticket_id:
-        print(f"Process completed successfully. Ticket ID: {ticket_id}")
+        log.info(f"Process completed successfully. Ticket ID: {ticket_id}")
     else:
-        print("Process failed to complete successfully")
+        log.error("Process failed to complete successfully")
 
 if __name__ == "__main__":
     main()
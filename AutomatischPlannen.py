@@ -4,9 +4,21 @@ import base64
 import requests
 import pandas as pd
 from datetime import datetime
-import msal
+import clients
+import jobs
+import ledger
+import logs
+import memprofile
+import metrics
+import outbox
+import polling
+import ticket_index
 import math
 
+log = logs.get_logger(__name__)
+
+PIPELINE_NAME = 'AutomatischPlannen'
+
 # Config: Trengo Custom Field IDs
 CUSTOM_FIELDS = {
     "plan_url": 618842,
@@ -28,11 +40,7 @@ class OutlookClient:
         self.username = os.getenv('OUTLOOK_EMAIL')
         self.password = os.getenv('OUTLOOK_PASSWORD')
 
-        self.app = msal.ConfidentialClientApplication(
-            client_id=self.client_id,
-            client_credential=self.client_secret,
-            authority=f"https://login.microsoftonline.com/{self.tenant_id}"
-        )
+        self.app = clients.graph_app()
 
     def get_token(self):
         scopes = [
@@ -40,11 +48,7 @@ class OutlookClient:
             'https://graph.microsoft.com/Mail.ReadWrite',
             'https://graph.microsoft.com/User.Read'
         ]
-        result = self.app.acquire_token_by_username_password(
-            username=self.username,
-            password=self.password,
-            scopes=scopes
-        )
+        result = clients.acquire_graph_token(self.username, self.password, scopes)
         if "access_token" not in result:
             raise Exception(f"Token acquisition failed: {result.get('error_description', 'Unknown error')}")
         return result["access_token"]
@@ -52,11 +56,12 @@ class OutlookClient:
     def verify_permissions(self, token):
         test_url = 'https://graph.microsoft.com/v1.0/me/messages?$top=1'
         headers = {'Authorization': f'Bearer {token}'}
-        response = requests.get(test_url, headers=headers)
+        response = clients.graph.get(test_url, headers=headers)
         return response.status_code == 200
 
+    @logs.stage('fetch')
     def download_excel_attachment(self, sender_email, subject_line):
-        print(f"Searching for unread emails from '{sender_email}' with subject '{subject_line}'...")
+        log.info(f"Searching for unread emails from '{sender_email}' with subject '{subject_line}'...")
         token = self.get_token()
 
         if not self.verify_permissions(token):
@@ -68,7 +73,7 @@ class OutlookClient:
             '$select': 'id,subject,hasAttachments'
         }
 
-        response = requests.get("https://graph.microsoft.com/v1.0/me/messages", headers=headers, params=params)
+        response = clients.graph.get("https://graph.microsoft.com/v1.0/me/messages", headers=headers, params=params)
         response.raise_for_status()
         messages = response.json().get("value", [])
 
@@ -76,7 +81,7 @@ class OutlookClient:
             if msg.get("hasAttachments"):
                 msg_id = msg["id"]
                 att_url = f"https://graph.microsoft.com/v1.0/me/messages/{msg_id}/attachments"
-                att_resp = requests.get(att_url, headers=headers)
+                att_resp = clients.graph.get(att_url, headers=headers)
                 att_resp.raise_for_status()
                 for att in att_resp.json().get("value", []):
                     if att["name"].endswith(".xlsx"):
@@ -84,15 +89,16 @@ class OutlookClient:
                         os.makedirs("downloads", exist_ok=True)
                         with open(filepath, "wb") as f:
                             f.write(base64.b64decode(att["contentBytes"]))
-                        requests.patch(
+                        memprofile.checkpoint('base64 decode')
+                        clients.graph.patch(
                             f"https://graph.microsoft.com/v1.0/me/messages/{msg_id}",
                             headers=headers,
                             json={'isRead': True}
                         )
-                        print(f"Saved: {filepath}")
+                        log.info(f"Saved: {filepath}")
                         return filepath
 
-        print("No Excel attachments found.")
+        log.info("No Excel attachments found.")
         return None
 
 # === Helpers ===
@@ -128,7 +134,7 @@ def send_whatsapp_message(
     binnen_of_buiten
 ):
     if not mobielnummer:
-        print(f"No valid phone number for {naam_bewoner}")
+        log.info(f"No valid phone number for {naam_bewoner}")
         return None
 
     formatted_phone = format_phone_number(mobielnummer)
@@ -150,18 +156,31 @@ def send_whatsapp_message(
         ]
     }
 
+    ledger_key = ledger.message_key(PIPELINE_NAME, payload['hsm_id'], formatted_phone, planregel)
+    if ledger.already_sent(ledger_key):
+        log.info(f"Message for {naam_bewoner} already sent, skipping")
+        return
+    resume_ticket = ledger.unfinished_ticket(ledger_key)
+
     try:
-        print(f"Sending WhatsApp message to {naam_bewoner}...")
-        response = requests.post(url, json=payload, headers=headers)
-        response.raise_for_status()
-        response_json = response.json()
-        print(f"Trengo response: {response.text}")
+        if resume_ticket:
+            log.info(f"Message already sent, finishing custom fields on ticket {resume_ticket}")
+            response_json = {'message': {'ticket_id': resume_ticket}}
+        else:
+            log.info(f"Sending WhatsApp message to {naam_bewoner}...")
+            response = clients.trengo.post(url, json=payload, headers=headers)
+            response.raise_for_status()
+            response_json = response.json()
+            ledger.record_sent(ledger_key, response_json.get('message', {}).get('ticket_id'), completed=False)
+            log.debug(f"Trengo response: {response.text}")
 
         ticket_id = response_json.get('message', {}).get('ticket_id')
         if not ticket_id:
-            print("No ticket_id received from Trengo, cannot set custom fields.")
+            log.info("No ticket_id received from Trengo, cannot set custom fields.")
             return
 
+        ticket_index.record_sent(ticket_id, werkbon=safe_str(werkbonnummer), phone=formatted_phone)
+
         combined_string = f"fixzed,{email},{planregel}"
         encoded = base64.b64encode(combined_string.encode('utf-8')).decode('utf-8')
         plan_url = BASE_PLAN_URL + encoded
@@ -176,39 +195,46 @@ def send_whatsapp_message(
         ]
 
         for field_id, value in field_payloads:
-            print(f"Custom field {field_id} = {repr(value)}")
+            log.debug(f"Custom field {field_id} = {repr(value)}")
             custom_field_url = f"https://app.trengo.com/api/v2/tickets/{ticket_id}/custom_fields"
             custom_field_payload = {
                 "custom_field_id": field_id,
                 "value": value
             }
-            field_response = requests.post(custom_field_url, json=custom_field_payload, headers=headers)
+            field_response = clients.trengo.post(custom_field_url, json=custom_field_payload, headers=headers)
             field_response.raise_for_status()
+            metrics.count('custom_fields_written', PIPELINE_NAME)
 
-        print(f"Message + custom fields set for {naam_bewoner}")
+        log.info(f"Message + custom fields set for {naam_bewoner}")
+        ledger.record_completed(ledger_key)
         return response_json
 
     except requests.exceptions.HTTPError as e:
-        print(f"HTTP Error while sending message: {str(e)}")
+        log.error(f"HTTP Error while sending message: {str(e)}")
         if e.response is not None:
-            print(f"Response body: {e.response.text}")
+            log.info(f"Response body: {e.response.text}")
         raise
     except Exception as e:
-        print(f"Error while sending message: {str(e)}")
+        log.error(f"Error while sending message: {str(e)}")
         raise
 
+outbox.register(PIPELINE_NAME, send_whatsapp_message, 'planning')
+
 # === Excel Processor ===
+@logs.stage('parse')
 def process_excel_file(filepath):
     try:
-        print(f"\nProcessing Excel file: {filepath}")
+        log.info(f"Processing Excel file: {filepath}")
         df = pd.read_excel(filepath)
+        memprofile.checkpoint('read_excel')
+        metrics.count('rows_parsed', PIPELINE_NAME, len(df))
 
         if df.empty:
-            print("No data found in Excel file")
+            log.info("No data found in Excel file")
             return
 
-        print(f"Number of rows found: {len(df)}")
-        print(f"Columns: {', '.join(df.columns)}")
+        log.info(f"Number of rows found: {len(df)}")
+        log.info(f"Columns: {', '.join(df.columns)}")
 
         required_columns = ['Naam bewoner', 'Planregel', 'Mobielnummer', 'Locatie', 'Element', 'Defect', 'Werkbonnummer', 'Binnen of buiten']
         missing = [col for col in required_columns if col not in df.columns]
@@ -216,15 +242,18 @@ def process_excel_file(filepath):
             raise ValueError(f"Missing columns in Excel: {', '.join(missing)}")
 
         df_unique = df.drop_duplicates(subset=['Naam bewoner', 'Planregel'])
+        memprofile.checkpoint('drop_duplicates')
+        metrics.count('duplicates_removed', PIPELINE_NAME, len(df) - len(df_unique))
 
         if len(df_unique) < len(df):
-            print(f"{len(df) - len(df_unique)} duplicate rows removed")
+            log.info(f"{len(df) - len(df_unique)} duplicate rows removed")
 
+        payloads = []
         for index, row in df_unique.iterrows():
             try:
-                print(f"\nProcessing row {index + 1}/{len(df_unique)}")
+                log.debug(f"Processing row {index + 1}/{len(df_unique)}", extra=logs.row(index, len(df_unique)))
 
-                send_whatsapp_message(
+                payloads.append(dict(
                     naam_bewoner=row['Naam bewoner'],
                     planregel=row['Planregel'],
                     mobielnummer=row['Mobielnummer'],
@@ -233,19 +262,25 @@ def process_excel_file(filepath):
                     defect=row['Defect'],
                     werkbonnummer=row['Werkbonnummer'],
                     binnen_of_buiten=row['Binnen of buiten']
-                )
+                ))
 
             except Exception as e:
-                print(f"Error processing row {index + 1}: {str(e)}")
+                log.error(f"Error processing row {index + 1}: {str(e)}")
+                metrics.count_failure(PIPELINE_NAME, 'parse', e)
                 continue
 
+        memprofile.checkpoint('rows')
+        queued = outbox.enqueue(PIPELINE_NAME, payloads)
+        memprofile.checkpoint('enqueue')
+        log.info(f"{queued} messages queued")
+
     except Exception as e:
-        print(f"Error processing Excel file: {str(e)}")
+        log.error(f"Error processing Excel file: {str(e)}")
         raise
 
 # === Orchestration ===
 def process_data():
-    print(f"\n=== Starting new processing: {datetime.now()} ===")
+    log.info(f"=== Starting new processing: {datetime.now()} ===")
 
     try:
         outlook = OutlookClient()
@@ -257,22 +292,28 @@ def process_data():
 
         excel_file = outlook.download_excel_attachment(sender_email, subject_line)
 
+        polling.record(PIPELINE_NAME, excel_file is not None)
+
         if excel_file:
             try:
                 process_excel_file(excel_file)
             finally:
                 if os.path.exists(excel_file):
-                    print(f"\nRemoving temporary file: {excel_file}")
+                    log.info(f"Removing temporary file: {excel_file}")
                     os.remove(excel_file)
         else:
-            print("No new Excel files found to process")
+            log.info("No new Excel files found to process")
 
     except Exception as e:
-        print(f"General error: {str(e)}")
+        log.error(f"General error: {str(e)}")
+        raise
+    finally:
+        # Also after a failed fetch: rows of earlier runs still wait in the outbox
+        outbox.drain()
 
 # === Entrypoint ===
 if __name__ == "__main__":
-    print("\n=== ENVIRONMENT CHECK ===")
+    log.info("=== ENVIRONMENT CHECK ===")
     required_vars = [
         'AZURE_CLIENT_ID',
         'AZURE_CLIENT_SECRET',
@@ -288,15 +329,15 @@ if __name__ == "__main__":
 
     missing = [var for var in required_vars if not os.environ.get(var)]
     if missing:
-        print(f"ERROR: Missing environment variables: {', '.join(missing)}")
+        log.error(f"ERROR: Missing environment variables: {', '.join(missing)}")
         sys.exit(1)
 
-    print("All environment variables are set")
+    log.info("All environment variables are set")
 
-    print("\n=== MANUAL TEST ===")
+    log.info("=== MANUAL TEST ===")
     try:
-        process_data()
-        print("Manual test complete")
+        jobs.locked_job(PIPELINE_NAME, process_data)()
+        log.info("Manual test complete")
     except Exception as e:
-        print(f"Error during manual test: {str(e)}")
+        log.error(f"Error during manual test: {str(e)}")
         sys.exit(1)
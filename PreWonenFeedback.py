@@ -3,7 +3,19 @@ import sys
 import requests
 import pandas as pd
 from datetime import datetime
-import msal
+import clients
+import jobs
+import ledger
+import logs
+import memprofile
+import metrics
+import outbox
+import polling
+import ticket_index
+
+log = logs.get_logger(__name__)
+
+PIPELINE_NAME = 'PreWonenFeedback'
 
 class OutlookClient:
     def __init__(self):
@@ -14,11 +26,7 @@ class OutlookClient:
         self.password = os.getenv('OUTLOOK_PASSWORD')
         
         # Initialize MSAL client
-        self.app = msal.ConfidentialClientApplication(
-            client_id=self.client_id,
-            client_credential=self.client_secret,
-            authority=f"https://login.microsoftonline.com/{self.tenant_id}"
-        )
+        self.app = clients.graph_app()
         
     def get_token(self):
         """Get access token for Microsoft Graph API"""
@@ -26,15 +34,11 @@ class OutlookClient:
                  'https://graph.microsoft.com/Mail.ReadWrite',
                  'https://graph.microsoft.com/User.Read']
                  
-        result = self.app.acquire_token_by_username_password(
-            username=self.username,
-            password=self.password,
-            scopes=scopes
-        )
+        result = clients.acquire_graph_token(self.username, self.password, scopes)
         
         if "access_token" not in result:
             error_msg = result.get('error_description', 'Unknown error')
-            print(f"Token acquisition failed. Error: {error_msg}")
+            log.error(f"Token acquisition failed. Error: {error_msg}")
             raise Exception(f"Failed to obtain token: {error_msg}")
             
         return result["access_token"]
@@ -48,13 +52,14 @@ class OutlookClient:
         
         # Test reading messages
         test_url = 'https://graph.microsoft.com/v1.0/me/messages?$top=1'
-        response = requests.get(test_url, headers=headers)
+        response = clients.graph.get(test_url, headers=headers)
         
         return response.status_code == 200
 
+    @logs.stage('fetch')
     def download_excel_attachment(self, sender_email, subject_line):
         """Downloads Excel attachment from specific email using Microsoft Graph API."""
-        print(f"\nZoeken naar emails van {sender_email} met onderwerp '{subject_line}'...")
+        log.info(f"Zoeken naar emails van {sender_email} met onderwerp '{subject_line}'...")
         
         token = self.get_token()
         
@@ -71,16 +76,16 @@ class OutlookClient:
             url = f'https://graph.microsoft.com/v1.0/me/messages'
             params = {'$filter': filter_query, '$select': 'id,subject,hasAttachments'}
             
-            response = requests.get(url, headers=headers, params=params)
+            response = clients.graph.get(url, headers=headers, params=params)
             response.raise_for_status()
             
             messages = response.json().get('value', [])
             
             if not messages:
-                print("Geen nieuwe emails gevonden")
+                log.info("Geen nieuwe emails gevonden")
                 return None
                 
-            print("Nieuwe email(s) gevonden, bijlage controleren...")
+            log.info("Nieuwe email(s) gevonden, bijlage controleren...")
             
             for message in messages:
                 if not message.get('hasAttachments'):
@@ -89,49 +94,51 @@ class OutlookClient:
                 try:
                     message_id = message['id']
                     attachments_url = f'https://graph.microsoft.com/v1.0/me/messages/{message_id}/attachments'
-                    attachments_response = requests.get(attachments_url, headers=headers)
+                    attachments_response = clients.graph.get(attachments_url, headers=headers)
                     attachments_response.raise_for_status()
                     
                     attachments = attachments_response.json().get('value', [])
+                    memprofile.checkpoint('attachments json')
                     
                     for attachment in attachments:
                         filename = attachment.get('name', '')
                         if filename.endswith('.xlsx'):
-                            print(f"Excel bijlage gevonden: {filename}")
+                            log.info(f"Excel bijlage gevonden: {filename}")
                             
                             content = attachment.get('contentBytes')
                             if content:
                                 filepath = f"downloads/{datetime.now().strftime('%Y%m%d')}_{filename}"
                                 os.makedirs('downloads', exist_ok=True)
                                 
-                                print(f"Opslaan als: {filepath}")
+                                log.info(f"Opslaan als: {filepath}")
                                 
                                 import base64
                                 with open(filepath, 'wb') as f:
                                     f.write(base64.b64decode(content))
+                                memprofile.checkpoint('base64 decode')
                                     
                                 update_url = f'https://graph.microsoft.com/v1.0/me/messages/{message_id}'
-                                update_response = requests.patch(
+                                update_response = clients.graph.patch(
                                     update_url,
                                     headers=headers,
                                     json={'isRead': True}
                                 )
                                 update_response.raise_for_status()
-                                print("Email gemarkeerd als gelezen")
+                                log.info("Email gemarkeerd als gelezen")
                                 
                                 return filepath
                 
                 except requests.exceptions.HTTPError as e:
-                    print(f"Fout bij verwerken van specifieke email: {str(e)}")
+                    log.error(f"Fout bij verwerken van specifieke email: {str(e)}")
                     continue
                     
-            print("Geen Excel bijlage gevonden in nieuwe emails")
+            log.info("Geen Excel bijlage gevonden in nieuwe emails")
             return None
             
         except requests.exceptions.HTTPError as e:
-            print(f"HTTP Error bij API aanroep: {str(e)}")
+            log.error(f"HTTP Error bij API aanroep: {str(e)}")
             if e.response is not None:
-                print(f"Response body: {e.response.text}")
+                log.info(f"Response body: {e.response.text}")
             raise
             
 
@@ -160,21 +167,22 @@ def update_custom_field(ticket_id, task_id):
     }
 
     try:
-        response = requests.post(custom_field_url, json=payload, headers=headers)
+        response = clients.trengo.post(custom_field_url, json=payload, headers=headers)
         response.raise_for_status()
-        print(f"Custom field updated successfully with Taskid: {task_id}")
+        metrics.count('custom_fields_written', PIPELINE_NAME)
+        log.info(f"Custom field updated successfully with Taskid: {task_id}")
         return True
     except requests.exceptions.RequestException as e:
-        print(f"Error updating custom field: {str(e)}")
+        log.error(f"Error updating custom field: {str(e)}")
         if hasattr(e, 'response') and e.response is not None:
-            print(f"Response content: {e.response.text}")
+            log.info(f"Response content: {e.response.text}")
         return False
         
 
 def send_whatsapp_message(naam, mobielnummer, task_id):
     """Sends WhatsApp message via Trengo with the template and updates the custom field with Taskid."""
     if not mobielnummer:
-        print(f"Geen geldig telefoonnummer voor {naam}")
+        log.info(f"Geen geldig telefoonnummer voor {naam}")
         return
         
     url = "https://app.trengo.com/api/v2/wa_sessions"
@@ -191,54 +199,83 @@ def send_whatsapp_message(naam, mobielnummer, task_id):
         "Authorization": "Bearer " + os.environ.get('TRENGO_API_KEY')
     }
     
+    ledger_key = ledger.message_key(PIPELINE_NAME, payload['hsm_id'], mobielnummer, task_id)
+    if ledger.already_sent(ledger_key):
+        log.info(f"Bericht voor {naam} al eerder verstuurd, overslaan")
+        return
+    resume_ticket = ledger.unfinished_ticket(ledger_key)
+
     try:
-        print(f"Versturen WhatsApp bericht naar {mobielnummer} voor {naam}...")
-        response = requests.post(url, json=payload, headers=headers)
-        response.raise_for_status()
-        
-        response_data = response.json()
-        print(f"Trengo response: {response.text}")
+        if resume_ticket:
+            log.info(f"Bericht al verstuurd, custom fields afmaken op ticket {resume_ticket}")
+            response_data = {'message': {'ticket_id': resume_ticket}}
+        else:
+            log.info(f"Versturen WhatsApp bericht naar {mobielnummer} voor {naam}...")
+            response = clients.trengo.post(url, json=payload, headers=headers)
+            response.raise_for_status()
+
+            response_data = response.json()
+            ledger.record_sent(ledger_key, response_data.get('message', {}).get('ticket_id'), completed=False)
+            log.debug(f"Trengo response: {response.text}")
 
         # Extract ticket ID and update the custom field with Taskid
         ticket_id = response_data.get("message", {}).get("ticket_id")
         if ticket_id:
+            ticket_index.record_sent(ticket_id, werkbon=str(task_id), phone=mobielnummer)
             update_custom_field(ticket_id, str(task_id))
 
+        ledger.record_completed(ledger_key)
         return response_data
     except requests.exceptions.RequestException as e:
-        print(f"Fout bij versturen bericht: {str(e)}")
+        log.error(f"Fout bij versturen bericht: {str(e)}")
         raise
 
 
+outbox.register(PIPELINE_NAME, send_whatsapp_message, 'feedback')
+
+@logs.stage('parse')
 def process_excel_file(filepath):
     try:
         df = pd.read_excel(filepath, dtype={"Taskid": str})
+        memprofile.checkpoint('read_excel')
+        metrics.count('rows_parsed', PIPELINE_NAME, len(df))
         
         if df.empty:
-            print("Geen data gevonden in Excel bestand")
+            log.info("Geen data gevonden in Excel bestand")
             return
         
         df = df.rename(columns={'Naam bewoner': 'naam', 'Mobielnummer': 'mobielnummer', 'Taskid': 'task_id'})
 
+        payloads = []
         for _, row in df.iterrows():
             naam = row.get('naam', '')
             mobielnummer = row.get('mobielnummer', '')
             task_id = row.get('task_id', '')
 
-            send_whatsapp_message(naam, mobielnummer, task_id)
-            
+            payloads.append(dict(naam=naam, mobielnummer=mobielnummer, task_id=task_id))
+
+        memprofile.checkpoint('rows')
+        queued = outbox.enqueue(PIPELINE_NAME, payloads)
+        memprofile.checkpoint('enqueue')
+        log.info(f"{queued} berichten in wachtrij gezet")
+
     except Exception as e:
-        print(f"Fout bij verwerken Excel bestand: {str(e)}")
+        log.error(f"Fout bij verwerken Excel bestand: {str(e)}")
         raise
 
 
 def process_data():
     outlook = OutlookClient()
-    excel_file = outlook.download_excel_attachment(os.getenv('SENDER_EMAIL'), os.getenv('SUBJECT_LINE_PW_FB'))
-    if excel_file:
-        process_excel_file(excel_file)
-        os.remove(excel_file)
+    try:
+        excel_file = outlook.download_excel_attachment(os.getenv('SENDER_EMAIL'), os.getenv('SUBJECT_LINE_PW_FB'))
+        polling.record(PIPELINE_NAME, excel_file is not None)
+        if excel_file:
+            process_excel_file(excel_file)
+            os.remove(excel_file)
+    finally:
+        # Also after a failed fetch: rows of earlier runs still wait in the outbox
+        outbox.drain()
 
 
 if __name__ == "__main__":
-    process_data()
+    jobs.locked_job(PIPELINE_NAME, process_data)()
@@ -3,10 +3,27 @@ import sys
 import requests
 import pandas as pd
 from datetime import datetime
-import msal
+import clients
+import coalesce
+import deadlines
+import jobs
+import ledger
+import logs
+import memprofile
+import metrics
+import outbox
+import polling
+import ticket_index
 from apscheduler.schedulers.blocking import BlockingScheduler
 import math
 
+log = logs.get_logger(__name__)
+
+PIPELINE_NAME = 'PreWonenHerinnering'
+
+RESIDENT_MERGE_FIELDS = ['monteur', 'dp_nummer', 'locatie', 'element', 'defect', 'werkbonnummer', 'binnen_of_buiten']
+RESIDENT_SUM_FIELDS = ['reparatieduur']
+
 CUSTOM_FIELDS = {
     "locatie": 613776,
     "element": 618192,
@@ -23,22 +40,14 @@ class OutlookClient:
         self.username = os.getenv('OUTLOOK_EMAIL')
         self.password = os.getenv('OUTLOOK_PASSWORD')
 
-        self.app = msal.ConfidentialClientApplication(
-            client_id=self.client_id,
-            client_credential=self.client_secret,
-            authority=f"https://login.microsoftonline.com/{self.tenant_id}"
-        )
+        self.app = clients.graph_app()
 
     def get_token(self):
         scopes = ['https://graph.microsoft.com/Mail.Read',
                   'https://graph.microsoft.com/Mail.ReadWrite',
                   'https://graph.microsoft.com/User.Read']
 
-        result = self.app.acquire_token_by_username_password(
-            username=self.username,
-            password=self.password,
-            scopes=scopes
-        )
+        result = clients.acquire_graph_token(self.username, self.password, scopes)
 
         if "access_token" not in result:
             error_msg = result.get('error_description', 'Unknown error')
@@ -51,11 +60,12 @@ class OutlookClient:
             'Content-Type': 'application/json'
         }
         test_url = 'https://graph.microsoft.com/v1.0/me/messages?$top=1'
-        response = requests.get(test_url, headers=headers)
+        response = clients.graph.get(test_url, headers=headers)
         return response.status_code == 200
 
+    @logs.stage('fetch')
     def download_excel_attachment(self, sender_email, subject_line):
-        print(f"\nZoeken naar emails van {sender_email} met onderwerp '{subject_line}'...")
+        log.info(f"Zoeken naar emails van {sender_email} met onderwerp '{subject_line}'...")
         token = self.get_token()
         if not self.verify_permissions(token):
             raise Exception("Insufficient permissions to access mailbox")
@@ -73,7 +83,7 @@ class OutlookClient:
                 '$select': 'id,subject,hasAttachments'
             }
 
-            response = requests.get(url, headers=headers, params=params)
+            response = clients.graph.get(url, headers=headers, params=params)
             response.raise_for_status()
             messages = response.json().get('value', [])
 
@@ -83,14 +93,15 @@ class OutlookClient:
 
                 message_id = message['id']
                 attachments_url = f'https://graph.microsoft.com/v1.0/me/messages/{message_id}/attachments'
-                attachments_response = requests.get(attachments_url, headers=headers)
+                attachments_response = clients.graph.get(attachments_url, headers=headers)
                 attachments_response.raise_for_status()
                 attachments = attachments_response.json().get('value', [])
+                memprofile.checkpoint('attachments json')
 
                 for attachment in attachments:
                     filename = attachment.get('name', '')
                     if filename.endswith('.xlsx'):
-                        print(f"Excel bijlage gevonden: {filename}")
+                        log.info(f"Excel bijlage gevonden: {filename}")
                         content = attachment.get('contentBytes')
                         if content:
                             import base64
@@ -98,20 +109,21 @@ class OutlookClient:
                             os.makedirs('downloads', exist_ok=True)
                             with open(filepath, 'wb') as f:
                                 f.write(base64.b64decode(content))
+                            memprofile.checkpoint('base64 decode')
 
                             try:
                                 update_url = f'https://graph.microsoft.com/v1.0/me/messages/{message_id}'
-                                requests.patch(update_url, headers=headers, json={'isRead': True}).raise_for_status()
-                                print("Email gemarkeerd als gelezen")
+                                clients.graph.patch(update_url, headers=headers, json={'isRead': True}).raise_for_status()
+                                log.info("Email gemarkeerd als gelezen")
                             except:
-                                print("Kon email niet als gelezen markeren")
+                                log.info("Kon email niet als gelezen markeren")
                             return filepath
 
-            print("Geen Excel bijlage gevonden in nieuwe emails")
+            log.info("Geen Excel bijlage gevonden in nieuwe emails")
             return None
 
         except requests.exceptions.RequestException as e:
-            print(f"Fout bij ophalen van email of bijlage: {e}")
+            log.error(f"Fout bij ophalen van email of bijlage: {e}")
             raise
 
 def format_date(date_str):
@@ -135,7 +147,7 @@ def format_date(date_str):
                 return str(date_str)
         return f"{date_obj.day} {nl_month_abbr[date_obj.month]} {date_obj.year}"
     except Exception as e:
-        print(f"Fout bij formatteren datum {date_str}: {str(e)}")
+        log.error(f"Fout bij formatteren datum {date_str}: {str(e)}")
         return str(date_str)
 
 def format_phone_number(phone):
@@ -161,7 +173,7 @@ def safe_str(val):
 def send_whatsapp_message(naam, monteur, dagnaam, datum, tijdvak, reparatieduur, dp_nummer, mobielnummer,
                           locatie, element, defect, werkbonnummer, binnen_of_buiten):
     if not mobielnummer:
-        print(f"Geen geldig telefoonnummer voor {naam}")
+        log.info(f"Geen geldig telefoonnummer voor {naam}")
         return
 
     url = "https://app.trengo.com/api/v2/wa_sessions"
@@ -189,18 +201,31 @@ def send_whatsapp_message(naam, monteur, dagnaam, datum, tijdvak, reparatieduur,
         "Authorization": "Bearer " + os.environ.get('TRENGO_API_KEY')
     }
 
+    ledger_key = ledger.message_keys(PIPELINE_NAME, payload['hsm_id'], formatted_phone, werkbonnummer, datum)
+    if ledger.already_sent(ledger_key):
+        log.info(f"Bericht voor {naam} al eerder verstuurd, overslaan")
+        return
+    resume_ticket = ledger.unfinished_ticket(ledger_key)
+
     try:
-        print(f"Versturen WhatsApp bericht naar {formatted_phone} voor {naam}...")
-        response = requests.post(url, json=payload, headers=headers)
-        response.raise_for_status()
-        response_json = response.json()
-        print(f"Trengo response: {response.text}")
+        if resume_ticket:
+            log.info(f"Bericht al verstuurd, custom fields afmaken op ticket {resume_ticket}")
+            response_json = {'message': {'ticket_id': resume_ticket}}
+        else:
+            log.info(f"Versturen WhatsApp bericht naar {formatted_phone} voor {naam}...")
+            response = clients.trengo.post(url, json=payload, headers=headers)
+            response.raise_for_status()
+            response_json = response.json()
+            ledger.record_sent(ledger_key, response_json.get('message', {}).get('ticket_id'), completed=False)
+            log.debug(f"Trengo response: {response.text}")
 
         ticket_id = response_json.get('message', {}).get('ticket_id')
         if not ticket_id:
-            print("Geen ticket_id ontvangen. Custom fields overslaan.")
+            log.info("Geen ticket_id ontvangen. Custom fields overslaan.")
             return response_json
 
+        ticket_index.record_sent(ticket_id, werkbon=safe_str(werkbonnummer), phone=formatted_phone)
+
         field_payloads = [
             (CUSTOM_FIELDS['locatie'], safe_str(locatie)),
             (CUSTOM_FIELDS['element'], safe_str(element)),
@@ -210,36 +235,43 @@ def send_whatsapp_message(naam, monteur, dagnaam, datum, tijdvak, reparatieduur,
         ]
 
         for field_id, value in field_payloads:
-            print(f"Custom field {field_id} = {repr(value)}")
+            log.debug(f"Custom field {field_id} = {repr(value)}")
             custom_field_url = f"https://app.trengo.com/api/v2/tickets/{ticket_id}/custom_fields"
             custom_field_payload = {
                 "custom_field_id": field_id,
                 "value": value
             }
-            field_response = requests.post(custom_field_url, json=custom_field_payload, headers=headers)
+            field_response = clients.trengo.post(custom_field_url, json=custom_field_payload, headers=headers)
             field_response.raise_for_status()
+            metrics.count('custom_fields_written', PIPELINE_NAME)
 
-        print(f"Bericht en custom fields succesvol verstuurd voor {naam}")
+        log.info(f"Bericht en custom fields succesvol verstuurd voor {naam}")
+        ledger.record_completed(ledger_key)
         return response_json
 
     except requests.exceptions.HTTPError as e:
-        print(f"HTTP Error bij versturen bericht: {str(e)}")
+        log.error(f"HTTP Error bij versturen bericht: {str(e)}")
         if e.response is not None:
-            print(f"Response body: {e.response.text}")
+            log.info(f"Response body: {e.response.text}")
         raise
     except Exception as e:
-        print(f"Fout bij verzenden WhatsApp bericht: {str(e)}")
+        log.error(f"Fout bij verzenden WhatsApp bericht: {str(e)}")
         raise
 
+outbox.register(PIPELINE_NAME, send_whatsapp_message, 'reminder')
+
+@logs.stage('parse')
 def process_excel_file(filepath):
-    print(f"\nVerwerken Excel bestand: {filepath}")
+    log.info(f"Verwerken Excel bestand: {filepath}")
     df = pd.read_excel(filepath)
+    memprofile.checkpoint('read_excel')
+    metrics.count('rows_parsed', PIPELINE_NAME, len(df))
 
     if df.empty:
-        print("Geen data gevonden in Excel bestand")
+        log.info("Geen data gevonden in Excel bestand")
         return
 
-    print(f"Aantal rijen gevonden: {len(df)}")
+    log.info(f"Aantal rijen gevonden: {len(df)}")
     required_columns = [
         'Naam bewoner', 'Datum bezoek', 'Reparatieduur', 'Mobielnummer',
         'Monteur', 'Dagnaam', 'DP Nummer', 'Tijdvak',
@@ -252,18 +284,21 @@ def process_excel_file(filepath):
     df['Datum bezoek'] = pd.to_datetime(df['Datum bezoek'])
 
     df_unique = df.drop_duplicates(subset=['Naam bewoner', 'Datum bezoek', 'DP Nummer'])
+    memprofile.checkpoint('drop_duplicates')
+    metrics.count('duplicates_removed', PIPELINE_NAME, len(df) - len(df_unique))
     if len(df_unique) < len(df):
-        print(f"{len(df) - len(df_unique)} dubbele afspraken verwijderd")
+        log.info(f"{len(df) - len(df_unique)} dubbele afspraken verwijderd")
 
+    payloads = []
     for index, row in df_unique.iterrows():
         try:
-            print(f"\nVerwerken rij {index + 1}/{len(df_unique)}")
+            log.debug(f"Verwerken rij {index + 1}/{len(df_unique)}", extra=logs.row(index, len(df_unique)))
             mobielnummer = format_phone_number(row['Mobielnummer'])
             if not mobielnummer:
-                print(f"Geen geldig telefoonnummer voor {row['Naam bewoner']}, overslaan")
+                log.info(f"Geen geldig telefoonnummer voor {row['Naam bewoner']}, overslaan")
                 continue
 
-            send_whatsapp_message(
+            payloads.append(dict(
                 naam=row['Naam bewoner'],
                 monteur=row['Monteur'],
                 dagnaam=row['Dagnaam'],
@@ -277,13 +312,22 @@ def process_excel_file(filepath):
                 defect=row['Defect'],
                 werkbonnummer=row['Werkbonnummer'],
                 binnen_of_buiten=row['Binnen of buiten']
-            )
+            ))
         except Exception as e:
-            print(f"Fout bij verwerken rij {index + 1}: {str(e)}")
+            log.error(f"Fout bij verwerken rij {index + 1}: {str(e)}")
+            metrics.count_failure(PIPELINE_NAME, 'parse', e)
             continue
 
+    memprofile.checkpoint('rows')
+    payloads = coalesce.group_by_resident(payloads, RESIDENT_MERGE_FIELDS, keep_separate=('datum', 'tijdvak'),
+                                          sum_fields=RESIDENT_SUM_FIELDS)
+    due = [deadlines.row_deadline(p['datum'], p['tijdvak']) for p in payloads]
+    queued = outbox.enqueue(PIPELINE_NAME, payloads, due)
+    memprofile.checkpoint('enqueue')
+    log.info(f"{queued} berichten in wachtrij gezet")
+
 def process_data():
-    print(f"\n=== Start nieuwe verwerking: {datetime.now()} ===")
+    log.info(f"=== Start nieuwe verwerking: {datetime.now()} ===")
     try:
         outlook = OutlookClient()
         sender_email = os.environ.get('SENDER_EMAIL')
@@ -294,20 +338,26 @@ def process_data():
 
         excel_file = outlook.download_excel_attachment(sender_email, subject_line)
 
+        polling.record(PIPELINE_NAME, excel_file is not None)
+
         if excel_file:
             try:
                 process_excel_file(excel_file)
             finally:
                 if os.path.exists(excel_file):
-                    print(f"\nVerwijderen tijdelijk bestand: {excel_file}")
+                    log.info(f"Verwijderen tijdelijk bestand: {excel_file}")
                     os.remove(excel_file)
         else:
-            print("Geen nieuwe Excel bestanden gevonden")
+            log.info("Geen nieuwe Excel bestanden gevonden")
     except Exception as e:
-        print(f"Fout tijdens verwerking: {str(e)}")
+        log.error(f"Fout tijdens verwerking: {str(e)}")
+        raise
+    finally:
+        # Also after a failed fetch: rows of earlier runs still wait in the outbox
+        outbox.drain(budget=deadlines.RUN_BUDGET_SECONDS)
 
 if __name__ == "__main__":
-    print("\n=== ENVIRONMENT CHECK ===")
+    log.info("=== ENVIRONMENT CHECK ===")
     required_vars = [
         'AZURE_CLIENT_ID',
         'AZURE_CLIENT_SECRET',
@@ -322,16 +372,16 @@ if __name__ == "__main__":
 
     missing_vars = [var for var in required_vars if not os.environ.get(var)]
     if missing_vars:
-        print(f"ERROR: Missende environment variables: {', '.join(missing_vars)}")
+        log.error(f"ERROR: Missende environment variables: {', '.join(missing_vars)}")
         sys.exit(1)
 
-    print("Alle environment variables zijn ingesteld")
+    log.info("Alle environment variables zijn ingesteld")
 
-    print("\n=== EERSTE TEST ===")
-    print("Handmatige test uitvoeren...")
+    log.info("=== EERSTE TEST ===")
+    log.info("Handmatige test uitvoeren...")
     try:
-        process_data()
-        print("Handmatige test compleet")
+        jobs.locked_job(PIPELINE_NAME, process_data)()
+        log.info("Handmatige test compleet")
     except Exception as e:
-        print(f"Fout tijdens handmatige test: {str(e)}")
+        log.error(f"Fout tijdens handmatige test: {str(e)}")
         sys.exit(1)
@@ -3,9 +3,25 @@ import sys
 import requests
 import pandas as pd
 from datetime import datetime
-import msal
+import clients
+import coalesce
+import jobs
+import ledger
+import logs
+import memprofile
+import metrics
+import outbox
+import polling
+import ticket_index
 from apscheduler.schedulers.blocking import BlockingScheduler
 
+log = logs.get_logger(__name__)
+
+PIPELINE_NAME = 'VestedaBevestiging'
+
+RESIDENT_MERGE_FIELDS = ['dp_nummer', 'locatie', 'element', 'defect', 'werkbonnummer', 'binnen_of_buiten']
+RESIDENT_SUM_FIELDS = ['reparatieduur']
+
 CUSTOM_FIELDS = {
     "locatie": 613776,
     "element": 618192,
@@ -22,26 +38,18 @@ class OutlookClient:
         self.username = os.getenv('OUTLOOK_EMAIL')
         self.password = os.getenv('OUTLOOK_PASSWORD')
 
-        self.app = msal.ConfidentialClientApplication(
-            client_id=self.client_id,
-            client_credential=self.client_secret,
-            authority=f"https://login.microsoftonline.com/{self.tenant_id}"
-        )
+        self.app = clients.graph_app()
 
     def get_token(self):
         scopes = ['https://graph.microsoft.com/Mail.Read',
                   'https://graph.microsoft.com/Mail.ReadWrite',
                   'https://graph.microsoft.com/User.Read']
 
-        result = self.app.acquire_token_by_username_password(
-            username=self.username,
-            password=self.password,
-            scopes=scopes
-        )
+        result = clients.acquire_graph_token(self.username, self.password, scopes)
 
         if "access_token" not in result:
             error_msg = result.get('error_description', 'Unknown error')
-            print(f"Token acquisition failed. Error: {error_msg}")
+            log.error(f"Token acquisition failed. Error: {error_msg}")
             raise Exception(f"Failed to obtain token: {error_msg}")
 
         return result["access_token"]
@@ -53,16 +61,17 @@ class OutlookClient:
         }
 
         test_url = 'https://graph.microsoft.com/v1.0/me/messages?$top=1'
-        response = requests.get(test_url, headers=headers)
+        response = clients.graph.get(test_url, headers=headers)
 
         if response.status_code != 200:
-            print(f"Permission verification failed. Status: {response.status_code}")
-            print(f"Response: {response.text}")
+            log.error(f"Permission verification failed. Status: {response.status_code}")
+            log.info(f"Response: {response.text}")
             return False
         return True
 
+    @logs.stage('fetch')
     def download_excel_attachment(self, sender_email, subject_line):
-        print(f"\nZoeken naar emails van {sender_email} met onderwerp '{subject_line}'...")
+        log.info(f"Zoeken naar emails van {sender_email} met onderwerp '{subject_line}'...")
 
         token = self.get_token()
 
@@ -82,16 +91,16 @@ class OutlookClient:
                 '$select': 'id,subject,hasAttachments'
             }
 
-            response = requests.get(url, headers=headers, params=params)
+            response = clients.graph.get(url, headers=headers, params=params)
             response.raise_for_status()
 
             messages = response.json().get('value', [])
 
             if not messages:
-                print("Geen nieuwe emails gevonden")
+                log.info("Geen nieuwe emails gevonden")
                 return None
 
-            print("Nieuwe email(s) gevonden, bijlage controleren...")
+            log.info("Nieuwe email(s) gevonden, bijlage controleren...")
 
             for message in messages:
                 if not message.get('hasAttachments'):
@@ -99,15 +108,16 @@ class OutlookClient:
 
                 message_id = message['id']
                 attachments_url = f'https://graph.microsoft.com/v1.0/me/messages/{message_id}/attachments'
-                attachments_response = requests.get(attachments_url, headers=headers)
+                attachments_response = clients.graph.get(attachments_url, headers=headers)
                 attachments_response.raise_for_status()
 
                 attachments = attachments_response.json().get('value', [])
+                memprofile.checkpoint('attachments json')
 
                 for attachment in attachments:
                     filename = attachment.get('name', '')
                     if filename.endswith('.xlsx'):
-                        print(f"Excel bijlage gevonden: {filename}")
+                        log.info(f"Excel bijlage gevonden: {filename}")
 
                         content = attachment.get('contentBytes')
                         if content:
@@ -117,31 +127,32 @@ class OutlookClient:
                             import base64
                             with open(filepath, 'wb') as f:
                                 f.write(base64.b64decode(content))
+                            memprofile.checkpoint('base64 decode')
 
                             try:
                                 update_url = f'https://graph.microsoft.com/v1.0/me/messages/{message_id}'
-                                update_response = requests.patch(
+                                update_response = clients.graph.patch(
                                     update_url,
                                     headers=headers,
                                     json={'isRead': True}
                                 )
                                 update_response.raise_for_status()
-                                print("Email gemarkeerd als gelezen")
+                                log.info("Email gemarkeerd als gelezen")
                             except requests.exceptions.HTTPError as e:
-                                print(f"Waarschuwing: Kon email niet als gelezen markeren: {str(e)}")
+                                log.warning(f"Waarschuwing: Kon email niet als gelezen markeren: {str(e)}")
 
                             return filepath
 
-            print("Geen Excel bijlage gevonden in nieuwe emails")
+            log.info("Geen Excel bijlage gevonden in nieuwe emails")
             return None
 
         except requests.exceptions.HTTPError as e:
-            print(f"HTTP Error bij API aanroep: {str(e)}")
+            log.error(f"HTTP Error bij API aanroep: {str(e)}")
             if e.response is not None:
-                print(f"Response body: {e.response.text}")
+                log.info(f"Response body: {e.response.text}")
             raise
         except Exception as e:
-            print(f"Onverwachte fout: {str(e)}")
+            log.error(f"Onverwachte fout: {str(e)}")
             raise
 
 def format_date(date_str):
@@ -162,7 +173,7 @@ def format_date(date_str):
                     date_obj = datetime.strptime(date_str, '%d-%m-%Y')
         return f"{date_obj.day} {nl_month_abbr[date_obj.month]} {date_obj.year}"
     except Exception as e:
-        print(f"Fout bij formatteren datum {date_str}: {str(e)}")
+        log.error(f"Fout bij formatteren datum {date_str}: {str(e)}")
         return date_str
 
 def format_phone_number(phone):
@@ -175,7 +186,7 @@ def format_phone_number(phone):
 
 def send_whatsapp_message(naam_bewoner, dag, datum, tijdvak, reparatieduur, dp_nummer, mobielnummer, locatie, element, defect, werkbonnummer, binnen_of_buiten):
     if not mobielnummer:
-        print(f"Geen geldig telefoonnummer voor {naam_bewoner}")
+        log.info(f"Geen geldig telefoonnummer voor {naam_bewoner}")
         return
 
     url = "https://app.trengo.com/api/v2/wa_sessions"
@@ -201,18 +212,31 @@ def send_whatsapp_message(naam_bewoner, dag, datum, tijdvak, reparatieduur, dp_n
         "Authorization": "Bearer " + os.environ.get('TRENGO_API_KEY')
     }
 
+    ledger_key = ledger.message_keys(PIPELINE_NAME, payload['hsm_id'], formatted_phone, werkbonnummer, datum)
+    if ledger.already_sent(ledger_key):
+        log.info(f"Bericht voor {naam_bewoner} al eerder verstuurd, overslaan")
+        return
+    resume_ticket = ledger.unfinished_ticket(ledger_key)
+
     try:
-        print(f"Versturen WhatsApp bericht naar {formatted_phone} voor {naam_bewoner}...")
-        response = requests.post(url, json=payload, headers=headers)
-        response.raise_for_status()
-        response_json = response.json()
-        print(f"Trengo response: {response.text}")
+        if resume_ticket:
+            log.info(f"Bericht al verstuurd, custom fields afmaken op ticket {resume_ticket}")
+            response_json = {'message': {'ticket_id': resume_ticket}}
+        else:
+            log.info(f"Versturen WhatsApp bericht naar {formatted_phone} voor {naam_bewoner}...")
+            response = clients.trengo.post(url, json=payload, headers=headers)
+            response.raise_for_status()
+            response_json = response.json()
+            ledger.record_sent(ledger_key, response_json.get('message', {}).get('ticket_id'), completed=False)
+            log.debug(f"Trengo response: {response.text}")
 
         ticket_id = response_json.get('message', {}).get('ticket_id')
         if not ticket_id:
-            print("Geen ticket_id ontvangen van Trengo, kan custom fields niet instellen.")
+            log.error("Geen ticket_id ontvangen van Trengo, kan custom fields niet instellen.")
             return
 
+        ticket_index.record_sent(ticket_id, werkbon=str(werkbonnummer), phone=formatted_phone)
+
         custom_fields = [
             (CUSTOM_FIELDS['locatie'], locatie),
             (CUSTOM_FIELDS['element'], element),
@@ -227,33 +251,41 @@ def send_whatsapp_message(naam_bewoner, dag, datum, tijdvak, reparatieduur, dp_n
                 "value": value
             }
             custom_field_url = f"https://app.trengo.com/api/v2/tickets/{ticket_id}/custom_fields"
-            print(f"Bijwerken van custom field {field_id}...")
-            field_response = requests.post(custom_field_url, json=field_payload, headers=headers)
+            log.debug(f"Bijwerken van custom field {field_id}...")
+            field_response = clients.trengo.post(custom_field_url, json=field_payload, headers=headers)
             field_response.raise_for_status()
+            metrics.count('custom_fields_written', PIPELINE_NAME)
 
-        print(f"Bericht + custom fields ingesteld voor {naam_bewoner}")
+        log.info(f"Bericht + custom fields ingesteld voor {naam_bewoner}")
+        ledger.record_completed(ledger_key)
         return response_json
 
     except requests.exceptions.HTTPError as e:
-        print(f"HTTP Error bij versturen bericht: {str(e)}")
+        log.error(f"HTTP Error bij versturen bericht: {str(e)}")
         if e.response is not None:
-            print(f"Response body: {e.response.text}")
+            log.info(f"Response body: {e.response.text}")
         raise
     except Exception as e:
-        print(f"Fout bij versturen bericht: {str(e)}")
+        log.error(f"Fout bij versturen bericht: {str(e)}")
         raise
 
+outbox.register(PIPELINE_NAME, send_whatsapp_message, 'confirmation')
+
+@logs.stage('parse')
 def process_excel_file(filepath):
-    print(f"\nVerwerken Excel bestand: {filepath}")
+    log.info(f"Verwerken Excel bestand: {filepath}")
     df = pd.read_excel(filepath)
+    memprofile.checkpoint('read_excel')
+    metrics.count('rows_parsed', PIPELINE_NAME, len(df))
     if df.empty:
-        print("Geen data gevonden in Excel bestand")
+        log.info("Geen data gevonden in Excel bestand")
         return
-    print(f"Aantal rijen gevonden: {len(df)}")
+    log.info(f"Aantal rijen gevonden: {len(df)}")
+    payloads = []
     for index, row in df.iterrows():
         try:
-            print(f"\nVerwerken rij {index + 1}/{len(df)}")
-            send_whatsapp_message(
+            log.debug(f"Verwerken rij {index + 1}/{len(df)}", extra=logs.row(index, len(df)))
+            payloads.append(dict(
                 naam_bewoner=row['Naam bewoner'],
                 dag=row['Dag'],
                 datum=row['Datum bezoek'],
@@ -266,13 +298,21 @@ def process_excel_file(filepath):
                 defect=row['Defect'],
                 werkbonnummer=row['Werkbonnummer'],
                 binnen_of_buiten=row['Binnen of buiten']
-            )
+            ))
         except Exception as e:
-            print(f"Fout bij verwerken rij {index}: {str(e)}")
+            log.error(f"Fout bij verwerken rij {index}: {str(e)}")
+            metrics.count_failure(PIPELINE_NAME, 'parse', e)
             continue
 
+    memprofile.checkpoint('rows')
+    payloads = coalesce.group_by_resident(payloads, RESIDENT_MERGE_FIELDS, keep_separate=('datum', 'tijdvak'),
+                                          sum_fields=RESIDENT_SUM_FIELDS)
+    queued = outbox.enqueue(PIPELINE_NAME, payloads)
+    memprofile.checkpoint('enqueue')
+    log.info(f"{queued} berichten in wachtrij gezet")
+
 def process_data():
-    print(f"\n=== Start nieuwe verwerking: {datetime.now()} ===")
+    log.info(f"=== Start nieuwe verwerking: {datetime.now()} ===")
     try:
         outlook = OutlookClient()
         sender_email = os.environ.get('SENDER_EMAIL')
@@ -284,22 +324,28 @@ def process_data():
                 sender_email=sender_email,
                 subject_line=subject_line
             )
+            polling.record(PIPELINE_NAME, excel_file is not None)
             if excel_file:
                 try:
                     process_excel_file(excel_file)
                 finally:
                     if os.path.exists(excel_file):
-                        print(f"\nVerwijderen tijdelijk bestand: {excel_file}")
+                        log.info(f"Verwijderen tijdelijk bestand: {excel_file}")
                         os.remove(excel_file)
             else:
-                print("Geen nieuwe Excel bestanden gevonden om te verwerken")
+                log.info("Geen nieuwe Excel bestanden gevonden om te verwerken")
         except Exception as e:
-            print(f"Fout bij verwerken emails: {str(e)}")
+            log.error(f"Fout bij verwerken emails: {str(e)}")
+            raise
     except Exception as e:
-        print(f"Algemene fout: {str(e)}")
+        log.error(f"Algemene fout: {str(e)}")
+        raise
+    finally:
+        # Also after a failed fetch: rows of earlier runs still wait in the outbox
+        outbox.drain()
 
 if __name__ == "__main__":
-    print("\n=== ENVIRONMENT CHECK ===")
+    log.info("=== ENVIRONMENT CHECK ===")
     required_vars = [
         'AZURE_CLIENT_ID', 
         'AZURE_CLIENT_SECRET', 
@@ -313,14 +359,14 @@ if __name__ == "__main__":
     ]
     missing_vars = [var for var in required_vars if not os.environ.get(var)]
     if missing_vars:
-        print(f"ERROR: Missende environment variables: {', '.join(missing_vars)}")
+        log.error(f"ERROR: Missende environment variables: {', '.join(missing_vars)}")
         sys.exit(1)
-    print("Alle environment variables zijn ingesteld")
-    print("\n=== EERSTE TEST ===")
-    print("Handmatige test uitvoeren...")
+    log.info("Alle environment variables zijn ingesteld")
+    log.info("=== EERSTE TEST ===")
+    log.info("Handmatige test uitvoeren...")
     try:
-        process_data()
-        print("Handmatige test compleet")
+        jobs.locked_job(PIPELINE_NAME, process_data)()
+        log.info("Handmatige test compleet")
     except Exception as e:
-        print(f"Fout tijdens handmatige test: {str(e)}")
+        log.error(f"Fout tijdens handmatige test: {str(e)}")
         sys.exit(1)
@@ -3,7 +3,19 @@ import sys
 import requests
 import pandas as pd
 from datetime import datetime
-import msal
+import clients
+import jobs
+import ledger
+import logs
+import memprofile
+import metrics
+import outbox
+import polling
+import ticket_index
+
+log = logs.get_logger(__name__)
+
+PIPELINE_NAME = 'VestedaFotoVerzoek'
 
 class OutlookClient:
     def __init__(self):
@@ -14,11 +26,7 @@ class OutlookClient:
         self.password = os.getenv('OUTLOOK_PASSWORD')
         
         # Initialize MSAL client
-        self.app = msal.ConfidentialClientApplication(
-            client_id=self.client_id,
-            client_credential=self.client_secret,
-            authority=f"https://login.microsoftonline.com/{self.tenant_id}"
-        )
+        self.app = clients.graph_app()
         
     def get_token(self):
         """Get access token for Microsoft Graph API"""
@@ -26,15 +34,11 @@ class OutlookClient:
                  'https://graph.microsoft.com/Mail.ReadWrite',
                  'https://graph.microsoft.com/User.Read']
                  
-        result = self.app.acquire_token_by_username_password(
-            username=self.username,
-            password=self.password,
-            scopes=scopes
-        )
+        result = clients.acquire_graph_token(self.username, self.password, scopes)
         
         if "access_token" not in result:
             error_msg = result.get('error_description', 'Unknown error')
-            print(f"Token acquisition failed. Error: {error_msg}")
+            log.error(f"Token acquisition failed. Error: {error_msg}")
             raise Exception(f"Failed to obtain token: {error_msg}")
             
         return result["access_token"]
@@ -48,17 +52,18 @@ class OutlookClient:
         
         # Test reading messages
         test_url = 'https://graph.microsoft.com/v1.0/me/messages?$top=1'
-        response = requests.get(test_url, headers=headers)
+        response = clients.graph.get(test_url, headers=headers)
         
         if response.status_code != 200:
-            print(f"Permission verification failed. Status: {response.status_code}")
-            print(f"Response: {response.text}")
+            log.error(f"Permission verification failed. Status: {response.status_code}")
+            log.info(f"Response: {response.text}")
             return False
         return True
 
+    @logs.stage('fetch')
     def download_excel_attachment(self, sender_email, subject_line):
         """Downloads Excel attachment from specific email using Microsoft Graph API."""
-        print(f"\nZoeken naar emails van {sender_email} met onderwerp '{subject_line}'...")
+        log.info(f"Zoeken naar emails van {sender_email} met onderwerp '{subject_line}'...")
         
         token = self.get_token()
         
@@ -80,16 +85,16 @@ class OutlookClient:
                 '$select': 'id,subject,hasAttachments'
             }
             
-            response = requests.get(url, headers=headers, params=params)
+            response = clients.graph.get(url, headers=headers, params=params)
             response.raise_for_status()
             
             messages = response.json().get('value', [])
             
             if not messages:
-                print("Geen nieuwe emails gevonden")
+                log.info("Geen nieuwe emails gevonden")
                 return None
                 
-            print("Nieuwe email(s) gevonden, bijlage controleren...")
+            log.info("Nieuwe email(s) gevonden, bijlage controleren...")
             
             for message in messages:
                 if not message.get('hasAttachments'):
@@ -99,15 +104,16 @@ class OutlookClient:
                     # Get attachments for this message
                     message_id = message['id']
                     attachments_url = f'https://graph.microsoft.com/v1.0/me/messages/{message_id}/attachments'
-                    attachments_response = requests.get(attachments_url, headers=headers)
+                    attachments_response = clients.graph.get(attachments_url, headers=headers)
                     attachments_response.raise_for_status()
                     
                     attachments = attachments_response.json().get('value', [])
+                    memprofile.checkpoint('attachments json')
                     
                     for attachment in attachments:
                         filename = attachment.get('name', '')
                         if filename.endswith('.xlsx'):
-                            print(f"Excel bijlage gevonden: {filename}")
+                            log.info(f"Excel bijlage gevonden: {filename}")
                             
                             # Download attachment content
                             content = attachment.get('contentBytes')
@@ -115,43 +121,44 @@ class OutlookClient:
                                 filepath = f"downloads/{datetime.now().strftime('%Y%m%d')}_{filename}"
                                 os.makedirs('downloads', exist_ok=True)
                                 
-                                print(f"Opslaan als: {filepath}")
+                                log.info(f"Opslaan als: {filepath}")
                                 
                                 # Decode and save attachment
                                 import base64
                                 with open(filepath, 'wb') as f:
                                     f.write(base64.b64decode(content))
+                                memprofile.checkpoint('base64 decode')
                                     
                                 try:
                                     # Mark message as read
                                     update_url = f'https://graph.microsoft.com/v1.0/me/messages/{message_id}'
-                                    update_response = requests.patch(
+                                    update_response = clients.graph.patch(
                                         update_url,
                                         headers=headers,
                                         json={'isRead': True}
                                     )
                                     update_response.raise_for_status()
-                                    print("Email gemarkeerd als gelezen")
+                                    log.info("Email gemarkeerd als gelezen")
                                 except requests.exceptions.HTTPError as e:
-                                    print(f"Waarschuwing: Kon email niet als gelezen markeren: {str(e)}")
+                                    log.warning(f"Waarschuwing: Kon email niet als gelezen markeren: {str(e)}")
                                     # Continue processing even if marking as read fails
                                     
                                 return filepath
                                 
                 except requests.exceptions.HTTPError as e:
-                    print(f"Fout bij verwerken van specifieke email: {str(e)}")
+                    log.error(f"Fout bij verwerken van specifieke email: {str(e)}")
                     continue
                     
-            print("Geen Excel bijlage gevonden in nieuwe emails")
+            log.info("Geen Excel bijlage gevonden in nieuwe emails")
             return None
             
         except requests.exceptions.HTTPError as e:
-            print(f"HTTP Error bij API aanroep: {str(e)}")
+            log.error(f"HTTP Error bij API aanroep: {str(e)}")
             if e.response is not None:
-                print(f"Response body: {e.response.text}")
+                log.info(f"Response body: {e.response.text}")
             raise
         except Exception as e:
-            print(f"Onverwachte fout: {str(e)}")
+            log.error(f"Onverwachte fout: {str(e)}")
             raise
 
 def format_phone_number(phone):
@@ -166,7 +173,7 @@ def format_phone_number(phone):
 def send_whatsapp_message(naam, dp_nummer, mobielnummer):
     """Sends WhatsApp message via Trengo with the template."""
     if not mobielnummer:
-        print(f"Geen geldig telefoonnummer voor {naam}")
+        log.info(f"Geen geldig telefoonnummer voor {naam}")
         return
         
     url = "https://app.trengo.com/api/v2/wa_sessions"
@@ -187,32 +194,45 @@ def send_whatsapp_message(naam, dp_nummer, mobielnummer):
         "Authorization": "Bearer " + os.environ.get('TRENGO_API_KEY')
     }
     
+    ledger_key = ledger.message_key(PIPELINE_NAME, payload['hsm_id'], formatted_phone, dp_nummer)
+    if ledger.already_sent(ledger_key):
+        log.info(f"Bericht voor {naam} al eerder verstuurd, overslaan")
+        return
+
     try:
-        print(f"Versturen WhatsApp bericht naar {formatted_phone} voor {naam} (DP: {dp_nummer})...")
-        response = requests.post(url, json=payload, headers=headers)
+        log.info(f"Versturen WhatsApp bericht naar {formatted_phone} voor {naam} (DP: {dp_nummer})...")
+        response = clients.trengo.post(url, json=payload, headers=headers)
         response.raise_for_status()
-        print(f"Trengo response: {response.text}")
-        return response.json()
+        log.debug(f"Trengo response: {response.text}")
+        response_json = response.json()
+        ledger.record_sent(ledger_key, response_json.get('message', {}).get('ticket_id'))
+        ticket_index.record_sent(response_json.get('message', {}).get('ticket_id'), phone=formatted_phone)
+        return response_json
     except requests.exceptions.HTTPError as e:
-        print(f"HTTP Error bij versturen bericht: {str(e)}")
+        log.error(f"HTTP Error bij versturen bericht: {str(e)}")
         if e.response is not None:
-            print(f"Response body: {e.response.text}")
+            log.info(f"Response body: {e.response.text}")
         raise
     except Exception as e:
-        print(f"Fout bij versturen bericht: {str(e)}")
+        log.error(f"Fout bij versturen bericht: {str(e)}")
         raise
 
+outbox.register(PIPELINE_NAME, send_whatsapp_message, 'photo')
+
+@logs.stage('parse')
 def process_excel_file(filepath):
     try:
-        print(f"\nVerwerken Excel bestand: {filepath}")
+        log.info(f"Verwerken Excel bestand: {filepath}")
         df = pd.read_excel(filepath)
+        memprofile.checkpoint('read_excel')
+        metrics.count('rows_parsed', PIPELINE_NAME, len(df))
         
         if df.empty:
-            print("Geen data gevonden in Excel bestand")
+            log.info("Geen data gevonden in Excel bestand")
             return
         
-        print(f"Aantal rijen gevonden: {len(df)}")
-        print(f"Kolommen in bestand: {', '.join(df.columns)}")
+        log.info(f"Aantal rijen gevonden: {len(df)}")
+        log.info(f"Kolommen in bestand: {', '.join(df.columns)}")
         
         column_mapping = {
             'Naam bewoner': 'fields.Naam bewoner',
@@ -227,37 +247,44 @@ def process_excel_file(filepath):
         df = df.rename(columns=column_mapping)
         
         df_unique = df.drop_duplicates(subset=['fields.DP Nummer'])
+        memprofile.checkpoint('drop_duplicates')
+        metrics.count('duplicates_removed', PIPELINE_NAME, len(df) - len(df_unique))
         
         if len(df_unique) < len(df):
-            print(f"Let op: {len(df) - len(df_unique)} dubbele afspraken verwijderd")
+            log.info(f"Let op: {len(df) - len(df_unique)} dubbele afspraken verwijderd")
         
+        payloads = []
         for index, row in df_unique.iterrows():
             try:
-                print(f"\nVerwerken rij {index + 1}/{len(df_unique)}")
+                log.debug(f"Verwerken rij {index + 1}/{len(df_unique)}", extra=logs.row(index, len(df_unique)))
                 mobielnummer = format_phone_number(row['fields.Mobielnummer'])
                 if not mobielnummer:
-                    print(f"Geen geldig telefoonnummer voor {row['fields.Naam bewoner']}, deze overslaan")
+                    log.info(f"Geen geldig telefoonnummer voor {row['fields.Naam bewoner']}, deze overslaan")
                     continue
                 
-                send_whatsapp_message(
+                payloads.append(dict(
                     naam=row['fields.Naam bewoner'],
                     dp_nummer=row['fields.DP Nummer'],
                     mobielnummer=mobielnummer
-                )
-                
-                print(f"Bericht verstuurd voor {row['fields.Naam bewoner']} (DP: {row['fields.DP Nummer']})")
-                
+                ))
+
             except Exception as e:
-                print(f"Fout bij verwerken rij {index}: {str(e)}")
+                log.error(f"Fout bij verwerken rij {index}: {str(e)}")
+                metrics.count_failure(PIPELINE_NAME, 'parse', e)
                 continue
-                
+
+        memprofile.checkpoint('rows')
+        queued = outbox.enqueue(PIPELINE_NAME, payloads)
+        memprofile.checkpoint('enqueue')
+        log.info(f"{queued} berichten in wachtrij gezet")
+
     except Exception as e:
-        print(f"Fout bij verwerken Excel bestand: {str(e)}")
+        log.error(f"Fout bij verwerken Excel bestand: {str(e)}")
         raise
 
 def process_data():
     """Main function to check email and process Excel."""
-    print(f"\n=== Start nieuwe verwerking: {datetime.now()} ===")
+    log.info(f"=== Start nieuwe verwerking: {datetime.now()} ===")
     
     try:
         outlook = OutlookClient()
@@ -267,6 +294,7 @@ def process_data():
                 sender_email=os.environ.get('SENDER_EMAIL'),
                 subject_line=os.environ.get('SUBJECT_LINE_VES_FV')
             )
+            polling.record(PIPELINE_NAME, excel_file is not None)
             
             if excel_file:
                 try:
@@ -274,16 +302,21 @@ def process_data():
                 finally:
                     # Always try to clean up the file
                     if os.path.exists(excel_file):
-                        print(f"\nVerwijderen tijdelijk bestand: {excel_file}")
+                        log.info(f"Verwijderen tijdelijk bestand: {excel_file}")
                         os.remove(excel_file)
             else:
-                print("Geen nieuwe Excel bestanden gevonden om te verwerken")
+                log.info("Geen nieuwe Excel bestanden gevonden om te verwerken")
                 
         except Exception as e:
-            print(f"Fout bij verwerken emails: {str(e)}")
+            log.error(f"Fout bij verwerken emails: {str(e)}")
+            raise
             
     except Exception as e:
-        print(f"Algemene fout: {str(e)}")
+        log.error(f"Algemene fout: {str(e)}")
+        raise
+    finally:
+        # Also after a failed fetch: rows of earlier runs still wait in the outbox
+        outbox.drain()
 
 if __name__ == "__main__":
-    process_data()
+    jobs.locked_job(PIPELINE_NAME, process_data)()
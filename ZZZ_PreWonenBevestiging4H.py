@@ -1,15 +1,35 @@
 import os
-import requests
-import pandas as pd
+import clients
+import deadlines
+import jobs
+import ledger
+import logs
+import metrics
+import outbox
+import polling
+import sampler
+import shutdown
+import ticket_index
+import tracing
+import airtable_records
 from datetime import datetime
 from apscheduler.schedulers.blocking import BlockingScheduler
 
+log = logs.get_logger(__name__)
+
+PIPELINE_NAME = 'ZZZ_PreWonenBevestiging4H'
+# Rate limiter priority of these sends next to the outbox classes (outbox.CLASS_WEIGHTS)
+PRIORITY_CLASS = 'confirmation'
+
 # Airtable configuration
 AIRTABLE_BASE_ID = os.environ.get('AIRTABLE_BASE_ID')
 AIRTABLE_TABLE_NAME = os.environ.get('AIRTABLE_PW4H')
 AIRTABLE_API_KEY = os.environ.get('AIRTABLE_API_KEY')
 WHATSAPP_TEMPLATE_ID = os.environ.get('WHATSAPP_TEMPLATE_ID_PW_4H')
 
+# Records missing any of these fields are quarantined instead of failing the batch
+REQUIRED_FIELDS = ['Naam bewoner', 'Mobielnummer', 'Datum bezoek', 'Tijdvak', 'Reparatieduur']
+
 def format_date(date_str):
     """Formatteert datum naar dd MMM yy formaat met Nederlandse maandnamen."""
     try:
@@ -36,26 +56,23 @@ def format_date(date_str):
         return f"{day} {nl_month_abbr[month]} {year}"
     
     except Exception as e:
-        print(f"Fout bij formatteren datum {date_str}: {str(e)}")
+        log.error(f"Fout bij formatteren datum {date_str}: {str(e)}")
         return date_str
 
 def delete_airtable_record(record_id):
-    """Deletes a record from Airtable."""
-    url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}/{record_id}"
+    """Queues a record for deletion; Airtable deletes are sent in batches."""
+    url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}"
     headers = {
         "Authorization": f"Bearer {AIRTABLE_API_KEY}",
         "Content-Type": "application/json"
     }
-    
-    response = requests.delete(url, headers=headers)
-    if response.status_code != 200:
-        raise Exception(f"Error deleting record: {response.status_code} - {response.text}")
-    print(f"Record {record_id} successfully deleted")
+    airtable_records.queue_delete(url, headers, record_id)
 
+@logs.stage('fetch')
 def get_airtable_data():
     """Fetches data from Airtable."""
     try:
-        print("Starting Airtable data fetch...")
+        log.info("Starting Airtable data fetch...")
         
         url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}"
         headers = {
@@ -63,18 +80,14 @@ def get_airtable_data():
             "Content-Type": "application/json"
         }
         
-        response = requests.get(url, headers=headers)
+        reminders, quarantined = airtable_records.fetch_reminders(url, headers, REQUIRED_FIELDS, AIRTABLE_TABLE_NAME)
         
-        if response.status_code != 200:
-            raise Exception(f"Error fetching data: {response.status_code} - {response.text}")
-        
-        data = response.json()
-        df = pd.json_normalize(data['records'])
-        print(f"Data retrieved. Row count: {len(df)}")
-        return df
+        metrics.count('rows_parsed', PIPELINE_NAME, len(reminders) + quarantined)
+        log.info(f"Data retrieved. Row count: {len(reminders)} ({quarantined} quarantined)")
+        return reminders
     
     except Exception as e:
-        print(f"Error fetching Airtable data: {str(e)}")
+        log.error(f"Error fetching Airtable data: {str(e)}")
         raise
 
 def format_phone_number(phone):
@@ -109,62 +122,103 @@ def send_whatsapp_message(naam_bewoner, datum, tijdvak, reparatieduur, mobielnum
         "Authorization": "Bearer " + os.environ.get('TRENGO_API_KEY')
     }
     
+    ledger_key = ledger.message_key(PIPELINE_NAME, payload['hsm_id'], formatted_phone, tijdvak, datum)
+    if ledger.already_sent(ledger_key):
+        log.info(f"Message for {naam_bewoner} already sent, skipping")
+        return
+
     try:
-        print(f"Sending message to {formatted_phone} for {naam_bewoner}...")
-        response = requests.post(url, json=payload, headers=headers)
-        print(f"Trengo response: {response.text}")
-        return response.json()
+        log.info(f"Sending message to {formatted_phone} for {naam_bewoner}...")
+        response = clients.trengo.post(url, json=payload, headers=headers)
+        log.debug(f"Trengo response: {response.text}")
+        # A 429 or 5xx raises, so the record stays in Airtable for the next tick
+        response.raise_for_status()
+        response_json = response.json()
+        ledger.record_sent(ledger_key, response_json.get('message', {}).get('ticket_id'))
+        ticket_index.record_sent(response_json.get('message', {}).get('ticket_id'), phone=formatted_phone)
+        return response_json
     except Exception as e:
-        print(f"Error sending message: {str(e)}")
+        log.error(f"Error sending message: {str(e)}")
         raise
 
+@logs.stage('send')
+def process_record(reminder, run_deadline=None):
+    """Sends the reminder for one Airtable record and deletes it."""
+    deadline = deadlines.reminder_deadline(reminder)
+    if deadlines.expired(deadline):
+        deadlines.report_expired(PIPELINE_NAME, reminder.record_id, reminder.naam_bewoner, deadline)
+        delete_airtable_record(reminder.record_id)
+        return False
+
+    # Send message
+    with clients.deadline(deadlines.earliest(deadline, run_deadline)), \
+            clients.priority(outbox.class_weight(PRIORITY_CLASS)):
+        send_whatsapp_message(
+            naam_bewoner=reminder.naam_bewoner,
+            datum=reminder.datum_bezoek,
+            tijdvak=reminder.tijdvak,
+            reparatieduur=reminder.reparatieduur,
+            mobielnummer=reminder.mobielnummer
+        )
+
+    # Delete record after successful send
+    delete_airtable_record(reminder.record_id)
+    log.info(f"Message sent and record deleted for {reminder.naam_bewoner}")
+    return True
+
 def process_data():
     """Main function to fetch data and send messages."""
-    print(f"\n=== Starting new processing: {datetime.now()} ===")
+    log.info(f"=== Starting new processing: {datetime.now()} ===")
     
     try:
-        df = get_airtable_data()
+        reminders = get_airtable_data()
+        polling.record(PIPELINE_NAME, bool(reminders))
         
-        if df.empty:
-            print("No data found to process")
+        if not reminders:
+            log.info("No data found to process")
             return
         
-        for index, row in df.iterrows():
+        # Earliest deadline first; the run stops when its time budget is used up
+        reminders.sort(key=lambda r: deadlines.sort_key(deadlines.reminder_deadline(r)))
+        budget = deadlines.run_deadline()
+
+        for index, reminder in enumerate(reminders):
+            if shutdown.requested():
+                log.info("Stopping: remaining records are kept for the next run")
+                break
+            if deadlines.expired(budget):
+                log.info(f"Run time budget used up, {len(reminders) - index} records wait for the next run")
+                break
             try:
-                print(f"\nProcessing row {index + 1}: {row['fields.Naam bewoner']}")
-                
-                if 'fields.Mobielnummer' not in row or pd.isna(row['fields.Mobielnummer']):
-                    print(f"No phone number found for {row['fields.Naam bewoner']}, skipping row")
-                    continue
-                
-                # Send message
-                send_whatsapp_message(
-                    naam_bewoner=row['fields.Naam bewoner'],
-                    datum=row['fields.Datum bezoek'],
-                    tijdvak=row['fields.Tijdvak'],
-                    reparatieduur=row['fields.Reparatieduur'],
-                    mobielnummer=row['fields.Mobielnummer']
-                )
+                log.debug(f"Processing row {index + 1}: {reminder.naam_bewoner}", extra=logs.row(reminder.record_id, len(reminders)))
                 
-                # Delete record after successful send
-                delete_airtable_record(row['id'])
-                print(f"Message sent and record deleted for {row['fields.Naam bewoner']}")
+                with logs.context(row=reminder.record_id, batch_size=len(reminders)), \
+                        tracing.span('row', pipeline=PIPELINE_NAME, row=reminder.record_id):
+                    process_record(reminder, budget)
                 
+            except clients.CircuitOpenError as e:
+                log.info(f"{str(e)}; remaining records are kept for the next run")
+                break
             except Exception as e:
-                print(f"Error processing row {index}: {str(e)}")
+                log.error(f"Error processing row {index}: {str(e)}")
+                metrics.count_failure(PIPELINE_NAME, 'send', e)
                 continue
     
     except Exception as e:
-        print(f"General error: {str(e)}")
-
-# Start initial processing
-print("Starting first processing...")
-process_data()
-
-# Schedule future processing
-scheduler = BlockingScheduler()
-scheduler.add_job(process_data, 'interval', minutes=30)
+        log.error(f"General error: {str(e)}")
+        raise
+    finally:
+        airtable_records.flush_deletes()
 
 if __name__ == "__main__":
-    print("\nStarting scheduler...")
+    # First run starts immediately; the interval then adapts between 5 and 30
+    # minutes, and a run still busy when the next is due is skipped
+    scheduler = BlockingScheduler(job_defaults=jobs.JOB_DEFAULTS)
+    poller = polling.get_poller(PIPELINE_NAME, min_interval=5 * 60, max_interval=30 * 60)
+    polling.add_adaptive_job(scheduler, PIPELINE_NAME, jobs.locked_job(PIPELINE_NAME, process_data), poller)
+
+    shutdown.install(scheduler)
+    sampler.install()
+    log.info("Starting scheduler...")
     scheduler.start()
+    shutdown.finish()
@@ -1,14 +1,35 @@
 import os
-import requests
-import pandas as pd
+import clients
+import deadlines
+import jobs
+import ledger
+import logs
+import metrics
+import outbox
+import polling
+import sampler
+import shutdown
+import ticket_index
+import tracing
+import airtable_records
 from datetime import datetime
 from apscheduler.schedulers.blocking import BlockingScheduler
 
+log = logs.get_logger(__name__)
+
+PIPELINE_NAME = 'ZZZ_VestedaHerinnering1H'
+# Rate limiter priority of these sends next to the outbox classes (outbox.CLASS_WEIGHTS)
+PRIORITY_CLASS = 'reminder'
+
 AIRTABLE_BASE_ID = os.environ.get('AIRTABLE_BASE_ID')
 AIRTABLE_TABLE_NAME = os.environ.get('AIRTABLE_V1H')
 AIRTABLE_API_KEY = os.environ.get('AIRTABLE_API_KEY')
 WHATSAPP_TEMPLATE_ID = os.environ.get('WHATSAPP_TEMPLATE_ID_VESTEDA_1H')
 
+# Records zonder deze velden gaan in quarantaine in plaats van de batch te stoppen
+REQUIRED_FIELDS = ['Naam bewoner', 'Mobielnummer', 'Monteur', 'Dagnaam', 'Datum bezoek',
+                   'Begintijd', 'Eindtijd', 'Reparatieduur', 'Taaknummer']
+
 def format_date(date_str):
     """Formatteert datum naar dd MMM yy formaat met Nederlandse maandnamen."""
     try:
@@ -35,26 +56,23 @@ def format_date(date_str):
         return f"{day} {nl_month_abbr[month]} {year}"
     
     except Exception as e:
-        print(f"Fout bij formatteren datum {date_str}: {str(e)}")
+        log.error(f"Fout bij formatteren datum {date_str}: {str(e)}")
         return date_str
 
 def delete_airtable_record(record_id):
-    """Deletes a record from Airtable."""
-    url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}/{record_id}"
+    """Zet een record klaar om te verwijderen; Airtable deletes gaan in batches."""
+    url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}"
     headers = {
         "Authorization": f"Bearer {AIRTABLE_API_KEY}",
         "Content-Type": "application/json"
     }
-    
-    response = requests.delete(url, headers=headers)
-    if response.status_code != 200:
-        raise Exception(f"Fout bij verwijderen record: {response.status_code} - {response.text}")
-    print(f"Record {record_id} succesvol verwijderd")
+    airtable_records.queue_delete(url, headers, record_id)
 
+@logs.stage('fetch')
 def get_airtable_data():
     """Haalt data op uit Airtable."""
     try:
-        print("Start ophalen Airtable data...")
+        log.info("Start ophalen Airtable data...")
         
         url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}"
         headers = {
@@ -62,20 +80,15 @@ def get_airtable_data():
             "Content-Type": "application/json"
         }
         
-        response = requests.get(url, headers=headers)
+        reminders, quarantined = airtable_records.fetch_reminders(url, headers, REQUIRED_FIELDS, AIRTABLE_TABLE_NAME)
         
-        if response.status_code != 200:
-            raise Exception(f"Fout bij ophalen data: {response.status_code} - {response.text}")
-        data = response.json()
+        metrics.count('rows_parsed', PIPELINE_NAME, len(reminders) + quarantined)
         
-        df = pd.json_normalize(data['records'])
-        df['fields.Taaknummer'] = df['fields.Taaknummer'].astype(int)
-        
-        print(f"Data opgehaald. Aantal rijen: {len(df)}")
-        return df
+        log.info(f"Data opgehaald. Aantal rijen: {len(reminders)} ({quarantined} in quarantaine)")
+        return reminders
     
     except Exception as e:
-        print(f"Fout bij ophalen Airtable data: {str(e)}")
+        log.error(f"Fout bij ophalen Airtable data: {str(e)}")
         raise
 
 def format_phone_number(phone):
@@ -115,64 +128,107 @@ def send_whatsapp_message(naam, monteur, dagnaam, datum, begintijd, eindtijd, re
         "Authorization": "Bearer " + os.environ.get('TRENGO_API_KEY')
     }
     
+    ledger_key = ledger.message_key(PIPELINE_NAME, payload['hsm_id'], formatted_phone, taaknummer, datum)
+    if ledger.already_sent(ledger_key):
+        log.info(f"Bericht voor {naam} al eerder verstuurd, overslaan")
+        return
+
     try:
-        print(f"Versturen bericht naar {formatted_phone} voor {naam}...")
-        response = requests.post(url, json=payload, headers=headers)
-        print(f"Response van Trengo: {response.text}")
-        return response.json()
+        log.info(f"Versturen bericht naar {formatted_phone} voor {naam}...")
+        response = clients.trengo.post(url, json=payload, headers=headers)
+        log.debug(f"Trengo response: {response.text}")
+        # A 429 or 5xx raises, so the record stays in Airtable for the next tick
+        response.raise_for_status()
+        response_json = response.json()
+        ledger.record_sent(ledger_key, response_json.get('message', {}).get('ticket_id'))
+        ticket_index.record_sent(response_json.get('message', {}).get('ticket_id'), phone=formatted_phone)
+        return response_json
     except Exception as e:
-        print(f"Fout bij versturen bericht: {str(e)}")
+        log.error(f"Fout bij versturen bericht: {str(e)}")
         raise
 
+@logs.stage('send')
+def process_record(reminder, run_deadline=None):
+    """Verstuurt de herinnering voor één Airtable record en verwijdert het."""
+    deadline = deadlines.reminder_deadline(reminder)
+    if deadlines.expired(deadline):
+        deadlines.report_expired(PIPELINE_NAME, reminder.record_id, reminder.naam_bewoner, deadline)
+        delete_airtable_record(reminder.record_id)
+        return False
+
+    # Send message
+    with clients.deadline(deadlines.earliest(deadline, run_deadline)), \
+            clients.priority(outbox.class_weight(PRIORITY_CLASS)):
+        send_whatsapp_message(
+            naam=reminder.naam_bewoner,
+            monteur=reminder.monteur,
+            dagnaam=reminder.dagnaam,
+            datum=reminder.datum_bezoek,
+            begintijd=reminder.begintijd,
+            eindtijd=reminder.eindtijd,
+            reparatieduur=reminder.reparatieduur,
+            taaknummer=reminder.taaknummer,
+            mobielnummer=reminder.mobielnummer
+        )
+
+    # Delete record after successful send
+    delete_airtable_record(reminder.record_id)
+    log.info(f"Bericht verstuurd en record verwijderd voor {reminder.naam_bewoner}")
+    return True
+
 def process_data():
     """Hoofdfunctie die data ophaalt en berichten verstuurt."""
-    print(f"\n=== Start nieuwe verwerking: {datetime.now()} ===")
+    log.info(f"=== Start nieuwe verwerking: {datetime.now()} ===")
     
     try:
-        df = get_airtable_data()
+        reminders = get_airtable_data()
+        polling.record(PIPELINE_NAME, bool(reminders))
         
-        if df.empty:
-            print("Geen data gevonden om te verwerken")
+        if not reminders:
+            log.info("Geen data gevonden om te verwerken")
             return
         
-        for index, row in df.iterrows():
+        # Earliest deadline first; the run stops when its time budget is used up
+        reminders.sort(key=lambda r: deadlines.sort_key(deadlines.reminder_deadline(r)))
+        budget = deadlines.run_deadline()
+
+        for index, reminder in enumerate(reminders):
+            if shutdown.requested():
+                log.info("Afsluiten: overige records blijven staan voor de volgende ronde")
+                break
+            if deadlines.expired(budget):
+                log.info(f"Tijdsbudget van deze ronde op, {len(reminders) - index} records wachten op de volgende ronde")
+                break
             try:
-                print(f"\nVerwerken rij {index + 1}: {row['fields.Naam bewoner']}")
-                
-                if 'fields.Mobielnummer' not in row or pd.isna(row['fields.Mobielnummer']):
-                    print(f"Geen telefoonnummer gevonden voor {row['fields.Naam bewoner']}, deze rij wordt overgeslagen")
-                    continue
-                
-                # Send message
-                send_whatsapp_message(
-                    naam=row['fields.Naam bewoner'],
-                    monteur=row['fields.Monteur'],
-                    dagnaam=row['fields.Dagnaam'],
-                    datum=row['fields.Datum bezoek'],
-                    begintijd=row['fields.Begintijd'],
-                    eindtijd=row['fields.Eindtijd'],
-                    reparatieduur=row['fields.Reparatieduur'],
-                    taaknummer=row['fields.Taaknummer'],
-                    mobielnummer=row['fields.Mobielnummer']
-                )
+                log.debug(f"Verwerken rij {index + 1}: {reminder.naam_bewoner}", extra=logs.row(reminder.record_id, len(reminders)))
                 
-                # Delete record after successful send
-                delete_airtable_record(row['id'])
-                print(f"Bericht verstuurd en record verwijderd voor {row['fields.Naam bewoner']}")
+                with logs.context(row=reminder.record_id, batch_size=len(reminders)), \
+                        tracing.span('row', pipeline=PIPELINE_NAME, row=reminder.record_id):
+                    process_record(reminder, budget)
                 
+            except clients.CircuitOpenError as e:
+                log.info(f"{str(e)}; overige records blijven staan voor de volgende ronde")
+                break
             except Exception as e:
-                print(f"Fout bij verwerken rij {index}: {str(e)}")
+                log.error(f"Fout bij verwerken rij {index}: {str(e)}")
+                metrics.count_failure(PIPELINE_NAME, 'send', e)
                 continue
     
     except Exception as e:
-        print(f"Algemene fout: {str(e)}")
-
-print("Start eerste verwerking...")
-process_data()
-
-scheduler = BlockingScheduler()
-scheduler.add_job(process_data, 'interval', minutes=30)
+        log.error(f"Algemene fout: {str(e)}")
+        raise
+    finally:
+        airtable_records.flush_deletes()
 
 if __name__ == "__main__":
-    print("\nStarting scheduler...")
+    # First run starts immediately; the interval then adapts between 5 and 30
+    # minutes, and a run still busy when the next is due is skipped
+    scheduler = BlockingScheduler(job_defaults=jobs.JOB_DEFAULTS)
+    poller = polling.get_poller(PIPELINE_NAME, min_interval=5 * 60, max_interval=30 * 60)
+    polling.add_adaptive_job(scheduler, PIPELINE_NAME, jobs.locked_job(PIPELINE_NAME, process_data), poller)
+
+    shutdown.install(scheduler)
+    sampler.install()
+    log.info("Starting scheduler...")
     scheduler.start()
+    shutdown.finish()
@@ -0,0 +1,199 @@
+import os
+import json
+import threading
+from datetime import datetime
+from dataclasses import dataclass
+import clients
+import logs
+import shutdown
+
+log = logs.get_logger(__name__)
+
+QUARANTINE_FILE = os.getenv('AIRTABLE_QUARANTINE_FILE', 'quarantine/airtable.jsonl')
+# Airtable deletes at most 10 records per request
+DELETE_BATCH_SIZE = 10
+
+# Airtable field name -> Reminder attribute
+FIELD_MAP = {
+    'Naam bewoner': 'naam_bewoner',
+    'Mobielnummer': 'mobielnummer',
+    'Datum bezoek': 'datum_bezoek',
+    'Reparatieduur': 'reparatieduur',
+    'Monteur': 'monteur',
+    'Dagnaam': 'dagnaam',
+    'Begintijd': 'begintijd',
+    'Eindtijd': 'eindtijd',
+    'Tijdvak': 'tijdvak',
+    'Taaknummer': 'taaknummer'
+}
+
+@dataclass(frozen=True, slots=True)
+class Reminder:
+    """One reminder record from an Airtable table, with plain string fields."""
+    record_id: str
+    naam_bewoner: str = ''
+    mobielnummer: str = ''
+    datum_bezoek: str = ''
+    reparatieduur: str = ''
+    monteur: str = ''
+    dagnaam: str = ''
+    begintijd: str = ''
+    eindtijd: str = ''
+    tijdvak: str = ''
+    taaknummer: int | None = None
+
+class RecordError(ValueError):
+    pass
+
+def decode_record(record, required):
+    """Turns one Airtable record into a Reminder; raises RecordError if it is unusable."""
+    record_id = record.get('id')
+    if not record_id:
+        raise RecordError("Record zonder id")
+
+    fields = record.get('fields', {})
+    missing = [name for name in required if fields.get(name) in (None, '')]
+    if missing:
+        raise RecordError(f"Missende velden: {', '.join(missing)}")
+
+    values = {}
+    for field, attr in FIELD_MAP.items():
+        value = fields.get(field)
+        if value is None:
+            continue
+        if attr == 'taaknummer':
+            try:
+                value = int(float(value))
+            except (TypeError, ValueError):
+                raise RecordError(f"Ongeldig Taaknummer: {value!r}")
+        else:
+            value = str(value).strip()
+        values[attr] = value
+    return Reminder(record_id=record_id, **values)
+
+# (table, record id) already in the quarantine file. Bad records stay in
+# Airtable, so without this every poll would append them again.
+_quarantined = None
+_quarantined_lock = threading.Lock()
+
+def _load_quarantined():
+    keys = set()
+    try:
+        with open(QUARANTINE_FILE) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                keys.add((entry.get('table'), entry.get('id')))
+    except FileNotFoundError:
+        pass
+    return keys
+
+def quarantine(table, record, reason):
+    """Parks a bad record in the quarantine file instead of failing the whole batch."""
+    global _quarantined
+    key = (table, record.get('id'))
+    with _quarantined_lock:
+        if _quarantined is None:
+            _quarantined = _load_quarantined()
+        if key in _quarantined:
+            log.debug(f"Record {record.get('id')} staat al in quarantaine")
+            return
+        _quarantined.add(key)
+    log.warning(f"Record {record.get('id')} in quarantaine: {reason}")
+    os.makedirs(os.path.dirname(QUARANTINE_FILE) or '.', exist_ok=True)
+    with open(QUARANTINE_FILE, 'a') as f:
+        f.write(json.dumps({
+            'time': datetime.now().isoformat(),
+            'table': table,
+            'id': record.get('id'),
+            'reason': reason,
+            'fields': record.get('fields', {})
+        }, default=str) + '\n')
+
+def decode_page(data, required, table=None):
+    """Returns (reminders, quarantined_count) for one page of the Airtable list API."""
+    reminders = []
+    quarantined = 0
+    for record in data.get('records', []):
+        try:
+            reminders.append(decode_record(record, required))
+        except RecordError as e:
+            quarantine(table, record, str(e))
+            quarantined += 1
+    return reminders, quarantined
+
+def iter_pages(url, headers):
+    """Yields every page of an Airtable list request, following the offset cursor."""
+    params = {}
+    while True:
+        response = clients.airtable.get(url, headers=headers, params=params)
+        if response.status_code != 200:
+            raise Exception(f"Fout bij ophalen data: {response.status_code} - {response.text}")
+        data = response.json()
+        yield data
+        offset = data.get('offset')
+        if not offset:
+            return
+        params = {'offset': offset}
+
+def fetch_reminders(url, headers, required, table=None):
+    """Fetches all pages and returns (reminders, quarantined_count)."""
+    reminders = []
+    quarantined = 0
+    for data in iter_pages(url, headers):
+        page, bad = decode_page(data, required, table)
+        reminders.extend(page)
+        quarantined += bad
+    return reminders, quarantined
+
+# Sent records waiting to be deleted: table url -> (headers, [record ids]).
+# Flushed in batches of DELETE_BATCH_SIZE, at the end of a run and on shutdown.
+# A record whose delete is lost is fetched again, but the send ledger stops
+# it from being sent twice.
+_pending_deletes = {}
+_pending_lock = threading.Lock()
+
+def delete_batch(url, headers, record_ids):
+    response = clients.airtable.delete(url, headers=headers, params=[('records[]', rid) for rid in record_ids])
+    if response.status_code != 200:
+        raise Exception(f"Fout bij verwijderen records: {response.status_code} - {response.text}")
+
+def queue_delete(url, headers, record_id):
+    """Queues a record for deletion; a full batch is sent right away."""
+    with _pending_lock:
+        entry = _pending_deletes.setdefault(url, (headers, []))
+        entry[1].append(record_id)
+        batch = None
+        if len(entry[1]) >= DELETE_BATCH_SIZE:
+            batch = entry[1][:DELETE_BATCH_SIZE]
+            del entry[1][:DELETE_BATCH_SIZE]
+    if batch:
+        try:
+            delete_batch(url, headers, batch)
+        except Exception:
+            with _pending_lock:
+                _pending_deletes.setdefault(url, (headers, []))[1].extend(batch)
+            raise
+
+@shutdown.on_shutdown
+def flush_deletes():
+    """Deletes every queued record; failed batches stay queued for the next flush."""
+    with _pending_lock:
+        pending = {url: (headers, list(ids)) for url, (headers, ids) in _pending_deletes.items() if ids}
+        _pending_deletes.clear()
+    deleted = 0
+    for url, (headers, ids) in pending.items():
+        for i in range(0, len(ids), DELETE_BATCH_SIZE):
+            batch = ids[i:i + DELETE_BATCH_SIZE]
+            try:
+                delete_batch(url, headers, batch)
+                deleted += len(batch)
+            except Exception as e:
+                log.error(f"Verwijderen van {len(batch)} records mislukt: {str(e)}")
+                with _pending_lock:
+                    _pending_deletes.setdefault(url, (headers, []))[1].extend(batch)
+    if deleted:
+        log.info(f"{deleted} Airtable records verwijderd")
+    return deleted
@@ -0,0 +1,277 @@
+"""End-to-end throughput of the workbook pipelines against the local API stand-in.
+
+For each pipeline a synthetic workbook of its schema (Bevestiging with
+Taaktype, Herinnering with Monteur/Dagnaam, Feedback with Taskid, AutoPlan
+with Planregel) is mailed to fakeapi.py, and the pipeline runs in a fresh
+subprocess from the download up to an empty outbox. Reported per case:
+rows/sec, API calls per row (as counted by the stand-in, token calls
+included), p95 row latency (one outbox delivery) and peak RSS.
+
+Every case is appended to reports/benchmarks.jsonl (BENCH_FILE) with the git
+commit, and compared with the previous result for the same pipeline, size
+and latency; a drop of more than --threshold percent (default 20, above the
+run-to-run noise of small cases) is marked REGRESSIE.
+
+    python benchmarks/bench_pipelines.py [--rows 100 1000 10000] [--pipeline NAME ...]
+        [--latency-ms 5] [--jitter-ms 2] [--error-rate 0] [--rate-limit-rate 0]
+
+The clients' rate limits are lifted (override with e.g. TRENGO_RATE_PER_MINUTE)
+so the numbers show the pipeline, not the documented API limits.
+"""
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BENCH_FILE = os.getenv('BENCH_FILE', os.path.join(ROOT, 'reports', 'benchmarks.jsonl'))
+SENDER = 'planning@example.com'
+SUBJECT = 'Benchmark'
+
+# pipeline module -> workbook schema
+PIPELINES = {
+    'PreWonenBevestiging': 'bevestiging',
+    'VestedaBevestiging': 'bevestiging',
+    'PreWonenHerinnering': 'herinnering',
+    'VestedaHerinnering': 'herinnering',
+    'PreWonenFeedback': 'feedback',
+    'VestedaFeedback': 'feedback',
+    'PreWonenFotoVerzoek': 'feedback',
+    'VestedaFotoVerzoek': 'feedback',
+    'AutomatischPlannen': 'autoplan',
+}
+DEFAULT_PIPELINES = ['PreWonenBevestiging', 'PreWonenHerinnering', 'PreWonenFeedback', 'AutomatischPlannen']
+
+TEMPLATE_IDS = [
+    'WHATSAPP_TEMPLATE_ID_PW_BEVESTIGING', 'WHATSAPP_TEMPLATE_ID_VES_BEVESTIGING',
+    'WHATSAPP_TEMPLATE_ID_PW_HERINNERING', 'WHATSAPP_TEMPLATE_ID_FB_PW', 'WHATSAPP_TEMPLATE_ID_FB_VES',
+    'WHATSAPP_TEMPLATE_ID_FV_PW', 'WHATSAPP_TEMPLATE_ID_FV_VES', 'WHATSAPP_TEMPLATE_ID_PLAN',
+]
+SUBJECT_LINES = [
+    'SUBJECT_LINE_PW_BEVESTIGING', 'SUBJECT_LINE_VES_BEVESTIGING', 'SUBJECT_LINE_PW_HERINNERING',
+    'SUBJECT_LINE_PW_FB', 'SUBJECT_LINE_VES_FB', 'SUBJECT_LINE_PW_FV', 'SUBJECT_LINE_VES_FV',
+    'SUBJECT_LINE_AUTO_PLAN',
+]
+
+FETCH_ATTEMPTS = 10
+
+# Every DUPLICATE_EVERY-th row repeats the one before, so drop_duplicates has work
+DUPLICATE_EVERY = 50
+
+def make_rows(schema, count):
+    visit = date.today() + timedelta(days=2)
+    rows = []
+    for i in range(count):
+        n = i - 1 if i and i % DUPLICATE_EVERY == 0 else i
+        common = {
+            'Naam bewoner': f"Bewoner {n}",
+            'Mobielnummer': f"06{n:08d}",
+            'DP Nummer': f"DP{n:06d}",
+        }
+        work = {
+            'Locatie': 'Keuken',
+            'Element': 'Kraan',
+            'Defect': 'Lekt',
+            'Werkbonnummer': f"WB{n:06d}",
+            'Binnen of buiten': 'Binnen',
+        }
+        if schema == 'bevestiging':
+            rows.append({**common, **work, 'Taaktype': 'Reparatie', 'Dag': 'maandag',
+                         'Datum bezoek': visit.isoformat(), 'Tijdvak': '08:00 - 12:00', 'Reparatieduur': 60})
+        elif schema == 'herinnering':
+            rows.append({**common, **work, 'Monteur': f"Monteur {n % 12}", 'Dagnaam': 'maandag',
+                         'Datum bezoek': visit.isoformat(), 'Tijdvak': '08:00 - 12:00', 'Reparatieduur': 60})
+        elif schema == 'feedback':
+            rows.append({**common, 'Taskid': f"{700000 + n}"})
+        elif schema == 'autoplan':
+            rows.append({**common, **work, 'Planregel': f"PR{n:06d}"})
+        else:
+            raise ValueError(f"Onbekend schema: {schema}")
+    return rows
+
+def make_workbook(schema, count):
+    import pandas as pd
+    buffer = io.BytesIO()
+    pd.DataFrame(make_rows(schema, count)).to_excel(buffer, index=False)
+    return buffer.getvalue()
+
+def percentile(values, q):
+    import metrics
+    return metrics.percentile(sorted(values), q)
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def case_env(base_url, tmp):
+    import fakeapi
+    env = dict(os.environ)
+    env.update(fakeapi.env(base_url))
+    env.update({
+        'AZURE_CLIENT_ID': 'bench', 'AZURE_CLIENT_SECRET': 'bench', 'AZURE_TENANT_ID': 'bench',
+        'OUTLOOK_EMAIL': 'bench@example.com', 'OUTLOOK_PASSWORD': 'bench', 'TRENGO_API_KEY': 'bench',
+        'SENDER_EMAIL': SENDER,
+        'OUTBOX_DB': os.path.join(tmp, 'outbox.sqlite'),
+        'LEDGER_DB': os.path.join(tmp, 'ledger.sqlite'),
+        'TICKET_INDEX_DB': os.path.join(tmp, 'ticket_index.sqlite'),
+        'RUNSTATS_FILE': os.path.join(tmp, 'runs.jsonl'),
+        'JOB_LOCK_DIR': os.path.join(tmp, 'locks'),
+        'DEADLINE_REPORT_FILE': os.path.join(tmp, 'expired.jsonl'),
+        'PYTHONPATH': ROOT,
+    })
+    env.update({name: SUBJECT for name in SUBJECT_LINES})
+    env.update({name: '1' for name in TEMPLATE_IDS})
+    for service in ('TRENGO', 'GRAPH', 'AIRTABLE'):
+        env.setdefault(f"{service}_RATE_PER_MINUTE", '1000000')
+        env.setdefault(f"{service}_BREAKER_RESET_SECONDS", '1')
+    env.setdefault('OUTBOX_BACKOFF_SECONDS', '0.05')
+    env.setdefault('OUTBOX_BACKOFF_MAX_SECONDS', '1')
+    env.setdefault('LOG_LEVEL', 'WARNING')
+    return env
+
+def run_case(fake, base_url, pipeline, rows):
+    """Mails a workbook to the stand-in and runs the pipeline in a subprocess until its outbox is empty."""
+    fake.reset()
+    fake.add_message(SENDER, SUBJECT, {f"{pipeline}.xlsx": make_workbook(PIPELINES[pipeline], rows)})
+    with tempfile.TemporaryDirectory() as tmp:
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', pipeline],
+            cwd=tmp, env=case_env(base_url, tmp), capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"{pipeline} {rows} rijen mislukt:\n{result.stderr[-2000:]}")
+        child = json.loads(result.stdout.strip().splitlines()[-1])
+
+    stats = fake.stats()
+    api_calls = sum(stats['calls'].values())
+    summary = child['summary']
+    return {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'pipeline': pipeline,
+        'rows': rows,
+        'latency_ms': fake.config['latency_ms'],
+        'error_rate': fake.config['error_rate'],
+        'rate_limit_rate': fake.config['rate_limit_rate'],
+        'wall_seconds': round(child['wall_seconds'], 3),
+        'rows_per_second': round(rows / child['wall_seconds'], 2),
+        'rows_sent': summary['rows_sent'],
+        'failures': summary['failures'],
+        'api_calls': api_calls,
+        'api_calls_per_row': round(api_calls / rows, 3),
+        'api_calls_by_endpoint': stats['calls'],
+        'injected': stats['injected'],
+        'p95_row_ms': round(percentile(child['row_seconds'], 95) * 1000, 1) if child['row_seconds'] else None,
+        'peak_rss_mib': summary['peak_rss_mib'],
+    }
+
+def child(pipeline):
+    """Runs in the case subprocess: one locked_job run that drains the outbox completely."""
+    import importlib
+    import jobs
+    import metrics
+    import outbox
+    import runstats
+
+    module = importlib.import_module(pipeline)
+    row_seconds = []
+    handler = outbox._handlers[module.PIPELINE_NAME]
+
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            row_seconds.append(time.perf_counter() - started)
+    outbox._handlers[module.PIPELINE_NAME] = timed
+
+    def work():
+        # A failed mail fetch is picked up by the next poll in production
+        for _ in range(FETCH_ATTEMPTS):
+            module.process_data()
+            if metrics.counters().get('rows_parsed'):
+                break
+        else:
+            raise RuntimeError(f"Werkboek niet opgehaald na {FETCH_ATTEMPTS} pogingen")
+        # Retried rows wait out their (shortened) backoff
+        while outbox.get_outbox().counts([module.PIPELINE_NAME]).get('pending'):
+            time.sleep(0.05)
+            outbox.drain([module.PIPELINE_NAME])
+
+    started = time.perf_counter()
+    jobs.locked_job(module.PIPELINE_NAME, work)()
+    wall_seconds = time.perf_counter() - started
+    summary = runstats.load(pipeline=module.PIPELINE_NAME)[-1]
+    print(json.dumps({'wall_seconds': wall_seconds, 'row_seconds': row_seconds, 'summary': summary}))
+
+def previous_results(path=BENCH_FILE):
+    results = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                r = json.loads(line)
+                results[(r['pipeline'], r['rows'], r['latency_ms'], r['error_rate'], r['rate_limit_rate'])] = r
+    except FileNotFoundError:
+        pass
+    return results
+
+def store(result, path=BENCH_FILE):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+
+def compare(result, before, threshold):
+    if before is None:
+        return 'nieuw'
+    change = (result['rows_per_second'] - before['rows_per_second']) / before['rows_per_second'] * 100
+    marker = '  REGRESSIE' if change < -threshold else ''
+    return f"{change:+.0f}% t.o.v. {before.get('commit') or '?'}{marker}"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--pipeline', nargs='+', choices=sorted(PIPELINES), default=DEFAULT_PIPELINES)
+    parser.add_argument('--latency-ms', type=float, default=5)
+    parser.add_argument('--jitter-ms', type=float, default=2)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0)
+    parser.add_argument('--threshold', type=float, default=20, help='procent minder rijen/s dat als regressie telt')
+    parser.add_argument('--no-store', action='store_true', help='resultaten niet opslaan')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        return
+
+    import fakeapi
+    fake = fakeapi.FakeApi(args.latency_ms, args.jitter_ms, args.error_rate, args.rate_limit_rate, seed=1)
+    base_url = fake.start()
+    previous = previous_results()
+    print(f"{'pipeline':<22}{'rijen':>7}{'rijen/s':>10}{'api/rij':>9}{'p95 rij':>10}{'RSS MiB':>9}  vergelijking")
+    try:
+        for pipeline in args.pipeline:
+            for rows in args.rows:
+                result = run_case(fake, base_url, pipeline, rows)
+                key = (pipeline, rows, result['latency_ms'], result['error_rate'], result['rate_limit_rate'])
+                p95 = f"{result['p95_row_ms']:.0f}ms" if result['p95_row_ms'] is not None else '-'
+                print(f"{pipeline:<22}{rows:>7}{result['rows_per_second']:>10.1f}{result['api_calls_per_row']:>9.2f}"
+                      f"{p95:>10}{result['peak_rss_mib']:>9.1f}  {compare(result, previous.get(key), args.threshold)}",
+                      flush=True)
+                if not args.no_store:
+                    store(result)
+    finally:
+        fake.stop()
+
+if __name__ == "__main__":
+    main()
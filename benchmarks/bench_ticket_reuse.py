@@ -0,0 +1,92 @@
+"""API calls per row for follow-up messages: new ticket + merge vs. ticket reuse.
+
+Runs test.py's row processing against the local Trengo stand-in (fakeapi.py),
+which rejects payloads the real API would reject, for werkbonnummers that
+already have one open ticket. The calls are counted by the stand-in.
+
+    python benchmarks/bench_ticket_reuse.py [rows]
+"""
+import os
+import sys
+import tempfile
+import importlib.util
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fakeapi
+
+def load_test_module():
+    spec = importlib.util.spec_from_file_location('trengo_test', os.path.join(ROOT, 'test.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def make_rows(count):
+    return [{
+        'Werkbonnummer': f"WB{i:06d}",
+        'Mobielnummer': f"0612{i:06d}",
+        'Naam bewoner': f"Bewoner {i}",
+        'Taaktype': 'Reparatie',
+        'Dag': 'maandag',
+        'Datum bezoek': '2024-05-06',
+        'Tijdvak': '08:00 - 12:00',
+        'Reparatieduur': '60',
+        'Locatie': 'Keuken',
+        'Element': 'Kraan',
+        'Defect': 'Lekt',
+        'Binnen of buiten': 'Binnen'
+    } for i in range(count)]
+
+def run(fake, module, rows, reuse_tickets):
+    """Seeds one open ticket per werkbon (with the same field values) and processes every row."""
+    import ticket_index
+    fake.reset()
+    with tempfile.TemporaryDirectory() as tmp:
+        index = ticket_index.TicketIndex(os.path.join(tmp, 'index.sqlite'))
+        for i, row in enumerate(rows):
+            ticket_id = 100000 + i
+            fake.tickets[ticket_id] = {
+                'id': ticket_id,
+                'status': 'OPEN',
+                'contact': {'id': ticket_id, 'phone': row['Mobielnummer']},
+                'custom_field_values': [],
+                'messages': 1,
+                'updated_at': '2024-05-01 08:00:00'
+            }
+            index.record_ticket(ticket_id, werkbon=row['Werkbonnummer'], phone=row['Mobielnummer'], status='OPEN')
+            index.record_custom_fields(ticket_id, {
+                module.CUSTOM_FIELDS['locatie']: row['Locatie'],
+                module.CUSTOM_FIELDS['element']: row['Element'],
+                module.CUSTOM_FIELDS['defect']: row['Defect'],
+                module.CUSTOM_FIELDS['werkbonnummer']: row['Werkbonnummer'],
+                module.CUSTOM_FIELDS['binnen_of_buiten']: row['Binnen of buiten']
+            })
+
+        fake.next_ticket_id = 100000 + len(rows)
+        for row in rows:
+            module.process_row(row, index, reuse_tickets=reuse_tickets)
+        return fake.stats()['calls']
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    fake = fakeapi.FakeApi(latency_ms=0, jitter_ms=0, error_rate=0, rate_limit_rate=0)
+    os.environ.update(fakeapi.env(fake.start()))
+    os.environ.setdefault('TRENGO_API_KEY', 'bench')
+    os.environ.setdefault('WHATSAPP_TEMPLATE_ID_TEST_BEVESTIGING', '1')
+    # Counting calls, not measuring the client-side rate limit
+    os.environ.setdefault('TRENGO_RATE_PER_MINUTE', '1000000')
+    module = load_test_module()
+    rows = make_rows(count)
+
+    try:
+        print(f"{'mode':<22}{'calls/row':>10}  per endpoint")
+        for label, reuse in (('new ticket + merge', False), ('ticket reuse', True)):
+            calls = run(fake, module, rows, reuse)
+            per_endpoint = ', '.join(f"{k}={v / count:g}" for k, v in sorted(calls.items()))
+            print(f"{label:<22}{sum(calls.values()) / count:>10g}  {per_endpoint}")
+    finally:
+        fake.stop()
+
+if __name__ == "__main__":
+    main()
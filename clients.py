@@ -0,0 +1,322 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+import requests
+import msal
+import logs
+import metrics
+import tracing
+
+log = logs.get_logger(__name__)
+
+# Shared HTTP clients and token caches, so every pipeline in one process
+# reuses the same connection pools and Graph token.
+
+# Base URL overrides, to run against a stand-in such as fakeapi.py instead of
+# the real services: production origin -> replacement, e.g.
+# TRENGO_BASE_URL=http://127.0.0.1:8900. Unset means the real service.
+BASE_URLS = {
+    'https://app.trengo.com': os.getenv('TRENGO_BASE_URL'),
+    'https://graph.microsoft.com': os.getenv('GRAPH_BASE_URL'),
+    'https://api.airtable.com': os.getenv('AIRTABLE_BASE_URL'),
+    'https://login.microsoftonline.com': os.getenv('AZURE_AUTHORITY_HOST'),
+}
+
+def rewrite_url(url):
+    """Points a production URL at its override from BASE_URLS, if one is set."""
+    for origin, base in BASE_URLS.items():
+        if base and (url == origin or url.startswith(origin + '/')):
+            return base.rstrip('/') + url[len(origin):]
+    return url
+
+class RewritingSession(requests.Session):
+    """requests.Session that sends production URLs to their BASE_URLS override."""
+
+    def request(self, method, url, *args, **kwargs):
+        return super().request(method, rewrite_url(url), *args, **kwargs)
+
+class RateLimiter:
+    """Token bucket: at most `rate` requests per `per` seconds, with bursts up to `rate`.
+
+    While a caller with a higher priority (clients.priority) is waiting for a
+    token, lower-priority callers wait behind it, so a reminder batch is not
+    starved by feedback sends sharing the same budget.
+    """
+
+    def __init__(self, rate, per=60.0):
+        self.capacity = float(rate)
+        self.fill_rate = float(rate) / per
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.throttled_seconds = 0.0
+        self._lock = threading.Lock()
+        self._turn = threading.Condition(self._lock)
+        # priority -> callers waiting for a token
+        self._waiting = {}
+
+    def acquire(self):
+        level = current_priority()
+        with self._turn:
+            self._waiting[level] = self._waiting.get(level, 0) + 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+                    self.updated = now
+                    ahead = any(n and other > level for other, n in self._waiting.items())
+                    if self.tokens >= 1 and not ahead:
+                        self.tokens -= 1
+                        return
+                    wait = max((1 - self.tokens) / self.fill_rate, 0) or 1 / self.fill_rate
+                    started = time.monotonic()
+                    self._turn.wait(wait)
+                    self.throttled_seconds += time.monotonic() - started
+            finally:
+                self._waiting[level] -= 1
+                # A lower-priority caller may be next in line now
+                self._turn.notify_all()
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Raised instead of calling a service whose circuit breaker is open."""
+
+    def __init__(self, service, retry_after):
+        super().__init__(f"{service} circuit open, nieuwe poging over {retry_after:.0f}s")
+        self.service = service
+        self.retry_after = retry_after
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """Raised when the deadline set with clients.deadline() has passed."""
+
+_context = threading.local()
+
+@contextmanager
+def deadline(at):
+    """Limits every ServiceClient call in this thread to finish before `at` (epoch seconds).
+
+    Nested deadlines keep the earliest; None means no deadline.
+    """
+    previous = getattr(_context, 'deadline', None)
+    if at is not None and previous is not None:
+        at = min(at, previous)
+    _context.deadline = at if at is not None else previous
+    try:
+        yield
+    finally:
+        _context.deadline = previous
+
+@contextmanager
+def priority(level):
+    """Gives the ServiceClient calls in this thread a rate limiter priority; higher goes first."""
+    previous = getattr(_context, 'priority', 0)
+    _context.priority = level
+    try:
+        yield
+    finally:
+        _context.priority = previous
+
+def current_priority():
+    return getattr(_context, 'priority', 0)
+
+def remaining_time():
+    """Seconds left until the current thread's deadline, or None without one."""
+    at = getattr(_context, 'deadline', None)
+    return None if at is None else at - time.time()
+
+def _cap_timeout(timeout):
+    """Shortens a request timeout to the time left; returns (timeout, capped)."""
+    remaining = remaining_time()
+    if remaining is None:
+        return timeout, False
+    if remaining <= 0:
+        raise DeadlineExceeded("Deadline verstreken voor verzoek")
+    if isinstance(timeout, tuple):
+        capped = tuple(min(t, remaining) for t in timeout)
+    else:
+        capped = min(timeout, remaining)
+    return capped, capped != timeout
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures and fails fast for `reset_timeout` seconds.
+
+    After that one probe call is let through (half-open): success closes the
+    circuit again, failure keeps it open for another `reset_timeout`.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=60.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == 'closed':
+                return
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0 or self._probing:
+                raise CircuitOpenError(self.name, max(remaining, 0.0))
+            self.state = 'half_open'
+            self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self._probing = False
+
+    def release_probe(self):
+        """Lets the next caller probe again when a call ended without telling us anything."""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.trips += 1
+                    log.warning(f"Circuit breaker {self.name} open na {self.failures} fouten op rij")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+class ServiceClient:
+    """Pooled, rate-limited HTTP client for one external service (Trengo, Graph, Airtable).
+
+    Every call gets a (connect, read) timeout unless the caller passes one, and
+    goes through the service's circuit breaker: connection errors, timeouts and
+    5xx responses count as failures.
+    """
+
+    def __init__(self, name, max_concurrency=4, rate_per_minute=600, connect_timeout=5, read_timeout=30):
+        self.name = name
+        prefix = name.upper()
+        self.max_concurrency = int(os.getenv(f"{prefix}_MAX_CONCURRENCY", max_concurrency))
+        self.limiter = RateLimiter(float(os.getenv(f"{prefix}_RATE_PER_MINUTE", rate_per_minute)))
+        self.timeout = (
+            float(os.getenv(f"{prefix}_CONNECT_TIMEOUT", connect_timeout)),
+            float(os.getenv(f"{prefix}_READ_TIMEOUT", read_timeout))
+        )
+        self.breaker = CircuitBreaker(
+            name,
+            failure_threshold=int(os.getenv(f"{prefix}_BREAKER_FAILURES", 5)),
+            reset_timeout=float(os.getenv(f"{prefix}_BREAKER_RESET_SECONDS", 60))
+        )
+        self.session = RewritingSession()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.max_concurrency,
+            pool_maxsize=self.max_concurrency
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+
+    def request(self, method, url, **kwargs):
+        endpoint = metrics.endpoint_class(self.name, method, url)
+        with tracing.span(f"{self.name} {endpoint}", kind=tracing.KIND_CLIENT, service=self.name,
+                          **{'http.method': method, 'endpoint': endpoint}) as span:
+            response = self._request(method, url, endpoint, span, **kwargs)
+            span.set(**{'http.status_code': response.status_code})
+            return response
+
+    def _request(self, method, url, endpoint, span, **kwargs):
+        timeout = kwargs.pop('timeout', self.timeout)
+        _cap_timeout(timeout)
+        self.breaker.before_call()
+        queued = time.perf_counter()
+        try:
+            self.limiter.acquire()
+            with self._slots:
+                kwargs['timeout'], capped = _cap_timeout(timeout)
+                started = time.perf_counter()
+                # Time spent in the rate limiter and waiting for a connection slot
+                span.set(wait_ms=round((started - queued) * 1000, 1))
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                except requests.exceptions.RequestException as e:
+                    metrics.record_call(self.name, endpoint, type(e).__name__, 0, time.perf_counter() - started)
+                    if isinstance(e, requests.exceptions.Timeout):
+                        # Cut short by our own deadline, not a sign the service is down
+                        if capped:
+                            self.breaker.release_probe()
+                            raise DeadlineExceeded(str(e)) from e
+                        self.breaker.record_failure()
+                    elif isinstance(e, requests.exceptions.ConnectionError):
+                        self.breaker.record_failure()
+                    raise
+                metrics.record_call(
+                    self.name, endpoint, response.status_code, len(response.content or b''),
+                    time.perf_counter() - started
+                )
+        except BaseException:
+            self.breaker.release_probe()
+            raise
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+
+# Defaults follow the documented API limits: Trengo 120 requests/minute,
+# Airtable 5 requests/second per base.
+trengo = ServiceClient('trengo', rate_per_minute=120)
+graph = ServiceClient('graph', rate_per_minute=600)
+airtable = ServiceClient('airtable', rate_per_minute=300)
+
+_graph_app = None
+_graph_lock = threading.Lock()
+
+def graph_app():
+    """Returns the process-wide MSAL app, so its token cache is shared."""
+    global _graph_app
+    with _graph_lock:
+        if _graph_app is None:
+            options = {}
+            if BASE_URLS['https://login.microsoftonline.com']:
+                # MSAL only accepts https authorities, so keep the real one
+                # and rewrite its requests instead
+                options = {'http_client': RewritingSession(), 'instance_discovery': False}
+            _graph_app = msal.ConfidentialClientApplication(
+                client_id=os.getenv('AZURE_CLIENT_ID'),
+                client_credential=os.getenv('AZURE_CLIENT_SECRET'),
+                authority=f"https://login.microsoftonline.com/{os.getenv('AZURE_TENANT_ID')}",
+                timeout=graph.timeout,
+                **options
+            )
+        return _graph_app
+
+def acquire_graph_token(username, password, scopes):
+    """Returns a cached Graph token when possible, otherwise logs in with username/password."""
+    app = graph_app()
+    with tracing.span('graph token') as span, _graph_lock:
+        accounts = app.get_accounts(username=username)
+        if accounts:
+            result = app.acquire_token_silent(scopes, account=accounts[0])
+            if result and "access_token" in result:
+                span.set(cached=True)
+                return result
+        span.set(cached=False)
+        return app.acquire_token_by_username_password(
+            username=username,
+            password=password,
+            scopes=scopes
+        )
@@ -0,0 +1,77 @@
+import logs
+import ticket_index
+
+log = logs.get_logger(__name__)
+
+# Rows for the same resident (normalized phone) and the same appointment are
+# collapsed into one message, so a resident with three defects gets one
+# WhatsApp and one ticket. Per-defect values (locatie, defect, werkbonnummer,
+# ...) are joined into one custom field value per ticket; durations
+# (reparatieduur) are added up, so the resident is told the total time.
+SEPARATOR = ', '
+
+def _clean(value):
+    if value is None or str(value) in ('', 'nan', 'NaT', 'None'):
+        return None
+    value = str(value).strip()
+    # Excel hands numeric IDs over as floats
+    if value.endswith('.0') and value[:-2].isdigit():
+        value = value[:-2]
+    return value
+
+def join_values(values):
+    """Joins the distinct non-empty values in their original order."""
+    joined = []
+    for value in values:
+        value = _clean(value)
+        if value and value not in joined:
+            joined.append(value)
+    return SEPARATOR.join(joined)
+
+def sum_values(values):
+    """Adds up numeric values (minutes); falls back to join_values when one is not a number."""
+    total = 0
+    for value in values:
+        cleaned = _clean(value)
+        if cleaned is None:
+            continue
+        try:
+            total += float(cleaned.replace(',', '.'))
+        except ValueError:
+            return join_values(values)
+    return str(int(total)) if float(total).is_integer() else str(total)
+
+def split_values(value):
+    """Inverse of join_values for a stored field value."""
+    return [v.strip() for v in str(value).split(',') if v.strip()]
+
+def group_by_resident(payloads, merge_fields, keep_separate=(), sum_fields=(), phone_field='mobielnummer'):
+    """Collapses payloads with the same normalized phone into one.
+
+    Payloads that differ in a `keep_separate` field (e.g. appointment date)
+    stay separate messages. In a merged payload the `merge_fields` hold the
+    joined values of all its rows and the `sum_fields` their total; every
+    other field comes from the first row.
+    """
+    groups = {}
+    for i, payload in enumerate(payloads):
+        phone = ticket_index.normalize_phone(payload.get(phone_field))
+        if phone:
+            key = (phone,) + tuple(str(payload.get(f)) for f in keep_separate)
+        else:
+            key = ('row', i)
+        groups.setdefault(key, []).append(payload)
+
+    merged = []
+    for rows in groups.values():
+        payload = dict(rows[0])
+        if len(rows) > 1:
+            for field in merge_fields:
+                payload[field] = join_values(row.get(field) for row in rows)
+            for field in sum_fields:
+                payload[field] = sum_values([row.get(field) for row in rows])
+        merged.append(payload)
+
+    if len(merged) < len(payloads):
+        log.info(f"{len(payloads)} rijen samengevoegd tot {len(merged)} berichten per bewoner")
+    return merged
@@ -0,0 +1,103 @@
+import os
+import re
+import json
+import time
+from datetime import datetime, date, time as dtime, timedelta
+from zoneinfo import ZoneInfo
+import logs
+import metrics
+
+log = logs.get_logger(__name__)
+
+# Deadlines for time-sensitive messages. A reminder is useless once the
+# appointment has started, so each row gets a deadline of appointment start
+# (Datum bezoek + Begintijd or the start of the Tijdvak) minus a margin.
+# A run additionally has a time budget; whatever is left over waits for
+# the next run instead of delaying the scheduler.
+DEADLINE_MARGIN_MINUTES = float(os.getenv('DEADLINE_MARGIN_MINUTES', 10))
+# Used when a row has a date but no usable time
+DEADLINE_DEFAULT_TIME = os.getenv('DEADLINE_DEFAULT_TIME', '07:00')
+RUN_BUDGET_SECONDS = float(os.getenv('RUN_BUDGET_SECONDS', 240))
+# Workbook and Airtable times are local Dutch times; the dynos run in UTC
+APPOINTMENT_TIMEZONE = ZoneInfo(os.getenv('APPOINTMENT_TIMEZONE', 'Europe/Amsterdam'))
+EXPIRED_REPORT_FILE = os.getenv('DEADLINE_REPORT_FILE', 'reports/expired.jsonl')
+
+_TIME_RE = re.compile(r'(\d{1,2})[:.](\d{2})')
+
+def parse_date(value):
+    if value is None or str(value) in ('', 'nan', 'NaT', 'None'):
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    text = str(value).strip()[:10]
+    for fmt in ('%Y-%m-%d', '%d-%m-%Y', '%d/%m/%Y'):
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+def parse_time(value):
+    """Reads '08:30', '8.30', '08:00:00' or the start of a tijdvak like '08:00 - 12:00'."""
+    if value is None:
+        return None
+    if isinstance(value, dtime):
+        return value
+    if isinstance(value, datetime):
+        return value.time()
+    match = _TIME_RE.search(str(value))
+    if not match:
+        return None
+    hour, minute = int(match.group(1)), int(match.group(2))
+    if hour > 23 or minute > 59:
+        return None
+    return dtime(hour, minute)
+
+def appointment_start(datum, tijd=None):
+    """Returns the appointment start as an aware datetime in APPOINTMENT_TIMEZONE, or None if the date is unreadable."""
+    day = parse_date(datum)
+    if day is None:
+        return None
+    start = parse_time(tijd) or parse_time(DEADLINE_DEFAULT_TIME)
+    return datetime.combine(day, start, tzinfo=APPOINTMENT_TIMEZONE)
+
+def row_deadline(datum, tijd=None, margin_minutes=DEADLINE_MARGIN_MINUTES):
+    """Epoch seconds by which the message for this row must be sent, or None if unknown."""
+    start = appointment_start(datum, tijd)
+    if start is None:
+        return None
+    return (start - timedelta(minutes=margin_minutes)).timestamp()
+
+def reminder_deadline(reminder):
+    return row_deadline(reminder.datum_bezoek, reminder.begintijd or reminder.tijdvak)
+
+def run_deadline(budget=RUN_BUDGET_SECONDS):
+    return time.time() + budget
+
+def earliest(*deadlines):
+    known = [d for d in deadlines if d is not None]
+    return min(known) if known else None
+
+def expired(deadline):
+    return deadline is not None and time.time() >= deadline
+
+def sort_key(deadline):
+    """Earliest deadline first; rows without a deadline go last."""
+    return deadline if deadline is not None else float('inf')
+
+def report_expired(pipeline, reference, naam, deadline):
+    """Logs a message that was skipped because its deadline had passed."""
+    deadline_text = datetime.fromtimestamp(deadline, APPOINTMENT_TIMEZONE).isoformat(timespec='minutes')
+    log.warning(f"[{pipeline}] Deadline {deadline_text} verstreken, bericht voor {naam} overgeslagen")
+    metrics.count_failure(pipeline, 'send', 'deadline_expired')
+    os.makedirs(os.path.dirname(EXPIRED_REPORT_FILE) or '.', exist_ok=True)
+    with open(EXPIRED_REPORT_FILE, 'a') as f:
+        f.write(json.dumps({
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'pipeline': pipeline,
+            'reference': reference,
+            'naam': naam,
+            'deadline': deadline_text
+        }, default=str) + '\n')
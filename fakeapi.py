@@ -0,0 +1,458 @@
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import base64
+import random
+import logging
+import argparse
+import threading
+from collections import Counter
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+import logs
+
+log = logs.get_logger(__name__)
+
+# Local stand-in for the parts of Trengo, Microsoft Graph (with its login
+# endpoints) and Airtable the pipelines use, so every pipeline can run end to
+# end offline and under load. Point the clients at it with the base URL
+# overrides of clients.py:
+#
+#   TRENGO_BASE_URL=http://127.0.0.1:8900 GRAPH_BASE_URL=http://127.0.0.1:8900 \
+#   AIRTABLE_BASE_URL=http://127.0.0.1:8900 AZURE_AUTHORITY_HOST=http://127.0.0.1:8900
+#
+# Every service call waits FAKE_LATENCY_MS (+- FAKE_LATENCY_JITTER_MS), fails
+# with a 503 with probability FAKE_ERROR_RATE and with a 429 + Retry-After
+# with probability FAKE_RATE_LIMIT_RATE. Mail and Airtable records are seeded
+# from the command line (--mail, --airtable), through the /_fake/ endpoints
+# or from Python (FakeApi.add_message, add_records); /_fake/stats counts the
+# calls per endpoint.
+FAKE_PORT = int(os.getenv('FAKE_PORT', 8900))
+FAKE_LATENCY_MS = float(os.getenv('FAKE_LATENCY_MS', 0))
+FAKE_LATENCY_JITTER_MS = float(os.getenv('FAKE_LATENCY_JITTER_MS', 0))
+FAKE_ERROR_RATE = float(os.getenv('FAKE_ERROR_RATE', 0))
+FAKE_RATE_LIMIT_RATE = float(os.getenv('FAKE_RATE_LIMIT_RATE', 0))
+FAKE_RETRY_AFTER = int(os.getenv('FAKE_RETRY_AFTER', 1))
+FAKE_SEED = os.getenv('FAKE_SEED')
+
+AIRTABLE_PAGE_SIZE = 100
+AIRTABLE_DELETE_LIMIT = 10
+
+_FILTER_TERM = re.compile(r"([\w/]+) eq ('(?:[^']|'')*'|true|false)")
+
+def _b64url(data):
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b'=').decode()
+
+def _filter_value(text):
+    if text in ('true', 'false'):
+        return text == 'true'
+    return text[1:-1].replace("''", "'")
+
+class FakeApi:
+    """In-memory Trengo, Graph and Airtable state behind one Flask app."""
+
+    def __init__(self, latency_ms=FAKE_LATENCY_MS, jitter_ms=FAKE_LATENCY_JITTER_MS,
+                 error_rate=FAKE_ERROR_RATE, rate_limit_rate=FAKE_RATE_LIMIT_RATE, seed=FAKE_SEED):
+        self.config = {
+            'latency_ms': latency_ms,
+            'jitter_ms': jitter_ms,
+            'error_rate': error_rate,
+            'rate_limit_rate': rate_limit_rate,
+            'retry_after': FAKE_RETRY_AFTER,
+        }
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.reset()
+        self.app = Flask(__name__)
+        self._routes()
+        self._server = None
+
+    def reset(self):
+        with self._lock:
+            self.calls = Counter()
+            self.injected = Counter()
+            self.tickets = {}
+            self.next_ticket_id = 100000
+            self.messages = []
+            self.tables = {}
+            self.next_record = 0
+
+    # --- seeding ---------------------------------------------------------
+
+    def add_message(self, sender, subject, attachments=None, is_read=False):
+        """Adds a mail; attachments maps file name -> bytes. Returns the message id."""
+        with self._lock:
+            message = {
+                'id': f"AAMk{uuid.uuid4().hex}",
+                'subject': subject,
+                'from': {'emailAddress': {'address': sender}},
+                'isRead': is_read,
+                'receivedDateTime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'attachments': [
+                    {
+                        '@odata.type': '#microsoft.graph.fileAttachment',
+                        'id': f"AAMkAtt{i}",
+                        'name': name,
+                        'size': len(content),
+                        'contentBytes': base64.b64encode(content).decode()
+                    }
+                    for i, (name, content) in enumerate((attachments or {}).items())
+                ]
+            }
+            message['hasAttachments'] = bool(message['attachments'])
+            self.messages.append(message)
+            return message['id']
+
+    def add_records(self, base, table, rows):
+        """Adds Airtable records for a list of field dicts; returns their ids."""
+        with self._lock:
+            records = self.tables.setdefault((base, table), [])
+            ids = []
+            for fields in rows:
+                self.next_record += 1
+                record = {
+                    'id': f"rec{self.next_record:014d}",
+                    'createdTime': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+                    'fields': dict(fields)
+                }
+                records.append(record)
+                ids.append(record['id'])
+            return ids
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': dict(self.calls),
+                'injected': dict(self.injected),
+                'tickets': len(self.tickets),
+                'unread_messages': sum(not m['isRead'] for m in self.messages),
+                'records': {f"{base}/{table}": len(records) for (base, table), records in self.tables.items()},
+            }
+
+    # --- fault injection -------------------------------------------------
+
+    def _inject(self, endpoint, faults=True):
+        """Counts the call, sleeps the configured latency and maybe returns an error response."""
+        with self._lock:
+            self.calls[endpoint] += 1
+            config = dict(self.config)
+            latency = config['latency_ms'] + self.random.uniform(-1, 1) * config['jitter_ms']
+            roll = self.random.random()
+        if latency > 0:
+            time.sleep(latency / 1000)
+        if not faults:
+            return None
+        if roll < config['rate_limit_rate']:
+            with self._lock:
+                self.injected[f"429 {endpoint}"] += 1
+            response = jsonify({'message': 'Too Many Attempts.'})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(config['retry_after'])
+            return response
+        if roll < config['rate_limit_rate'] + config['error_rate']:
+            with self._lock:
+                self.injected[f"503 {endpoint}"] += 1
+            response = jsonify({'message': 'Service Unavailable'})
+            response.status_code = 503
+            return response
+        return None
+
+    # --- routes ----------------------------------------------------------
+
+    def _routes(self):
+        app = self.app
+
+        def service(endpoint, faults=True):
+            def decorator(view):
+                def wrapped(*args, **kwargs):
+                    return self._inject(endpoint, faults) or view(*args, **kwargs)
+                wrapped.__name__ = view.__name__
+                return wrapped
+            return decorator
+
+        # Trengo
+
+        @app.post('/api/v2/wa_sessions')
+        @service('POST wa_sessions')
+        def wa_sessions():
+            payload = request.get_json(silent=True) or {}
+            if not payload.get('recipient_phone_number') or not payload.get('hsm_id'):
+                return jsonify({'message': 'The given data was invalid.'}), 422
+            with self._lock:
+                ticket_id = payload.get('ticket_id')
+                if not ticket_id or int(ticket_id) not in self.tickets:
+                    self.next_ticket_id += 1
+                    ticket_id = self.next_ticket_id
+                    self.tickets[ticket_id] = {
+                        'id': ticket_id,
+                        'status': 'OPEN',
+                        'contact': {'id': ticket_id, 'phone': payload['recipient_phone_number']},
+                        'custom_field_values': [],
+                        'messages': 0,
+                        'updated_at': time.strftime('%Y-%m-%d %H:%M:%S')
+                    }
+                ticket = self.tickets[int(ticket_id)]
+                ticket['messages'] += 1
+            return jsonify({'message': {'id': uuid.uuid4().int % 10 ** 9, 'ticket_id': ticket['id']}})
+
+        @app.get('/api/v2/tickets')
+        @service('GET tickets')
+        def tickets():
+            page = max(int(request.args.get('page', 1)), 1)
+            per_page = max(min(int(request.args.get('per_page', 25)), 100), 1)
+            with self._lock:
+                ordered = sorted(self.tickets.values(), key=lambda t: t['id'], reverse=True)
+            last_page = max((len(ordered) + per_page - 1) // per_page, 1)
+            data = ordered[(page - 1) * per_page:page * per_page]
+            next_url = (f"https://app.trengo.com/api/v2/tickets?page={page + 1}&per_page={per_page}"
+                        if page < last_page else None)
+            return jsonify({
+                'data': data,
+                'links': {'next': next_url},
+                'meta': {'current_page': page, 'last_page': last_page, 'per_page': per_page, 'total': len(ordered)}
+            })
+
+        @app.get('/api/v2/tickets/<int:ticket_id>')
+        @service('GET tickets')
+        def ticket(ticket_id):
+            with self._lock:
+                found = self.tickets.get(ticket_id)
+            if found is None:
+                return jsonify({'message': 'Not found'}), 404
+            return jsonify(found)
+
+        @app.post('/api/v2/tickets/<int:ticket_id>/custom_fields')
+        @service('POST custom_fields')
+        def custom_fields(ticket_id):
+            payload = request.get_json(silent=True) or {}
+            with self._lock:
+                found = self.tickets.get(ticket_id)
+                if found is None:
+                    return jsonify({'message': 'Not found'}), 404
+                values = [f for f in found['custom_field_values']
+                          if str(f['custom_field_id']) != str(payload.get('custom_field_id'))]
+                values.append({'custom_field_id': payload.get('custom_field_id'), 'value': payload.get('value')})
+                found['custom_field_values'] = values
+            return jsonify({'custom_field_id': payload.get('custom_field_id'), 'value': payload.get('value')})
+
+        @app.post('/api/v2/tickets/<int:ticket_id>/merge')
+        @service('POST merge')
+        def merge(ticket_id):
+            payload = request.get_json(silent=True) or {}
+            with self._lock:
+                if ticket_id not in self.tickets:
+                    return jsonify({'message': 'Not found'}), 404
+                for merged in payload.get('ticket_ids', []):
+                    if int(merged) in self.tickets and int(merged) != ticket_id:
+                        self.tickets[int(merged)]['status'] = 'MERGED'
+            return jsonify({'message': 'ok'})
+
+        # Microsoft identity platform (what MSAL needs for username/password)
+
+        @app.get('/<tenant>/v2.0/.well-known/openid-configuration')
+        @service('GET openid-configuration', faults=False)
+        def openid_configuration(tenant):
+            # Real-looking URLs: clients.RewritingSession sends them back here
+            authority = f"https://login.microsoftonline.com/{tenant}"
+            return jsonify({
+                'issuer': f"{authority}/v2.0",
+                'authorization_endpoint': f"{authority}/oauth2/v2.0/authorize",
+                'token_endpoint': f"{authority}/oauth2/v2.0/token",
+                'device_authorization_endpoint': f"{authority}/oauth2/v2.0/devicecode",
+            })
+
+        @app.get('/common/userrealm/<path:username>')
+        @service('GET userrealm', faults=False)
+        def userrealm(username):
+            return jsonify({'ver': '1.0', 'account_type': 'Managed', 'domain_name': username.split('@')[-1]})
+
+        @app.post('/<tenant>/oauth2/v2.0/token')
+        @service('POST token')
+        def token(tenant):
+            username = request.form.get('username', 'fake@example.com')
+            now = int(time.time())
+            claims = {
+                'aud': request.form.get('client_id', ''), 'iss': f"https://login.microsoftonline.com/{tenant}/v2.0",
+                'iat': now, 'nbf': now, 'exp': now + 3600, 'oid': 'fake-user', 'tid': tenant,
+                'preferred_username': username, 'sub': 'fake-user'
+            }
+            return jsonify({
+                'token_type': 'Bearer',
+                'scope': request.form.get('scope', ''),
+                'expires_in': 3600,
+                'access_token': f"fake-{uuid.uuid4().hex}",
+                'refresh_token': f"fake-refresh-{uuid.uuid4().hex}",
+                'id_token': f"{_b64url({'alg': 'none', 'typ': 'JWT'})}.{_b64url(claims)}.",
+                'client_info': _b64url({'uid': 'fake-user', 'utid': tenant}),
+            })
+
+        # Microsoft Graph
+
+        @app.get('/v1.0/me')
+        @service('GET me')
+        def me():
+            return jsonify({'id': 'fake-user', 'mail': os.getenv('OUTLOOK_EMAIL', 'fake@example.com')})
+
+        @app.get('/v1.0/me/messages')
+        @service('GET messages')
+        def messages():
+            terms = [(field, _filter_value(value))
+                     for field, value in _FILTER_TERM.findall(request.args.get('$filter', ''))]
+            with self._lock:
+                found = [m for m in self.messages if all(self._field(m, f) == v for f, v in terms)]
+            top = int(request.args.get('$top', 10))
+            select = [s for s in request.args.get('$select', '').split(',') if s]
+            value = [{k: v for k, v in m.items() if k != 'attachments' and (not select or k in select or k == 'id')}
+                     for m in found[:top]]
+            return jsonify({'value': value})
+
+        @app.get('/v1.0/me/messages/<message_id>/attachments')
+        @service('GET attachments')
+        def attachments(message_id):
+            message = self._message(message_id)
+            if message is None:
+                return jsonify({'error': {'code': 'ErrorItemNotFound'}}), 404
+            return jsonify({'value': message['attachments']})
+
+        @app.patch('/v1.0/me/messages/<message_id>')
+        @service('PATCH messages')
+        def update_message(message_id):
+            message = self._message(message_id)
+            if message is None:
+                return jsonify({'error': {'code': 'ErrorItemNotFound'}}), 404
+            payload = request.get_json(silent=True) or {}
+            with self._lock:
+                if 'isRead' in payload:
+                    message['isRead'] = bool(payload['isRead'])
+            return jsonify({k: v for k, v in message.items() if k != 'attachments'})
+
+        # Airtable
+
+        @app.get('/v0/<base>/<table>')
+        @service('GET records')
+        def list_records(base, table):
+            page_size = max(min(int(request.args.get('pageSize', AIRTABLE_PAGE_SIZE)), AIRTABLE_PAGE_SIZE), 1)
+            start = int(request.args.get('offset', 0) or 0)
+            with self._lock:
+                records = list(self.tables.get((base, table), []))
+            page = records[start:start + page_size]
+            body = {'records': page}
+            if start + page_size < len(records):
+                body['offset'] = str(start + page_size)
+            return jsonify(body)
+
+        @app.delete('/v0/<base>/<table>')
+        @service('DELETE records')
+        def delete_records(base, table):
+            ids = request.args.getlist('records[]')
+            if not ids or len(ids) > AIRTABLE_DELETE_LIMIT:
+                return jsonify({'error': {'type': 'INVALID_REQUEST_UNKNOWN'}}), 422
+            with self._lock:
+                records = self.tables.get((base, table), [])
+                self.tables[(base, table)] = [r for r in records if r['id'] not in ids]
+            return jsonify({'records': [{'id': rid, 'deleted': True} for rid in ids]})
+
+        # Control endpoints, without latency or faults
+
+        @app.get('/_fake/stats')
+        def fake_stats():
+            return jsonify(self.stats())
+
+        @app.post('/_fake/config')
+        def fake_config():
+            payload = request.get_json(silent=True) or {}
+            with self._lock:
+                for key in self.config:
+                    if key in payload:
+                        self.config[key] = type(self.config[key])(payload[key])
+                config = dict(self.config)
+            return jsonify(config)
+
+        @app.post('/_fake/messages')
+        def fake_messages():
+            payload = request.get_json(silent=True) or {}
+            attachments = {name: base64.b64decode(content) for name, content in payload.get('attachments', {}).items()}
+            return jsonify({'id': self.add_message(payload['from'], payload['subject'], attachments)})
+
+        @app.post('/_fake/airtable/<base>/<table>')
+        def fake_records(base, table):
+            payload = request.get_json(silent=True) or {}
+            return jsonify({'ids': self.add_records(base, table, payload.get('records', []))})
+
+        @app.get('/_fake/tickets')
+        def fake_tickets():
+            with self._lock:
+                return jsonify(list(self.tickets.values()))
+
+    def _message(self, message_id):
+        with self._lock:
+            return next((m for m in self.messages if m['id'] == message_id), None)
+
+    @staticmethod
+    def _field(message, path):
+        value = message
+        for part in path.split('/'):
+            value = value.get(part) if isinstance(value, dict) else None
+        return value
+
+    # --- serving ---------------------------------------------------------
+
+    def start(self, host='127.0.0.1', port=0):
+        """Serves the app in a daemon thread (port 0 picks a free one); returns the base URL."""
+        # One access log line per call drowns out the pipeline's own logs
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        self._server = make_server(host, port, self.app, threaded=True)
+        threading.Thread(target=self._server.serve_forever, name='fakeapi', daemon=True).start()
+        return f"http://{host}:{self._server.server_port}"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+def env(base_url):
+    """The clients.py base URL overrides that send every service to base_url."""
+    return {
+        'TRENGO_BASE_URL': base_url,
+        'GRAPH_BASE_URL': base_url,
+        'AIRTABLE_BASE_URL': base_url,
+        'AZURE_AUTHORITY_HOST': base_url,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Lokale nep-API voor Trengo, Graph en Airtable')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=FAKE_PORT)
+    parser.add_argument('--latency-ms', type=float, default=FAKE_LATENCY_MS)
+    parser.add_argument('--jitter-ms', type=float, default=FAKE_LATENCY_JITTER_MS)
+    parser.add_argument('--error-rate', type=float, default=FAKE_ERROR_RATE, help='kans op een 503 per verzoek')
+    parser.add_argument('--rate-limit-rate', type=float, default=FAKE_RATE_LIMIT_RATE, help='kans op een 429 per verzoek')
+    parser.add_argument('--sender', default=os.getenv('SENDER_EMAIL', 'planning@example.com'))
+    parser.add_argument('--mail', action='append', default=[], metavar='ONDERWERP=BESTAND.xlsx',
+                        help='ongelezen mail met het bestand als bijlage')
+    parser.add_argument('--airtable', action='append', default=[], metavar='BASE/TABEL=RECORDS.json',
+                        help='records (lijst van fields) in een Airtable tabel')
+    args = parser.parse_args(argv)
+
+    fake = FakeApi(args.latency_ms, args.jitter_ms, args.error_rate, args.rate_limit_rate)
+    for item in args.mail:
+        subject, path = item.split('=', 1)
+        with open(path, 'rb') as f:
+            fake.add_message(args.sender, subject, {os.path.basename(path): f.read()})
+    for item in args.airtable:
+        target, path = item.split('=', 1)
+        base, table = target.split('/', 1)
+        with open(path) as f:
+            fake.add_records(base, table, json.load(f))
+
+    base_url = f"http://{args.host}:{args.port}"
+    log.info("Nep-API op " + base_url + ", zet:\n"
+             + '\n'.join(f"  export {key}={value}" for key, value in env(base_url).items()))
+    fake.app.run(host=args.host, port=args.port, threaded=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,21 @@
+import os
+
+# gunicorn reads this file from the working directory. One worker process,
+# because the pipeline scheduler and its metrics live inside it (web.py).
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = 1
+threads = int(os.getenv('WEB_THREADS', 4))
+# Heroku sends SIGKILL 30 seconds after SIGTERM. Read from the environment
+# like shutdown.py does: importing application modules here would start
+# their threads in the master, before the fork.
+graceful_timeout = int(float(os.getenv('SHUTDOWN_GRACE_SECONDS', 25))) + 3
+
+def post_worker_init(worker):
+    import sampler
+    import web
+    sampler.install()
+    web.start_scheduler()
+
+def worker_exit(server, worker):
+    import web
+    web.stop_scheduler()
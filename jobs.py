@@ -0,0 +1,136 @@
+import os
+import time
+import fcntl
+import uuid
+import threading
+from datetime import datetime
+import logs
+import memprofile
+import metrics
+import profiling
+import runstats
+import tracing
+
+log = logs.get_logger(__name__)
+
+LOCK_DIR = os.getenv('JOB_LOCK_DIR', 'locks')
+
+# Missed runs are collapsed into one, and a run that starts more than
+# JOB_MISFIRE_GRACE_TIME seconds late is dropped instead of piling up.
+JOB_DEFAULTS = {
+    'coalesce': os.getenv('JOB_COALESCE', '1').lower() not in {'0', 'false', 'no', 'off'},
+    'max_instances': 1,
+    'misfire_grace_time': int(os.getenv('JOB_MISFIRE_GRACE_TIME', 300))
+}
+
+# Per-job timing record: name -> dict with runs, skipped, last_start,
+# last_duration and max_duration (seconds), and last_success: when the
+# last run that did not raise ended.
+job_timings = {}
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+# Jobs currently running in this process (name -> number of runs)
+_running = {}
+_running_lock = threading.Lock()
+
+def running_jobs():
+    with _running_lock:
+        return [name for name, count in _running.items() if count]
+
+class JobLock:
+    """Non-blocking run lock, held both in-process and via a file lock across processes."""
+
+    def __init__(self, name):
+        self.name = name
+        self.path = os.path.join(LOCK_DIR, f"{name}.lock")
+        self._thread_lock = threading.Lock()
+        self._file = None
+
+    def acquire(self):
+        if not self._thread_lock.acquire(blocking=False):
+            return False
+        try:
+            os.makedirs(LOCK_DIR, exist_ok=True)
+            self._file = open(self.path, 'a')
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self._file.truncate(0)
+            self._file.write(f"{os.getpid()}\n")
+            self._file.flush()
+            return True
+        except OSError:
+            if self._file:
+                self._file.close()
+                self._file = None
+            self._thread_lock.release()
+            return False
+
+    def release(self):
+        if self._file:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._thread_lock.release()
+
+def bind(func):
+    """Wraps func so work it does in another thread counts toward the caller's run (metrics, logs, trace, profile)."""
+    return logs.bind(metrics.bind(tracing.bind(profiling.bind(func))))
+
+def get_lock(name):
+    with _locks_guard:
+        if name not in _locks:
+            _locks[name] = JobLock(name)
+        return _locks[name]
+
+def locked_job(name, func):
+    """Wraps func so overlapping runs of the same job are skipped and every run is timed.
+
+    Everything the run logs carries the pipeline name and a run id, the run
+    is traced as one trace (profiled and memory-reported when those are on),
+    at the end of each run the latency of its API calls is logged per
+    endpoint, and a summary of the run is appended to the run history
+    (runstats).
+    """
+    def run(*args, **kwargs):
+        timing = job_timings.setdefault(name, {
+            'runs': 0, 'skipped': 0, 'last_start': None, 'last_duration': None, 'max_duration': 0.0,
+            'last_success': None
+        })
+        lock = get_lock(name)
+        if not lock.acquire():
+            timing['skipped'] += 1
+            log.warning(f"Job {name} draait nog, deze run wordt overgeslagen", extra={'pipeline': name})
+            return None
+
+        timing['last_start'] = datetime.now()
+        start = time.monotonic()
+        with _running_lock:
+            _running[name] = _running.get(name, 0) + 1
+        try:
+            run_id = uuid.uuid4().hex[:12]
+            with logs.context(pipeline=name, run_id=run_id), metrics.run_scope() as calls, \
+                    tracing.span(f"run {name}", root=True, pipeline=name), profiling.run(name), \
+                    memprofile.run(name):
+                ok = False
+                try:
+                    result = func(*args, **kwargs)
+                    timing['last_success'] = datetime.now()
+                    ok = True
+                    return result
+                finally:
+                    duration = time.monotonic() - start
+                    metrics.log_summary(calls, name)
+                    runstats.record(name, run_id, calls, duration, ok)
+                    log.info(f"Job {name} klaar in {duration:.1f}s", extra={'duration_ms': round(duration * 1000)})
+        finally:
+            with _running_lock:
+                _running[name] -= 1
+            duration = time.monotonic() - start
+            timing['runs'] += 1
+            timing['last_duration'] = duration
+            timing['max_duration'] = max(timing['max_duration'], duration)
+            lock.release()
+
+    run.__name__ = getattr(func, '__name__', name)
+    return run
@@ -0,0 +1,184 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+import logs
+import metrics
+import ticket_index
+
+log = logs.get_logger(__name__)
+
+# Send ledger: remembers which template went to which phone for which
+# werkbon/DP/planregel and appointment date, so re-running a pipeline on a
+# workbook that was (partly) processed before skips the rows already sent.
+# Entries expire after LEDGER_TTL_DAYS. A message whose custom fields were
+# not all written yet (process stopped or a call failed) is kept as not
+# completed, so the next attempt finishes the fields on the same ticket
+# instead of sending the message again. A message for a coalesced resident
+# (coalesce.py) covers several werkbons and gets one entry per werkbon
+# (message_keys), so reordered rows do not change its keys and a later
+# workbook only messages the resident again for a werkbon not sent before.
+# Must outlive the process to be of use after a restart; a Heroku dyno's
+# filesystem does not (see shutdown.check_state_storage).
+LEDGER_DB = os.getenv('LEDGER_DB', 'data/ledger.sqlite')
+LEDGER_TTL_DAYS = float(os.getenv('LEDGER_TTL_DAYS', 30))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sent_messages (
+    pipeline TEXT NOT NULL,
+    template_id TEXT NOT NULL,
+    phone TEXT NOT NULL,
+    reference TEXT NOT NULL,
+    appointment_date TEXT NOT NULL,
+    ticket_id INTEGER,
+    sent_at TEXT NOT NULL,
+    completed INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (pipeline, template_id, phone, reference, appointment_date)
+);
+"""
+
+def _date_key(value):
+    if value is None or str(value) in ('', 'nan', 'NaT', 'None'):
+        return ''
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d')
+    return str(value).strip()
+
+def _reference_key(value):
+    if value is None or str(value) in ('nan', 'None'):
+        return ''
+    value = str(value).strip()
+    # Excel hands numeric IDs over as floats
+    if value.endswith('.0') and value[:-2].isdigit():
+        value = value[:-2]
+    return value
+
+def message_key(pipeline, template_id, phone, reference, appointment_date=None):
+    """Builds the ledger key; phone is normalized so 06..., +316... and 316... are one resident."""
+    return (
+        pipeline,
+        str(template_id or ''),
+        ticket_index.normalize_phone(phone) or '',
+        _reference_key(reference),
+        _date_key(appointment_date)
+    )
+
+def message_keys(pipeline, template_id, phone, references, appointment_date=None):
+    """One key per werkbon of a coalesced reference like "WB2, WB1", in sorted order."""
+    refs = sorted({_reference_key(ref) for ref in str(references).split(',')} - {''})
+    return [message_key(pipeline, template_id, phone, ref, appointment_date) for ref in refs or ['']]
+
+def _as_keys(key):
+    return key if isinstance(key, list) else [key]
+
+class SendLedger:
+    def __init__(self, path=LEDGER_DB, ttl_days=LEDGER_TTL_DAYS):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.ttl = timedelta(days=ttl_days)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.executescript(SCHEMA)
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(sent_messages)")]
+            if 'completed' not in columns:
+                self._conn.execute("ALTER TABLE sent_messages ADD COLUMN completed INTEGER NOT NULL DEFAULT 1")
+
+    def lookup(self, key):
+        """Returns (ticket_id, completed) for a message sent within the TTL, or None."""
+        cutoff = (datetime.now() - self.ttl).isoformat(timespec='seconds')
+        with self._lock:
+            row = self._conn.execute(
+                """SELECT ticket_id, completed FROM sent_messages
+                   WHERE pipeline = ? AND template_id = ? AND phone = ? AND reference = ?
+                   AND appointment_date = ? AND sent_at >= ?""",
+                (*key, cutoff)
+            ).fetchone()
+        return None if row is None else (row[0], bool(row[1]))
+
+    def is_sent(self, key):
+        """True when there is nothing left to do; an unfinished message without ticket counts as done."""
+        entry = self.lookup(key)
+        return entry is not None and (entry[1] or entry[0] is None)
+
+    def unfinished_ticket(self, key):
+        """Returns the ticket of a sent message whose custom fields are not complete, or None."""
+        entry = self.lookup(key)
+        if entry is None or entry[1]:
+            return None
+        return entry[0]
+
+    def record(self, key, ticket_id=None, completed=True):
+        with self._lock, self._conn:
+            self._conn.execute(
+                """INSERT OR REPLACE INTO sent_messages
+                   (pipeline, template_id, phone, reference, appointment_date, ticket_id, sent_at, completed)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (*key, ticket_id, datetime.now().isoformat(timespec='seconds'), int(completed))
+            )
+
+    def mark_completed(self, key):
+        with self._lock, self._conn:
+            self._conn.execute(
+                """UPDATE sent_messages SET completed = 1
+                   WHERE pipeline = ? AND template_id = ? AND phone = ? AND reference = ? AND appointment_date = ?""",
+                key
+            )
+
+    def purge(self):
+        """Drops expired entries; returns how many were removed."""
+        cutoff = (datetime.now() - self.ttl).isoformat(timespec='seconds')
+        with self._lock, self._conn:
+            cur = self._conn.execute("DELETE FROM sent_messages WHERE sent_at < ?", (cutoff,))
+        return cur.rowcount
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+def get_ledger():
+    """Returns the process-wide ledger; expired entries are purged on first use."""
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = SendLedger()
+            _ledger.purge()
+        return _ledger
+
+def already_sent(key):
+    """True if this message (every key of a list) was delivered within the TTL. A broken ledger never blocks a send."""
+    try:
+        return all(get_ledger().is_sent(k) for k in _as_keys(key))
+    except Exception as e:
+        log.warning(f"Waarschuwing: ledger niet leesbaar: {str(e)}")
+        return False
+
+def unfinished_ticket(key):
+    """The ticket to finish instead of sending again, or None.
+
+    For a list of keys only when every key is unfinished on the same ticket:
+    a message that also covers a werkbon the interrupted one did not is sent
+    anew, or that werkbon would never be messaged.
+    """
+    try:
+        tickets = {get_ledger().unfinished_ticket(k) for k in _as_keys(key)}
+        return tickets.pop() if len(tickets) == 1 else None
+    except Exception as e:
+        log.warning(f"Waarschuwing: ledger niet leesbaar: {str(e)}")
+        return None
+
+def record_sent(key, ticket_id=None, completed=True):
+    """Marks a message as delivered; never fails the send."""
+    keys = _as_keys(key)
+    metrics.count('messages_sent', keys[0][0])
+    try:
+        for k in keys:
+            get_ledger().record(k, ticket_id, completed)
+    except Exception as e:
+        log.warning(f"Waarschuwing: bericht niet in ledger opgeslagen: {str(e)}")
+
+def record_completed(key):
+    """Marks the custom fields of a delivered message as written."""
+    try:
+        for k in _as_keys(key):
+            get_ledger().mark_completed(k)
+    except Exception as e:
+        log.warning(f"Waarschuwing: ledger niet bijgewerkt: {str(e)}")
@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+import time
+import atexit
+import queue
+import logging
+import threading
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+import tracing
+
+# Logging for all pipelines. Records go onto an in-memory queue and a
+# single listener thread writes them to stdout, so a sender never waits on
+# a stdout write. Each record is a JSON line carrying the context of the
+# thread that logged it: pipeline, run_id, row, stage and duration_ms.
+#
+# Per-row logs in large batches are sampled: when a batch has more than
+# LOG_SAMPLE_MIN_BATCH rows, only rows whose key hashes into 1 of every
+# LOG_SAMPLE_EVERY buckets keep their logs at LOG_SAMPLE_LEVEL and below
+# (so all logs of a sampled row stay together). Warnings and errors are
+# never sampled.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+LOG_SAMPLE_MIN_BATCH = int(os.getenv('LOG_SAMPLE_MIN_BATCH', 50))
+LOG_SAMPLE_EVERY = int(os.getenv('LOG_SAMPLE_EVERY', 20))
+LOG_SAMPLE_LEVEL = logging.getLevelName(os.getenv('LOG_SAMPLE_LEVEL', 'INFO').upper())
+
+CONTEXT_FIELDS = ('pipeline', 'run_id', 'row', 'stage', 'duration_ms', 'batch_size')
+
+_context = threading.local()
+_listener = None
+_listener_pid = None
+_setup_lock = threading.Lock()
+
+def current_context():
+    return dict(getattr(_context, 'fields', {}))
+
+@contextmanager
+def context(**fields):
+    """Adds fields to every record logged by this thread inside the block."""
+    previous = getattr(_context, 'fields', {})
+    _context.fields = {**previous, **{k: v for k, v in fields.items() if v is not None}}
+    try:
+        yield
+    finally:
+        _context.fields = previous
+
+def bind(func):
+    """Wraps func so it logs with the caller's context when run in another thread."""
+    fields = current_context()
+
+    def bound(*args, **kwargs):
+        with context(**fields):
+            return func(*args, **kwargs)
+    return bound
+
+def row(key, batch_size=None):
+    """`extra` for a per-row record, e.g. log.debug(..., extra=logs.row(index, len(df)))."""
+    return {'row': key, 'batch_size': batch_size}
+
+@contextmanager
+def stage(name, log=None):
+    """Tags records with the stage, traces it as a span and logs its duration when the block ends."""
+    started = time.perf_counter()
+    with context(stage=name), tracing.span(name, stage=name):
+        try:
+            yield
+        finally:
+            duration_ms = round((time.perf_counter() - started) * 1000, 1)
+            (log or logging.getLogger(__name__)).info(
+                f"Stage {name} klaar", extra={'duration_ms': duration_ms}
+            )
+
+class ContextFilter(logging.Filter):
+    """Copies the thread's context onto the record (before it leaves the thread) and samples rows."""
+
+    def filter(self, record):
+        for key, value in current_context().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return keep(record)
+
+def keep(record):
+    row_key = getattr(record, 'row', None)
+    batch_size = getattr(record, 'batch_size', None)
+    if row_key is None or record.levelno > LOG_SAMPLE_LEVEL or LOG_SAMPLE_EVERY <= 1:
+        return True
+    if batch_size is None or batch_size <= LOG_SAMPLE_MIN_BATCH:
+        return True
+    return zlib.crc32(str(row_key).encode()) % LOG_SAMPLE_EVERY == 0
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key in CONTEXT_FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class TextFormatter(logging.Formatter):
+    """Plain lines for running a script by hand (LOG_FORMAT=text)."""
+
+    def format(self, record):
+        prefix = ' '.join(
+            f"{key}={getattr(record, key)}" for key in ('pipeline', 'row', 'stage', 'duration_ms')
+            if getattr(record, key, None) is not None
+        )
+        message = super().format(record)
+        return f"[{prefix}] {message}" if prefix else message
+
+def setup():
+    """Routes the root logger through the queue; safe to call more than once.
+
+    The listener thread does not survive a fork (the gunicorn master imports
+    this module before forking its worker), so a child process that finds
+    one started by its parent sets up its own queue and listener.
+    """
+    global _listener, _listener_pid
+    with _setup_lock:
+        if _listener is not None and _listener_pid == os.getpid():
+            return
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(TextFormatter('%(asctime)s %(levelname)s %(message)s') if LOG_FORMAT == 'text' else JsonFormatter())
+
+        log_queue = queue.SimpleQueue()
+        handler = QueueHandler(log_queue)
+        handler.addFilter(ContextFilter())
+
+        root = logging.getLogger()
+        root.handlers = [handler]
+        root.setLevel(LOG_LEVEL)
+        # urllib3 logs every connection at DEBUG
+        logging.getLogger('urllib3').setLevel(max(logging.INFO, root.level))
+
+        _listener = QueueListener(log_queue, output, respect_handler_level=True)
+        _listener.start()
+        if _listener_pid is None:
+            atexit.register(flush)
+        _listener_pid = os.getpid()
+
+def flush():
+    """Writes out everything still queued; runs at exit."""
+    global _listener
+    with _setup_lock:
+        listener, _listener = _listener, None
+    if listener is not None and _listener_pid == os.getpid():
+        listener.stop()
+
+def _after_fork():
+    global _setup_lock
+    # Another thread may have held the lock at the fork
+    _setup_lock = threading.Lock()
+    if _listener is not None:
+        setup()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def get_logger(name):
+    setup()
+    return logging.getLogger(name)
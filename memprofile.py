@@ -0,0 +1,140 @@
+import os
+import sys
+import json
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+import logs
+
+log = logs.get_logger(__name__)
+
+# tracemalloc report of where a run's memory goes. With MEMORY_REPORT=1 (or
+# --memory-report on the command line) each run (jobs.locked_job) starts
+# tracing, and the checkpoints in the pipelines (attachment JSON, base64 decode, read_excel, drop_duplicates,
+# row loop, ...) record per stage: the memory still held, the peak reached
+# during the stage and the top allocation sites that grew. The report is
+# logged at the end of the run and appended to MEMORY_REPORT_FILE, so a
+# benchmark can compare peaks between versions. tracemalloc is process-wide:
+# in the worker, runs overlapping the reported one are counted too.
+MEMORY_REPORT = os.getenv('MEMORY_REPORT', '0').lower() not in {'0', 'false', 'no', 'off'} or '--memory-report' in sys.argv
+MEMORY_REPORT_TOP = int(os.getenv('MEMORY_REPORT_TOP', 5))
+MEMORY_REPORT_FRAMES = int(os.getenv('MEMORY_REPORT_FRAMES', 1))
+MEMORY_REPORT_FILE = os.getenv('MEMORY_REPORT_FILE', 'reports/memory.jsonl')
+
+_IGNORE = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+_current = threading.local()
+# Reports in progress in this process; tracemalloc runs while there is one
+_active = 0
+_active_lock = threading.Lock()
+
+def _mib(size):
+    return round(size / (1024 * 1024), 2)
+
+class MemoryReport:
+    def __init__(self, name, top=MEMORY_REPORT_TOP):
+        self.name = name
+        self.top = top
+        self.stages = []
+        self._snapshot = self._take()
+        self._baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+
+    def _take(self):
+        return tracemalloc.take_snapshot().filter_traces(_IGNORE)
+
+    def checkpoint(self, stage):
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = self._take()
+        grown = [s for s in snapshot.compare_to(self._snapshot, 'lineno') if s.size_diff > 0][:self.top]
+        self.stages.append({
+            'stage': stage,
+            'current_mib': _mib(current - self._baseline),
+            'peak_mib': _mib(peak - self._baseline),
+            'top': [
+                {'site': str(s.traceback), 'size_diff_kib': round(s.size_diff / 1024, 1), 'count_diff': s.count_diff}
+                for s in grown
+            ]
+        })
+        self._snapshot = snapshot
+        # The next stage's peak starts from here
+        tracemalloc.reset_peak()
+
+    @property
+    def peak_mib(self):
+        return max((s['peak_mib'] for s in self.stages), default=0.0)
+
+    def text(self):
+        lines = [f"Geheugen {self.name} (MiB boven start van de run, piek {self.peak_mib}):"]
+        for s in self.stages:
+            lines.append(f"  {s['stage']:<24} vast {s['current_mib']:>8.2f}  piek {s['peak_mib']:>8.2f}")
+            for site in s['top']:
+                lines.append(f"      +{site['size_diff_kib']:>10.1f} KiB  {site['count_diff']:>+7}  {site['site']}")
+        return '\n'.join(lines)
+
+    def write(self, path=MEMORY_REPORT_FILE):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'a') as f:
+            f.write(json.dumps({
+                'time': datetime.now().isoformat(timespec='seconds'),
+                'pipeline': self.name,
+                'peak_mib': self.peak_mib,
+                'stages': self.stages
+            }) + '\n')
+
+def current_report():
+    return getattr(_current, 'report', None)
+
+@contextmanager
+def run(name, enabled=None):
+    """Reports the memory of the block (one pipeline run) stage by stage when MEMORY_REPORT is on."""
+    global _active
+    if not (MEMORY_REPORT if enabled is None else enabled) or current_report() is not None:
+        yield None
+        return
+    # Runs overlap in the worker: the first to start turns tracing on and
+    # the last to end turns it off
+    with _active_lock:
+        if _active == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(MEMORY_REPORT_FRAMES)
+        _active += 1
+    try:
+        report = _current.report = MemoryReport(name)
+    except Exception as e:
+        log.warning(f"Geheugenrapport van {name} niet gestart: {str(e)}")
+        report = None
+    try:
+        yield report
+    finally:
+        _current.report = None
+        if report is not None:
+            try:
+                report.checkpoint('end of run')
+                log.info(report.text())
+                report.write()
+            except Exception as e:
+                log.warning(f"Geheugenrapport van {name} niet opgeslagen: {str(e)}")
+        with _active_lock:
+            _active -= 1
+            if _active == 0:
+                tracemalloc.stop()
+
+def checkpoint(stage):
+    """Closes a stage of the running report; a no-op without MEMORY_REPORT.
+
+    Never raises: a failing diagnostic must not fail the run.
+    """
+    report = current_report()
+    if report is None:
+        return
+    try:
+        report.checkpoint(stage)
+    except Exception as e:
+        log.warning(f"Geheugen checkpoint {stage} mislukt: {str(e)}")
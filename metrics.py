@@ -0,0 +1,161 @@
+import threading
+import logs
+from bisect import bisect_left
+from collections import Counter, deque
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# Latency of every outbound API call, per service and endpoint class.
+# clients.ServiceClient records each call twice: in the process-wide `calls`
+# (served on /metrics by web.py) and in the stats of the run that made it, which
+# jobs.locked_job logs as a p50/p95/p99 summary when the run ends.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Percentiles are taken over the most recent samples per endpoint
+SAMPLE_SIZE = 2048
+
+# Path segments that name an endpoint; everything else (ids, bases, tables) is dropped
+ENDPOINT_SEGMENTS = {
+    'wa_sessions', 'custom_fields', 'merge', 'tickets', 'messages', 'attachments', 'mailFolders'
+}
+
+def endpoint_class(service, method, url):
+    """'POST wa_sessions', 'GET attachments', 'DELETE records', ... for a request."""
+    if service == 'airtable':
+        return f"{method} records"
+    segments = [s for s in urlparse(url).path.split('/') if s in ENDPOINT_SEGMENTS]
+    return f"{method} {segments[-1] if segments else urlparse(url).path.rsplit('/', 1)[-1] or '/'}"
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = max(int(round(q / 100.0 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+class LatencyHistogram:
+    def __init__(self):
+        self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total_seconds = 0.0
+        self.bytes = 0
+        self.statuses = Counter()
+        self.samples = deque(maxlen=SAMPLE_SIZE)
+
+    def observe(self, seconds, status, nbytes):
+        self.bucket_counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total_seconds += seconds
+        self.bytes += nbytes
+        self.statuses[str(status)] += 1
+        self.samples.append(seconds)
+
+    def percentiles(self):
+        values = sorted(self.samples)
+        return {q: percentile(values, q) for q in (50, 95, 99)}
+
+class CallStats:
+    """Latency histograms keyed by (service, endpoint class), plus counters for a run."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def observe(self, service, endpoint, status, nbytes, seconds):
+        with self._lock:
+            histogram = self.histograms.get((service, endpoint))
+            if histogram is None:
+                histogram = self.histograms[(service, endpoint)] = LatencyHistogram()
+            histogram.observe(seconds, status, nbytes)
+
+    def snapshot(self):
+        with self._lock:
+            return sorted(self.histograms.items())
+
+    def summary_lines(self):
+        lines = []
+        for (service, endpoint), h in self.snapshot():
+            p = h.percentiles()
+            errors = sum(n for status, n in h.statuses.items() if not status.startswith(('2', '3')))
+            lines.append(
+                f"{service:<9}{endpoint:<22}{h.count:>6} calls  "
+                f"p50 {p[50] * 1000:>6.0f}ms  p95 {p[95] * 1000:>6.0f}ms  p99 {p[99] * 1000:>6.0f}ms  "
+                f"{h.bytes / 1024:>8.1f} KiB  {errors} fout"
+            )
+        return lines
+
+log = logs.get_logger(__name__)
+
+calls = CallStats()
+_current = threading.local()
+
+# Pipeline counters: name -> {pipeline: total}, e.g. rows_parsed, messages_sent,
+# failed.<stage>.<reason>. The run that counts them gets them in its CallStats too.
+_counters = {}
+_counters_lock = threading.Lock()
+
+def count(name, pipeline, n=1):
+    with _counters_lock:
+        totals = _counters.setdefault(name, {})
+        totals[pipeline] = totals.get(pipeline, 0) + n
+    run = current_run()
+    if run is not None:
+        run.count(name, n)
+
+def failure_reason(error):
+    """Short reason for a failed row: 'http_429', 'ConnectionError', 'KeyError', ..."""
+    response = getattr(error, 'response', None)
+    if response is not None and getattr(response, 'status_code', None):
+        return f"http_{response.status_code}"
+    return type(error).__name__
+
+def count_failure(pipeline, stage, error):
+    """Counts a failed row under failed.<stage>.<reason>; error is an exception or a reason."""
+    reason = failure_reason(error) if isinstance(error, BaseException) else error
+    count(f"failed.{stage}.{reason}", pipeline)
+
+def counters():
+    with _counters_lock:
+        return {name: dict(totals) for name, totals in _counters.items()}
+
+def current_run():
+    return getattr(_current, 'run', None)
+
+def record_call(service, endpoint, status, nbytes, seconds):
+    calls.observe(service, endpoint, status, nbytes, seconds)
+    run = current_run()
+    if run is not None:
+        run.observe(service, endpoint, status, nbytes, seconds)
+
+@contextmanager
+def run_scope():
+    """Collects the calls made by this thread (and threads started via bind) into fresh stats."""
+    previous = current_run()
+    _current.run = CallStats()
+    try:
+        yield _current.run
+    finally:
+        _current.run = previous
+
+def bind(func):
+    """Wraps func so calls it makes in another thread count toward the caller's run."""
+    run = current_run()
+
+    def bound(*args, **kwargs):
+        previous = current_run()
+        _current.run = run
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current.run = previous
+    return bound
+
+def log_summary(stats, title):
+    lines = stats.summary_lines()
+    if not lines:
+        return
+    log.info(f"API latency {title}:\n" + '\n'.join(lines))
@@ -0,0 +1,361 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from datetime import datetime
+import requests
+import clients
+import deadlines
+import jobs
+import logs
+import metrics
+import shutdown
+import tracing
+
+log = logs.get_logger(__name__)
+
+# Durable send queue. Parsing a workbook only enqueues one message per row
+# (fast, one transaction); worker threads then deliver them through the
+# handler registered for the pipeline, retrying failures with exponential
+# backoff. Messages left in 'sending' by a killed process go back to
+# 'pending' on startup, so a restart resumes where it stopped. Messages with
+# a deadline are sent earliest-deadline-first and expire once it has passed.
+# Must outlive the process to be of use after a restart; a Heroku dyno's
+# filesystem does not (see shutdown.check_state_storage).
+OUTBOX_DB = os.getenv('OUTBOX_DB', 'data/outbox.sqlite')
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', 4))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 8))
+OUTBOX_BACKOFF_SECONDS = float(os.getenv('OUTBOX_BACKOFF_SECONDS', 30))
+OUTBOX_BACKOFF_MAX_SECONDS = float(os.getenv('OUTBOX_BACKOFF_MAX_SECONDS', 3600))
+
+# Priority classes share the Trengo budget by weight (smooth weighted round
+# robin): with the defaults, 8 reminders go out for every feedback message.
+# The weight is also the class's priority in the services' rate limiters, so
+# the Airtable reminders (sent outside the outbox, see reminders.py) get
+# Trengo tokens before feedback and photo sends waiting for the same budget.
+def _parse_weights(text):
+    weights = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip():
+            weights[name.strip()] = max(int(weight or 1), 1)
+    return weights
+
+CLASS_WEIGHTS = _parse_weights(os.getenv(
+    'OUTBOX_CLASS_WEIGHTS', 'reminder=8,confirmation=4,planning=4,photo=1,feedback=1'
+))
+DEFAULT_CLASS = 'default'
+# Shedding: while more than OUTBOX_SHED_BACKLOG higher-priority messages are
+# due, the classes in OUTBOX_SHED_CLASSES wait. 0 turns shedding off.
+OUTBOX_SHED_BACKLOG = int(os.getenv('OUTBOX_SHED_BACKLOG', 0))
+OUTBOX_SHED_CLASSES = [c.strip() for c in os.getenv('OUTBOX_SHED_CLASSES', 'feedback,photo').split(',') if c.strip()]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    pipeline TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    deadline REAL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_due ON messages (status, next_attempt_at);
+"""
+
+# pipeline name -> callable taking the payload as keyword arguments
+_handlers = {}
+# pipeline name -> priority class
+_classes = {}
+
+def register(pipeline, handler, priority_class=DEFAULT_CLASS):
+    _handlers[pipeline] = handler
+    _classes[pipeline] = priority_class
+
+def class_of(pipeline):
+    return _classes.get(pipeline, DEFAULT_CLASS)
+
+def class_weight(priority_class):
+    return CLASS_WEIGHTS.get(priority_class, 1)
+
+def _encode(value):
+    if isinstance(value, datetime):
+        if str(value) == 'NaT':
+            return None
+        return {'__datetime__': value.isoformat()}
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+def _decode(obj):
+    if '__datetime__' in obj:
+        return datetime.fromisoformat(obj['__datetime__'])
+    return obj
+
+def encode_payload(payload):
+    return json.dumps(payload, default=_encode)
+
+def decode_payload(text):
+    return json.loads(text, object_hook=_decode)
+
+def is_retryable(error):
+    """Client errors (4xx other than 429) will fail the same way again; everything else is retried."""
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return True
+
+def backoff_delay(attempts):
+    return min(OUTBOX_BACKOFF_SECONDS * (2 ** (attempts - 1)), OUTBOX_BACKOFF_MAX_SECONDS)
+
+class Outbox:
+    def __init__(self, path=OUTBOX_DB):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        # Smooth weighted round robin state per priority class
+        self._credit = {}
+        self.shed_count = 0
+        with self._lock, self._conn:
+            self._conn.executescript(SCHEMA)
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(messages)")]
+            if 'deadline' not in columns:
+                self._conn.execute("ALTER TABLE messages ADD COLUMN deadline REAL")
+
+    def recover(self):
+        """Puts messages a previous process was still sending back in the queue."""
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "UPDATE messages SET status = 'pending', updated_at = ? WHERE status = 'sending'",
+                (time.time(),)
+            )
+        return cur.rowcount
+
+    def enqueue_many(self, pipeline, payloads, due=None):
+        """Queues payloads in one transaction; `due` optionally gives a deadline (epoch) per payload."""
+        now = time.time()
+        due = due or [None] * len(payloads)
+        rows = [(pipeline, encode_payload(p), now, d, now, now) for p, d in zip(payloads, due)]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                """INSERT INTO messages (pipeline, payload, next_attempt_at, deadline, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                rows
+            )
+        return len(rows)
+
+    def _pick_class(self, due_counts):
+        """Chooses the priority class to serve next from {class: due messages}."""
+        classes = sorted(due_counts)
+        if OUTBOX_SHED_BACKLOG:
+            urgent = sum(n for c, n in due_counts.items() if c not in OUTBOX_SHED_CLASSES)
+            if urgent > OUTBOX_SHED_BACKLOG:
+                shed = [c for c in classes if c in OUTBOX_SHED_CLASSES]
+                if shed:
+                    self.shed_count += 1
+                classes = [c for c in classes if c not in OUTBOX_SHED_CLASSES]
+        if not classes:
+            return None
+        total = sum(class_weight(c) for c in classes)
+        for c in classes:
+            self._credit[c] = self._credit.get(c, 0) + class_weight(c)
+        best = max(classes, key=lambda c: self._credit[c])
+        self._credit[best] -= total
+        return best
+
+    def claim(self, pipelines=None):
+        """Marks the next due message as 'sending'; returns (id, pipeline, payload, attempts, deadline).
+
+        The priority class is chosen by weight; within it, messages with the
+        earliest deadline go first, then the oldest without one.
+        """
+        now = time.time()
+        where = "WHERE status = 'pending' AND next_attempt_at <= ?"
+        params = [now]
+        if pipelines:
+            where += f" AND pipeline IN ({','.join('?' * len(pipelines))})"
+            params.extend(pipelines)
+        with self._lock, self._conn:
+            due = self._conn.execute(
+                f"SELECT pipeline, COUNT(*) FROM messages {where} GROUP BY pipeline", params
+            ).fetchall()
+            due_counts = {}
+            for pipeline, count in due:
+                due_counts[class_of(pipeline)] = due_counts.get(class_of(pipeline), 0) + count
+            chosen = self._pick_class(due_counts)
+            if chosen is None:
+                return None
+            chosen_pipelines = [pipeline for pipeline, _ in due if class_of(pipeline) == chosen]
+            row = self._conn.execute(
+                f"""SELECT id, pipeline, payload, attempts, deadline FROM messages {where}
+                    AND pipeline IN ({','.join('?' * len(chosen_pipelines))})
+                    ORDER BY deadline IS NULL, deadline, next_attempt_at, id LIMIT 1""",
+                params + chosen_pipelines
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE messages SET status = 'sending', updated_at = ? WHERE id = ?", (now, row[0])
+            )
+        return row[0], row[1], decode_payload(row[2]), row[3], row[4]
+
+    def mark_sent(self, message_id):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE messages SET status = 'sent', last_error = NULL, updated_at = ? WHERE id = ?",
+                (time.time(), message_id)
+            )
+
+    def mark_failed(self, message_id, attempts, error, retryable=True):
+        """Schedules a retry with backoff, or gives up after OUTBOX_MAX_ATTEMPTS or a permanent error."""
+        now = time.time()
+        give_up = not retryable or attempts >= OUTBOX_MAX_ATTEMPTS
+        with self._lock, self._conn:
+            self._conn.execute(
+                """UPDATE messages SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?,
+                   updated_at = ? WHERE id = ?""",
+                ('failed' if give_up else 'pending', attempts, now + backoff_delay(attempts),
+                 str(error)[:1000], now, message_id)
+            )
+        return not give_up
+
+    def mark_expired(self, message_id):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE messages SET status = 'expired', updated_at = ? WHERE id = ?", (time.time(), message_id)
+            )
+
+    def defer(self, message_id, delay):
+        """Parks a message without counting an attempt, e.g. while a circuit breaker is open."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE messages SET status = 'pending', next_attempt_at = ?, updated_at = ? WHERE id = ?",
+                (now + delay, now, message_id)
+            )
+
+    def counts(self, pipelines=None):
+        query = "SELECT status, COUNT(*) FROM messages"
+        params = []
+        if pipelines:
+            query += f" WHERE pipeline IN ({','.join('?' * len(pipelines))})"
+            params.extend(pipelines)
+        with self._lock:
+            rows = self._conn.execute(query + " GROUP BY status", params).fetchall()
+        return dict(rows)
+
+    def counts_by_pipeline(self):
+        """Returns {(pipeline, status): count} for the whole outbox."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT pipeline, status, COUNT(*) FROM messages GROUP BY pipeline, status"
+            ).fetchall()
+        return {(pipeline, status): n for pipeline, status, n in rows}
+
+    def expire(self, message_id, pipeline, payload, deadline):
+        self.mark_expired(message_id)
+        deadlines.report_expired(pipeline, message_id, payload.get('naam') or payload.get('naam_bewoner'), deadline)
+        return 'expired'
+
+    def deliver_one(self, pipelines=None, run_deadline=None):
+        """Claims and delivers one due message.
+
+        Returns 'sent', 'retry', 'failed', 'expired' (deadline passed), 'deferred'
+        (service circuit open or run budget used up) or None if nothing is due.
+        """
+        claimed = self.claim(pipelines)
+        if claimed is None:
+            return None
+        message_id, pipeline, payload, attempts, deadline = claimed
+        if deadlines.expired(deadline):
+            return self.expire(message_id, pipeline, payload, deadline)
+        handler = _handlers.get(pipeline)
+        started = time.perf_counter()
+        try:
+            if handler is None:
+                raise LookupError(f"Geen handler geregistreerd voor {pipeline}")
+            with logs.context(pipeline=pipeline, row=message_id, stage='send'), \
+                    tracing.span('row', pipeline=pipeline, row=message_id, attempt=attempts + 1), \
+                    clients.deadline(deadlines.earliest(deadline, run_deadline)), \
+                    clients.priority(class_weight(class_of(pipeline))):
+                handler(**payload)
+                log.debug(f"Outbox bericht {message_id} verstuurd",
+                          extra={'duration_ms': round((time.perf_counter() - started) * 1000, 1)})
+        except clients.CircuitOpenError as e:
+            self.defer(message_id, e.retry_after)
+            return 'deferred'
+        except clients.DeadlineExceeded:
+            if deadlines.expired(deadline):
+                return self.expire(message_id, pipeline, payload, deadline)
+            self.defer(message_id, 0)
+            return 'deferred'
+        except Exception as e:
+            retry = self.mark_failed(message_id, attempts + 1, e, retryable=is_retryable(e))
+            metrics.count_failure(pipeline, 'send', e)
+            log.error(f"Outbox bericht {message_id} ({pipeline}) mislukt, poging {attempts + 1}: {str(e)}",
+                      extra={'pipeline': pipeline, 'row': message_id, 'stage': 'send'})
+            return 'retry' if retry else 'failed'
+        self.mark_sent(message_id)
+        return 'sent'
+
+    def drain(self, pipelines=None, workers=OUTBOX_WORKERS, budget=None):
+        """Delivers all due messages with worker threads; returns a count per outcome.
+
+        By default every pipeline registered in this process is served, so in
+        the worker one drain works through the shared queue by priority class.
+        A worker stops as soon as a service circuit is open or the optional
+        time budget (seconds) is used up; the rest of the queue waits for a
+        later drain.
+        """
+        pipelines = pipelines or list(_handlers)
+        run_deadline = deadlines.run_deadline(budget) if budget else None
+        stats = {'sent': 0, 'retry': 0, 'failed': 0, 'expired': 0, 'deferred': 0}
+        stats_lock = threading.Lock()
+
+        def work():
+            while not deadlines.expired(run_deadline) and not shutdown.requested():
+                outcome = self.deliver_one(pipelines, run_deadline)
+                if outcome is None:
+                    return
+                with stats_lock:
+                    stats[outcome] += 1
+                if outcome == 'deferred':
+                    return
+
+        threads = [threading.Thread(target=jobs.bind(work), name=f"outbox-{i}") for i in range(workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if any(stats.values()):
+            log.info(f"Outbox: {stats['sent']} verstuurd, {stats['retry']} opnieuw gepland, {stats['failed']} mislukt")
+        if stats['expired']:
+            log.info(f"Outbox: {stats['expired']} berichten over hun deadline, niet verstuurd")
+        if stats['deferred'] or deadlines.expired(run_deadline) or shutdown.requested():
+            log.info("Outbox: ronde gestopt (service onbereikbaar, tijdsbudget op of afsluiten), resterende berichten blijven in de wachtrij")
+        return stats
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+def get_outbox():
+    """Returns the process-wide outbox; recovers interrupted messages on first use."""
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = Outbox()
+            recovered = _outbox.recover()
+            if recovered:
+                log.info(f"Outbox: {recovered} onderbroken berichten opnieuw in wachtrij")
+        return _outbox
+
+def enqueue(pipeline, payloads, due=None):
+    return get_outbox().enqueue_many(pipeline, payloads, due)
+
+def drain(pipelines=None, workers=OUTBOX_WORKERS, budget=None):
+    return get_outbox().drain(pipelines, workers, budget)
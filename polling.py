@@ -0,0 +1,101 @@
+import os
+import random
+import threading
+from datetime import datetime, timedelta
+import logs
+
+log = logs.get_logger(__name__)
+
+# Polling cadence adapts to the workload: right after a source returned
+# work we poll again at the minimum interval, while it stays empty the
+# interval grows by POLL_BACKOFF up to the maximum. Intervals in seconds.
+POLL_MIN_SECONDS = float(os.getenv('POLL_MIN_SECONDS', 120))
+POLL_MAX_SECONDS = float(os.getenv('POLL_MAX_SECONDS', 1800))
+POLL_BACKOFF = float(os.getenv('POLL_BACKOFF', 2.0))
+POLL_JITTER = float(os.getenv('POLL_JITTER', 0.1))
+
+class AdaptivePoller:
+    """Tracks hits for one source and computes the delay until the next poll."""
+
+    def __init__(self, name, min_interval=POLL_MIN_SECONDS, max_interval=POLL_MAX_SECONDS,
+                 backoff=POLL_BACKOFF, jitter=POLL_JITTER):
+        self.name = name
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.interval = min_interval
+        self.polls = 0
+        self.hits = 0
+        self.last_hit = None
+        self._lock = threading.Lock()
+
+    def record(self, found):
+        with self._lock:
+            self.polls += 1
+            if found:
+                self.hits += 1
+                self.last_hit = datetime.now()
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * self.backoff, self.max_interval)
+
+    def next_delay(self):
+        delay = self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        return max(self.min_interval, min(delay, self.max_interval))
+
+    @property
+    def hit_rate(self):
+        return self.hits / self.polls if self.polls else 0.0
+
+    def metrics(self):
+        return {
+            'name': self.name,
+            'interval_seconds': self.interval,
+            'polls': self.polls,
+            'hits': self.hits,
+            'hit_rate': self.hit_rate,
+            'last_hit': self.last_hit.isoformat() if self.last_hit else None
+        }
+
+_pollers = {}
+_pollers_lock = threading.Lock()
+
+def get_poller(name, **kwargs):
+    with _pollers_lock:
+        if name not in _pollers:
+            _pollers[name] = AdaptivePoller(name, **kwargs)
+        return _pollers[name]
+
+def record(name, found):
+    """Called by a pipeline after polling its source (mailbox or Airtable table)."""
+    get_poller(name).record(found)
+
+def metrics():
+    with _pollers_lock:
+        return [poller.metrics() for poller in _pollers.values()]
+
+def add_adaptive_job(scheduler, job_id, func, poller, **job_kwargs):
+    """Schedules func now and re-schedules it after every run using the poller's delay.
+
+    The max interval is kept as the job's own trigger, so the job keeps running
+    even if a run ends without re-scheduling.
+    """
+    def run():
+        try:
+            return func()
+        finally:
+            delay = poller.next_delay()
+            scheduler.modify_job(job_id, next_run_time=datetime.now() + timedelta(seconds=delay))
+            log.info(f"Volgende poll {job_id} over {delay:.0f}s (hit rate {poller.hit_rate:.0%})")
+
+    run.__name__ = getattr(func, '__name__', job_id)
+    scheduler.add_job(
+        run,
+        'interval',
+        seconds=poller.max_interval,
+        id=job_id,
+        name=job_id,
+        next_run_time=datetime.now(),
+        **job_kwargs
+    )
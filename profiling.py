@@ -0,0 +1,94 @@
+import os
+import io
+import sys
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+import logs
+
+log = logs.get_logger(__name__)
+
+# cProfile capture of whole pipeline runs. Switched on with PROFILE=1 or by
+# starting a script with --profile; PROFILE_EVERY=N profiles only every Nth
+# run of each pipeline, to limit the overhead in production. Worker threads
+# started through jobs.bind are profiled too and merged into the same
+# stats. Each profiled run writes PROFILE_DIR/<pipeline>-<time>-run<N>.pstats
+# (open with `python -m pstats` or snakeviz) and a .txt with the top
+# PROFILE_TOP functions by cumulative time.
+PROFILE = os.getenv('PROFILE', '0').lower() not in {'0', 'false', 'no', 'off'} or '--profile' in sys.argv
+PROFILE_EVERY = max(int(os.getenv('PROFILE_EVERY', 1)), 1)
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_TOP = int(os.getenv('PROFILE_TOP', 25))
+
+_runs = {}
+_runs_lock = threading.Lock()
+_current = threading.local()
+
+def should_profile(name):
+    """Counts the run; returns its number if this one is profiled, else None."""
+    if not PROFILE:
+        return None
+    with _runs_lock:
+        _runs[name] = _runs.get(name, 0) + 1
+        number = _runs[name]
+    return number if (number - 1) % PROFILE_EVERY == 0 else None
+
+@contextmanager
+def run(name):
+    """Profiles the block (one pipeline run) if profiling is on for this run."""
+    number = should_profile(name)
+    if number is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    threads = []
+    _current.threads = threads
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _current.threads = None
+        write(f"{name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}-run{number}", profiler, threads)
+
+def bind(func):
+    """Wraps func so a worker thread started during a profiled run is profiled as well."""
+    threads = getattr(_current, 'threads', None)
+    if threads is None:
+        return func
+
+    def bound(*args, **kwargs):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            threads.append(profiler)
+    return bound
+
+def write(name, profiler, threads=()):
+    base = os.path.join(PROFILE_DIR, name)
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stats = pstats.Stats(profiler)
+        for thread_profiler in threads:
+            stats.add(thread_profiler)
+        stats.dump_stats(base + '.pstats')
+
+        summary = io.StringIO()
+        pstats.Stats(base + '.pstats', stream=summary).sort_stats('cumulative').print_stats(PROFILE_TOP)
+        with open(base + '.txt', 'w') as f:
+            f.write(summary.getvalue())
+        log.info(f"Profiel opgeslagen in {base}.pstats ({len(threads)} worker threads)\n"
+                 + _top_lines(summary.getvalue()))
+    except Exception as e:
+        log.warning(f"Profiel {base} niet opgeslagen: {str(e)}")
+
+def _top_lines(text, limit=15):
+    """The header and first rows of a pstats listing, for the log."""
+    lines = [line for line in text.splitlines() if line.strip()]
+    start = next((i for i, line in enumerate(lines) if line.lstrip().startswith('ncalls')), 0)
+    return '\n'.join(lines[start:start + limit + 1])
@@ -0,0 +1,128 @@
+import heapq
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from apscheduler.schedulers.blocking import BlockingScheduler
+import airtable_records
+import clients
+import deadlines
+import jobs
+import logs
+import metrics
+import polling
+import sampler
+import shutdown
+import tracing
+import ZZZ_VestedaHerinnering1H
+import ZZZ_PreWonenHerinnering1H
+import ZZZ_VestedaBevestiging4H
+import ZZZ_PreWonenBevestiging4H
+
+log = logs.get_logger(__name__)
+
+PIPELINE_NAME = 'reminders'
+
+# All reminder tables are fetched concurrently in one tick and sent from a
+# single queue. Lower priority goes first: 1H reminders are due soonest.
+REMINDER_SOURCES = [
+    (ZZZ_VestedaHerinnering1H, 0),
+    (ZZZ_PreWonenHerinnering1H, 0),
+    (ZZZ_VestedaBevestiging4H, 1),
+    (ZZZ_PreWonenBevestiging4H, 1),
+]
+
+def due_key(reminder):
+    """Sort key within a priority class: earliest deadline first."""
+    return deadlines.sort_key(deadlines.reminder_deadline(reminder))
+
+def fetch_all(sources):
+    """Fetches every source table at the same time; returns (module, priority, reminders) per table."""
+    fetched = []
+    with ThreadPoolExecutor(max_workers=len(sources)) as pool:
+        futures = [(module, priority, pool.submit(jobs.bind(module.get_airtable_data))) for module, priority in sources]
+        for module, priority, future in futures:
+            try:
+                fetched.append((module, priority, future.result()))
+            except Exception as e:
+                log.error(f"Fout bij ophalen {module.PIPELINE_NAME}: {str(e)}")
+    return fetched
+
+def build_queue(fetched):
+    queue = []
+    for module, priority, reminders in fetched:
+        for reminder in reminders:
+            heapq.heappush(queue, (priority, due_key(reminder), len(queue), module, reminder))
+    return queue
+
+def process_data():
+    """Fetches all reminder tables in one tick and sends the merged queue, 1H first."""
+    log.info(f"=== Start nieuwe verwerking herinneringen: {datetime.now()} ===")
+
+    # Hold the run lock of each reminder script, so a standalone ZZZ process
+    # never sends the same table at the same time.
+    locked = []
+    try:
+        sources = []
+        for module, priority in REMINDER_SOURCES:
+            lock = jobs.get_lock(module.PIPELINE_NAME)
+            if lock.acquire():
+                locked.append(lock)
+                sources.append((module, priority))
+            else:
+                log.warning(f"{module.PIPELINE_NAME} draait al, tabel wordt overgeslagen")
+
+        if not sources:
+            return
+
+        queue = build_queue(fetch_all(sources))
+        polling.record(PIPELINE_NAME, bool(queue))
+        if not queue:
+            log.info("Geen herinneringen gevonden om te verwerken")
+            return
+
+        log.info(f"Aantal herinneringen in wachtrij: {len(queue)}")
+        budget = deadlines.run_deadline()
+        batch_size = len(queue)
+        sent = 0
+        while queue:
+            if shutdown.requested():
+                log.info(f"Afsluiten: {len(queue)} herinneringen wachten op de volgende ronde")
+                break
+            if deadlines.expired(budget):
+                log.info(f"Tijdsbudget van deze ronde op, {len(queue)} herinneringen wachten op de volgende ronde")
+                break
+            priority, _, _, module, reminder = heapq.heappop(queue)
+            try:
+                with logs.context(pipeline=module.PIPELINE_NAME, row=reminder.record_id, batch_size=batch_size), \
+                        tracing.span('row', pipeline=module.PIPELINE_NAME, row=reminder.record_id):
+                    log.debug(f"Verwerken: {reminder.naam_bewoner}")
+                    if module.process_record(reminder, budget):
+                        sent += 1
+            except clients.CircuitOpenError as e:
+                # The records stay in Airtable and are fetched again next tick
+                log.warning(f"{str(e)}; overige herinneringen wachten op de volgende ronde")
+                break
+            except Exception as e:
+                log.error(f"Fout bij verwerken record {reminder.record_id}: {str(e)}")
+                metrics.count_failure(module.PIPELINE_NAME, 'send', e)
+
+        log.info(f"{sent} herinneringen verstuurd")
+
+    except Exception as e:
+        log.error(f"Algemene fout: {str(e)}")
+        raise
+    finally:
+        # Before releasing the table locks, so a standalone script can't refetch the records first
+        airtable_records.flush_deletes()
+        for lock in locked:
+            lock.release()
+
+if __name__ == "__main__":
+    scheduler = BlockingScheduler(job_defaults=jobs.JOB_DEFAULTS)
+    poller = polling.get_poller(PIPELINE_NAME, min_interval=5 * 60, max_interval=30 * 60)
+    polling.add_adaptive_job(scheduler, PIPELINE_NAME, jobs.locked_job(PIPELINE_NAME, process_data), poller)
+
+    shutdown.install(scheduler)
+    sampler.install()
+    log.info("Starting scheduler...")
+    scheduler.start()
+    shutdown.finish()
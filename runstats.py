@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import argparse
+import resource
+import statistics
+from datetime import datetime
+import logs
+
+log = logs.get_logger(__name__)
+
+# Machine-readable summary of every pipeline run (jobs.locked_job): rows in,
+# duplicates removed, rows sent, failures by reason, API calls per endpoint,
+# wall time, rows/second and peak RSS, appended as one JSON line to
+# RUNSTATS_FILE. `python runstats.py [pipeline] [-n N]` prints the last N
+# runs per pipeline and how the latest one compares to the ones before it.
+# Peak RSS is the high-water mark of the whole process, so in the worker it
+# only grows; compare it between runs of the one-off scripts.
+RUNSTATS_FILE = os.getenv('RUNSTATS_FILE', 'reports/runs.jsonl')
+
+def peak_rss_mib():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def summarize(name, run_id, stats, wall_seconds, ok):
+    counters = dict(stats.counters)
+    rows_in = counters.get('rows_parsed', 0)
+    failures = {}
+    for key, n in counters.items():
+        if key.startswith('failed.'):
+            failures[key[len('failed.'):]] = n
+    api_calls = {}
+    for (service, endpoint), h in stats.snapshot():
+        api_calls[f"{service} {endpoint}"] = {'calls': h.count, 'p95_ms': round(h.percentiles()[95] * 1000)}
+    return {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'pipeline': name,
+        'run_id': run_id,
+        'ok': ok,
+        'wall_seconds': round(wall_seconds, 3),
+        'rows_in': rows_in,
+        'duplicates_removed': counters.get('duplicates_removed', 0),
+        'rows_sent': counters.get('messages_sent', 0),
+        'custom_fields_written': counters.get('custom_fields_written', 0),
+        'failures': failures,
+        'api_calls': api_calls,
+        'rows_per_second': round(rows_in / wall_seconds, 2) if wall_seconds > 0 else None,
+        'peak_rss_mib': peak_rss_mib(),
+    }
+
+def record(name, run_id, stats, wall_seconds, ok, path=None):
+    """Appends the summary of one run to the history; never fails the run."""
+    path = path or RUNSTATS_FILE
+    summary = summarize(name, run_id, stats, wall_seconds, ok)
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'a') as f:
+            f.write(json.dumps(summary) + '\n')
+    except OSError as e:
+        log.warning(f"Run samenvatting van {name} niet opgeslagen: {str(e)}")
+    return summary
+
+def load(path=None, pipeline=None):
+    runs = []
+    try:
+        with open(path or RUNSTATS_FILE) as f:
+            for line in f:
+                try:
+                    run = json.loads(line)
+                except ValueError:
+                    continue
+                if pipeline is None or run.get('pipeline') == pipeline:
+                    runs.append(run)
+    except FileNotFoundError:
+        pass
+    return runs
+
+def _api_total(run):
+    return sum(c['calls'] for c in run.get('api_calls', {}).values())
+
+def _row(run):
+    rows = run['rows_in']
+    calls_per_row = f"{_api_total(run) / rows:.1f}" if rows else '-'
+    rate = f"{run['rows_per_second']:.1f}" if run['rows_per_second'] is not None else '-'
+    return (f"{run['time']:<20}{'ok' if run['ok'] else 'FOUT':<5}{run['wall_seconds']:>9.1f}s"
+            f"{rows:>7}{run['duplicates_removed']:>6}{run['rows_sent']:>6}{sum(run['failures'].values()):>6}"
+            f"{calls_per_row:>9}{rate:>11}{run['peak_rss_mib']:>9.1f}")
+
+def compare(runs, last=10):
+    """Table of the last runs of one pipeline plus the latest run against the median of the others."""
+    runs = runs[-last:]
+    lines = [f"{'tijd':<20}{'':<5}{'duur':>10}{'rijen':>7}{'dubb':>6}{'verst':>6}{'fout':>6}"
+             f"{'api/rij':>9}{'rijen/s':>11}{'RSS MiB':>9}"]
+    lines += [_row(run) for run in runs]
+    if len(runs) > 1:
+        latest, earlier = runs[-1], runs[:-1]
+        for label, key in (('duur', 'wall_seconds'), ('rijen/s', 'rows_per_second'), ('RSS MiB', 'peak_rss_mib')):
+            values = [run[key] for run in earlier if run.get(key) is not None]
+            if not values or latest.get(key) is None:
+                continue
+            median = statistics.median(values)
+            change = f"{(latest[key] - median) / median * 100:+.0f}%" if median else '-'
+            lines.append(f"  {label:<8} laatste {latest[key]:>10}  mediaan vorige {median:>10}  {change}")
+        reasons = sorted(set(latest['failures']) | {r for run in earlier for r in run['failures']})
+        for reason in reasons:
+            lines.append(f"  fout {reason:<30} laatste {latest['failures'].get(reason, 0):>5}  "
+                         f"mediaan vorige {statistics.median(run['failures'].get(reason, 0) for run in earlier):>6}")
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Vergelijk de laatste runs per pipeline')
+    parser.add_argument('pipeline', nargs='?', help='alleen deze pipeline')
+    parser.add_argument('-n', '--last', type=int, default=10, help='aantal runs per pipeline (standaard 10)')
+    parser.add_argument('--file', default=RUNSTATS_FILE, help=f"geschiedenis (standaard {RUNSTATS_FILE})")
+    args = parser.parse_args(argv)
+
+    runs = load(args.file, args.pipeline)
+    if not runs:
+        print(f"Geen runs gevonden in {args.file}")
+        return 1
+    for name in sorted({run['pipeline'] for run in runs}):
+        print(f"\n{name}")
+        print(compare([run for run in runs if run['pipeline'] == name], args.last))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+import os
+import sys
+import time
+import signal
+import threading
+from collections import Counter
+from datetime import datetime
+import logs
+
+log = logs.get_logger(__name__)
+
+# Sampling profiler for the long-running scheduler processes. A daemon
+# thread reads the stack of every other thread each SAMPLER_INTERVAL
+# seconds and counts identical stacks; the overhead is low enough to leave
+# it on in production while looking for intermittent slowness. Toggle it
+# with `kill -USR2 <pid>` (or the /debug/sampler endpoint of web.py), or
+# start it with the process with SAMPLER=1. On stop the counts are written
+# to SAMPLER_DIR as collapsed stacks ("thread;file:func;file:func count"),
+# the input format of flamegraph.pl and speedscope.
+SAMPLER = os.getenv('SAMPLER', '0').lower() not in {'0', 'false', 'no', 'off'}
+SAMPLER_INTERVAL = float(os.getenv('SAMPLER_INTERVAL', 0.02))
+SAMPLER_DIR = os.getenv('SAMPLER_DIR', 'profiles')
+SAMPLER_MAX_DEPTH = int(os.getenv('SAMPLER_MAX_DEPTH', 64))
+
+class StackSampler:
+    def __init__(self, interval=SAMPLER_INTERVAL, max_depth=SAMPLER_MAX_DEPTH):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self.samples = 0
+        self.started_at = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration=None):
+        """Starts sampling; with `duration` (seconds) it stops and writes by itself."""
+        with self._lock:
+            if self.running:
+                return False
+            self.stacks = Counter()
+            self.samples = 0
+            self.started_at = datetime.now()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(duration,), name='stack-sampler', daemon=True)
+            self._thread.start()
+        log.info(f"Stack sampler gestart (elke {self.interval * 1000:.0f}ms)")
+        return True
+
+    def stop(self):
+        """Stops sampling and writes the collapsed stacks; returns the file path."""
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return None
+            self._stop.set()
+            self._thread = None
+        if thread is not threading.current_thread():
+            thread.join()
+        return self.write()
+
+    def _run(self, duration):
+        own = threading.get_ident()
+        end = time.monotonic() + duration if duration else None
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                self.stacks[self._collapse(names.get(ident, str(ident)), frame)] += 1
+            self.samples += 1
+            if end is not None and time.monotonic() >= end:
+                self.stop()
+                return
+
+    def _collapse(self, thread_name, frame):
+        frames = []
+        while frame is not None and len(frames) < self.max_depth:
+            code = frame.f_code
+            frames.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        frames.append(thread_name.replace(';', ':').replace(' ', '_'))
+        return ';'.join(reversed(frames))
+
+    def collapsed(self):
+        """The current counts in collapsed-stack format, most frequent first."""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def write(self):
+        stamp = (self.started_at or datetime.now()).strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(SAMPLER_DIR, f"stacks-{os.getpid()}-{stamp}.folded")
+        try:
+            os.makedirs(SAMPLER_DIR, exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(self.collapsed())
+        except OSError as e:
+            log.warning(f"Stack samples niet opgeslagen: {str(e)}")
+            return None
+        log.info(f"Stack sampler gestopt: {self.samples} samples, {len(self.stacks)} stacks in {path}")
+        return path
+
+sampler = StackSampler()
+
+def toggle():
+    if sampler.running:
+        return sampler.stop()
+    sampler.start()
+    return None
+
+def install():
+    """Toggles the sampler on SIGUSR2 (main thread only), and starts it when SAMPLER=1."""
+    signal.signal(signal.SIGUSR2, lambda signum, frame: threading.Thread(target=toggle, daemon=True).start())
+    if SAMPLER:
+        sampler.start()
@@ -0,0 +1,99 @@
+import os
+import signal
+import threading
+import time
+import jobs
+import logs
+
+log = logs.get_logger(__name__)
+
+# Graceful stop on SIGTERM (Heroku restarts dynos daily and on deploys, and
+# sends SIGKILL 30 seconds later). The scheduler stops starting jobs, running
+# jobs stop taking new rows (loops check requested()), the row in flight is
+# finished, and then the flush hooks run (e.g. pending Airtable deletes).
+SHUTDOWN_GRACE_SECONDS = float(os.getenv('SHUTDOWN_GRACE_SECONDS', 25))
+
+# Resuming after a restart only works when the send ledger, the outbox and
+# the ticket index survive it. A Heroku dyno boots on a fresh copy of the
+# slug: files written under the app directory, like the default
+# data/*.sqlite, are gone after every restart and deploy, together with the
+# pending messages, the record of what was sent and the index (which then
+# costs a full rebuild). Heroku offers no disk that outlives a dyno, so the
+# scheduler keeps running there and logs a warning at startup naming the
+# databases that will not survive; point them at persistent storage where
+# there is some, or set ALLOW_EPHEMERAL_STATE=1 to accept the loss quietly.
+STATE_DATABASES = ('LEDGER_DB', 'OUTBOX_DB', 'TICKET_INDEX_DB')
+ALLOW_EPHEMERAL_STATE = os.getenv('ALLOW_EPHEMERAL_STATE', '0').lower() in {'1', 'true', 'yes', 'on'}
+
+_stopping = threading.Event()
+_hooks = []
+_hooks_lock = threading.Lock()
+
+def check_state_storage():
+    """Warns on a dyno when the ledger, outbox or ticket index lives on the dyno's throwaway filesystem."""
+    if not os.getenv('DYNO') or ALLOW_EPHEMERAL_STATE:
+        return []
+    app_dir = os.path.realpath(os.getcwd())
+    ephemeral = []
+    for name in STATE_DATABASES:
+        path = os.getenv(name)
+        if not path or not os.path.isabs(path) or os.path.realpath(path).startswith(app_dir + os.sep):
+            ephemeral.append(name)
+    if ephemeral:
+        log.warning(f"Waarschuwing: {', '.join(ephemeral)} staat op het tijdelijke bestandssysteem van de "
+                    "dyno; na een herstart zijn de wachtrij en de verzonden berichten vergeten")
+    return ephemeral
+
+def requested():
+    """True once a shutdown signal was received; loops stop taking new work."""
+    return _stopping.is_set()
+
+def on_shutdown(hook):
+    """Registers a callable to run after the running jobs have stopped (once per hook)."""
+    with _hooks_lock:
+        if hook not in _hooks:
+            _hooks.append(hook)
+    return hook
+
+def run_hooks():
+    with _hooks_lock:
+        hooks = list(_hooks)
+    for hook in hooks:
+        try:
+            hook()
+        except Exception as e:
+            log.error(f"Fout bij afsluiten ({getattr(hook, '__name__', hook)}): {str(e)}")
+
+def wait_for_jobs(grace=SHUTDOWN_GRACE_SECONDS):
+    """Waits until no job is running, at most `grace` seconds; returns True if all finished."""
+    end = time.monotonic() + grace
+    while jobs.running_jobs() and time.monotonic() < end:
+        time.sleep(0.2)
+    running = jobs.running_jobs()
+    if running:
+        log.info(f"Afsluiten: jobs nog bezig na {grace:g}s: {', '.join(running)}")
+    return not running
+
+def request_stop(scheduler=None, reason="Stoppen"):
+    """Stops new work, and the scheduler if given; returns False if already stopping."""
+    if _stopping.is_set():
+        return False
+    log.info(f"{reason}, afronden en stoppen...")
+    _stopping.set()
+    if scheduler is not None and scheduler.running:
+        scheduler.shutdown(wait=False)
+    return True
+
+def install(scheduler=None):
+    """Handles SIGTERM/SIGINT: stop new work, and stop the scheduler if given."""
+    def handle(signum, frame):
+        request_stop(scheduler, f"Signaal {signal.Signals(signum).name} ontvangen")
+
+    signal.signal(signal.SIGTERM, handle)
+    signal.signal(signal.SIGINT, handle)
+
+def finish(grace=SHUTDOWN_GRACE_SECONDS):
+    """Called once the scheduler has returned: let running jobs finish, then flush."""
+    wait_for_jobs(grace)
+    run_hooks()
+    log.info("Afgesloten")
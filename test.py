@@ -2,10 +2,13 @@ import os
 import sys
 import json
 import base64
-import requests
 import pandas as pd
 from datetime import datetime
-import msal
+import clients
+import logs
+import ticket_index
+
+log = logs.get_logger(__name__)
 
 # === CONFIGURATION ===
 CUSTOM_FIELDS = {
@@ -15,8 +18,9 @@ CUSTOM_FIELDS = {
     "werkbonnummer": 618194,
     "binnen_of_buiten": 618205
 }
-PER_PAGE = 25
-MAX_TICKETS = 500
+
+# Send follow-ups into the open ticket of the werkbon instead of new ticket + merge
+TICKET_REUSE = os.getenv('TICKET_REUSE', '1').lower() not in {'0', 'false', 'no', 'off'}
 
 REQUIRED_ENV_VARS = [
     'AZURE_CLIENT_ID', 'AZURE_CLIENT_SECRET', 'AZURE_TENANT_ID',
@@ -31,19 +35,11 @@ class OutlookClient:
         self.tenant_id = os.getenv('AZURE_TENANT_ID')
         self.username = os.getenv('OUTLOOK_EMAIL')
         self.password = os.getenv('OUTLOOK_PASSWORD')
-        self.app = msal.ConfidentialClientApplication(
-            client_id=self.client_id,
-            client_credential=self.client_secret,
-            authority=f"https://login.microsoftonline.com/{self.tenant_id}"
-        )
+        self.app = clients.graph_app()
 
     def get_token(self):
         scopes = ['https://graph.microsoft.com/Mail.Read']
-        result = self.app.acquire_token_by_username_password(
-            username=self.username,
-            password=self.password,
-            scopes=scopes
-        )
+        result = clients.acquire_graph_token(self.username, self.password, scopes)
         if "access_token" not in result:
             raise Exception(f"Token acquisition failed: {result.get('error_description')}")
         return result["access_token"]
@@ -58,13 +54,13 @@ class OutlookClient:
         url = 'https://graph.microsoft.com/v1.0/me/messages'
         params = {'$filter': filter_query, '$select': 'id,hasAttachments'}
 
-        resp = requests.get(url, headers=headers, params=params)
+        resp = clients.graph.get(url, headers=headers, params=params)
         resp.raise_for_status()
         for msg in resp.json().get('value', []):
             if not msg.get("hasAttachments"):
                 continue
             att_url = f"https://graph.microsoft.com/v1.0/me/messages/{msg['id']}/attachments"
-            att_resp = requests.get(att_url, headers=headers)
+            att_resp = clients.graph.get(att_url, headers=headers)
             att_resp.raise_for_status()
             for att in att_resp.json().get("value", []):
                 if att.get("name", "").endswith(".xlsx"):
@@ -73,7 +69,7 @@ class OutlookClient:
                     with open(filepath, 'wb') as f:
                         f.write(base64.b64decode(att['contentBytes']))
                     # mark as read
-                    requests.patch(
+                    clients.graph.patch(
                         f"https://graph.microsoft.com/v1.0/me/messages/{msg['id']}",
                         headers=headers,
                         json={"isRead": True}
@@ -81,34 +77,6 @@ class OutlookClient:
                     return filepath
         return None
 
-def fetch_recent_trengo_tickets():
-    token = os.getenv("TRENGO_API_KEY")
-    tickets_by_werkbon = {}
-    next_url = f"https://app.trengo.com/api/v2/tickets?page=1&per_page={PER_PAGE}"
-    headers = {"Authorization": f"Bearer {token}", "Accept": "application/json"}
-    page = 1
-    count = 0
-
-    while next_url and count < MAX_TICKETS:
-        resp = requests.get(next_url, headers=headers)
-        resp.raise_for_status()
-        data = resp.json()
-        for t in data.get("data", []):
-            count += 1
-            if count > MAX_TICKETS:
-                break
-            # only need werkbon filter here
-            cf = t.get("custom_field_values", [])
-            for f in cf:
-                if str(f.get("custom_field_id")) == str(CUSTOM_FIELDS["werkbonnummer"]):
-                    wb = str(f.get("value", "")).strip()
-                    if wb:
-                        tickets_by_werkbon.setdefault(wb, []).append(t["id"])
-        next_url = data.get("links", {}).get("next")
-        page += 1
-
-    return tickets_by_werkbon
-
 def safe_str(val):
     if pd.isna(val) or val is None:
         return ""
@@ -137,6 +105,23 @@ def format_phone(phone):
     p = str(phone).strip()
     return p.split('.')[0] if p.endswith('.0') else p
 
+def send_whatsapp_to_ticket(ticket_id, phone, params):
+    url = "https://app.trengo.com/api/v2/wa_sessions"
+    headers = {
+        "Authorization": f"Bearer {os.getenv('TRENGO_API_KEY')}",
+        "Content-Type": "application/json"
+    }
+    payload = {
+        "recipient_phone_number": phone,
+        "ticket_id": ticket_id,
+        "hsm_id": os.getenv('WHATSAPP_TEMPLATE_ID_TEST_BEVESTIGING'),
+        "params": params
+    }
+    r = clients.trengo.post(url, json=payload, headers=headers)
+    r.raise_for_status()
+    log.info(f"Template sent into existing ticket {ticket_id}")
+    return ticket_id
+
 def send_new_whatsapp_message(phone, params):
     url = "https://app.trengo.com/api/v2/wa_sessions"
     headers = {
@@ -148,10 +133,10 @@ def send_new_whatsapp_message(phone, params):
         "hsm_id": os.getenv('WHATSAPP_TEMPLATE_ID_TEST_BEVESTIGING'),
         "params": params
     }
-    r = requests.post(url, json=payload, headers=headers)
+    r = clients.trengo.post(url, json=payload, headers=headers)
     r.raise_for_status()
     tid = r.json().get("message", {}).get("ticket_id")
-    print(f"✅ New ticket {tid} created for {phone}")
+    log.info(f"New ticket {tid} created for {phone}")
     return tid
 
 def set_custom_fields(ticket_id, fields):
@@ -160,7 +145,7 @@ def set_custom_fields(ticket_id, fields):
         "Content-Type": "application/json"
     }
     for fid, val in fields.items():
-        r = requests.post(
+        r = clients.trengo.post(
             f"https://app.trengo.com/api/v2/tickets/{ticket_id}/custom_fields",
             json={"custom_field_id": fid, "value": val},
             headers=headers
@@ -174,67 +159,87 @@ def merge_tickets(main_id, merge_ids):
         "Content-Type": "application/json"
     }
     payload = {"ticket_ids": merge_ids}
-    r = requests.post(url, json=payload, headers=headers)
+    r = clients.trengo.post(url, json=payload, headers=headers)
     r.raise_for_status()
-    print(f"🔀 Merged tickets {merge_ids} into {main_id}")
+    log.info(f"Merged tickets {merge_ids} into {main_id}")
+
+def process_row(row, index, reuse_tickets=TICKET_REUSE):
+    wb = safe_str(row['Werkbonnummer'])
+    phone = format_phone(row['Mobielnummer'])
+    if not (wb and phone):
+        return
+
+    # build template params
+    params = [
+        {"type":"body","key":"{{1}}","value":safe_str(row['Naam bewoner'])},
+        {"type":"body","key":"{{2}}","value":safe_str(row['Taaktype'])},
+        {"type":"body","key":"{{3}}","value":safe_str(row['Dag'])},
+        {"type":"body","key":"{{4}}","value":format_date(row['Datum bezoek'])},
+        {"type":"body","key":"{{5}}","value":safe_str(row['Tijdvak'])},
+        {"type":"body","key":"{{6}}","value":safe_str(row['Reparatieduur'])},
+        {"type":"body","key":"{{7}}","value":wb}
+    ]
+    fields = {
+        CUSTOM_FIELDS['locatie']: safe_str(row['Locatie']),
+        CUSTOM_FIELDS['element']: safe_str(row['Element']),
+        CUSTOM_FIELDS['defect']: safe_str(row['Defect']),
+        CUSTOM_FIELDS['werkbonnummer']: wb,
+        CUSTOM_FIELDS['binnen_of_buiten']: safe_str(row['Binnen of buiten'])
+    }
+
+    # open ticket for this werkbon → send into it, only post changed fields
+    open_tid = index.open_ticket_for_werkbon(wb) if reuse_tickets else None
+    if open_tid:
+        send_whatsapp_to_ticket(open_tid, phone, params)
+        changed = index.changed_fields(open_tid, fields)
+        set_custom_fields(open_tid, changed)
+        index.record_custom_fields(open_tid, changed)
+        index.record_sent(open_tid, werkbon=wb, phone=phone)
+        return
 
-def process_excel_file(filepath, ticket_lookup):
+    existing = index.tickets_for_werkbon(wb)
+    # 1 existing → we will merge
+    new_tid = send_new_whatsapp_message(phone, params)
+    if new_tid:
+        set_custom_fields(new_tid, fields)
+        if len(existing) == 1:
+            merge_tickets(existing[0], [new_tid])
+            index.record_sent(existing[0], werkbon=wb, phone=phone)
+        else:
+            index.record_sent(new_tid, werkbon=wb, phone=phone)
+            index.record_custom_fields(new_tid, fields)
+
+def process_excel_file(filepath, index):
     df = pd.read_excel(filepath)
-    print(f"📄 Rows in Excel: {len(df)}")
+    log.info(f"Rows in Excel: {len(df)}")
     for _, row in df.iterrows():
-        wb = safe_str(row['Werkbonnummer'])
-        phone = format_phone(row['Mobielnummer'])
-        if not (wb and phone):
-            continue
-
-        # build template params
-        params = [
-            {"type":"body","key":"{{1}}","value":safe_str(row['Naam bewoner'])},
-            {"type":"body","key":"{{2}}","value":safe_str(row['Taaktype'])},
-            {"type":"body","key":"{{3}}","value":safe_str(row['Dag'])},
-            {"type":"body","key":"{{4}}","value":format_date(row['Datum bezoek'])},
-            {"type":"body","key":"{{5}}","value":safe_str(row['Tijdvak'])},
-            {"type":"body","key":"{{6}}","value":safe_str(row['Reparatieduur'])},
-            {"type":"body","key":"{{7}}","value":wb}
-        ]
-
-        existing = ticket_lookup.get(wb, [])
-        # 1 existing → we will merge
-        new_tid = send_new_whatsapp_message(phone, params)
-        if new_tid:
-            set_custom_fields(new_tid, {
-                CUSTOM_FIELDS['locatie']: safe_str(row['Locatie']),
-                CUSTOM_FIELDS['element']: safe_str(row['Element']),
-                CUSTOM_FIELDS['defect']: safe_str(row['Defect']),
-                CUSTOM_FIELDS['werkbonnummer']: wb,
-                CUSTOM_FIELDS['binnen_of_buiten']: safe_str(row['Binnen of buiten'])
-            })
-            if len(existing) == 1:
-                merge_tickets(existing[0], [new_tid])
+        process_row(row, index)
 
 def main():
     missing = [v for v in REQUIRED_ENV_VARS if not os.getenv(v)]
     if missing:
-        print("❌ Missing ENV vars:", missing)
+        log.error(f"Missing ENV vars: {missing}")
         sys.exit(1)
 
-    # 1) fetch lookup
-    lookup = fetch_recent_trengo_tickets()
-    print(f"🔍 Found {sum(len(v) for v in lookup.values())} tickets for {len(lookup)} werkbonnummers")
+    # 1) refresh lookup (newest tickets only, until a known ticket is hit)
+    index = ticket_index.get_index()
+    pages = index.refresh()
+    tickets, werkbons = index.werkbon_count()
+    log.info(f"Index refreshed ({pages} pages): {tickets} tickets for {werkbons} werkbonnummers")
 
     # 2) download Excel
     out = OutlookClient()
     f = out.download_excel_attachment(os.getenv('TEST_EMAIL'), os.getenv('SUBJECT_LINE_PW_BEVESTIGING'))
     if not f:
-        print("📭 No new Excel attachment found")
+        log.info("No new Excel attachment found")
         return
 
     # 3) process & merge logic
     try:
-        process_excel_file(f, lookup)
+        process_excel_file(f, index)
     finally:
         os.remove(f)
-        print("🧹 Deleted", f)
+        log.info(f"Deleted {f}")
 
 if __name__=="__main__":
     main()
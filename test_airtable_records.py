@@ -0,0 +1,111 @@
+import json
+import pytest
+import airtable_records
+
+REQUIRED = ['Naam bewoner', 'Mobielnummer']
+
+@pytest.fixture(autouse=True)
+def quarantine_file(tmp_path, monkeypatch):
+    path = tmp_path / 'airtable.jsonl'
+    monkeypatch.setattr(airtable_records, 'QUARANTINE_FILE', str(path))
+    monkeypatch.setattr(airtable_records, '_quarantined', None)
+    monkeypatch.setattr(airtable_records, '_pending_deletes', {})
+    return path
+
+class FakeResponse:
+    def __init__(self, status, data=None):
+        self.status_code = status
+        self.data = data or {}
+        self.text = json.dumps(self.data)
+
+    def json(self):
+        return self.data
+
+class FakeAirtable:
+    """Stands in for clients.airtable: pages of records and a delete log."""
+
+    def __init__(self, pages, delete_status=200):
+        self.pages = pages
+        self.offsets = []
+        self.deleted = []
+        self.delete_status = delete_status
+
+    def get(self, url, headers=None, params=None):
+        offset = params.get('offset')
+        self.offsets.append(offset)
+        return FakeResponse(200, self.pages[int(offset or 0)])
+
+    def delete(self, url, headers=None, params=None):
+        if self.delete_status != 200:
+            return FakeResponse(self.delete_status, {'error': 'down'})
+        self.deleted.append([rid for _, rid in params])
+        return FakeResponse(200)
+
+def record(record_id, **fields):
+    return {'id': record_id, 'fields': {'Naam bewoner': 'Jansen', 'Mobielnummer': '0612345678', **fields}}
+
+def test_record_decodes_to_plain_strings_and_an_int_taaknummer():
+    reminder = airtable_records.decode_record(
+        record('rec1', Reparatieduur=60, Taaknummer='123.0', Tijdvak=' 08:00 - 12:00 '), REQUIRED)
+    assert reminder.record_id == 'rec1'
+    assert reminder.reparatieduur == '60'
+    assert reminder.taaknummer == 123
+    assert reminder.tijdvak == '08:00 - 12:00'
+    assert reminder.monteur == ''
+
+@pytest.mark.parametrize('bad', [
+    {'id': 'rec1', 'fields': {'Naam bewoner': 'Jansen'}},
+    record('rec1', Taaknummer='onbekend'),
+    {'fields': {}},
+])
+def test_unusable_record_raises(bad):
+    with pytest.raises(airtable_records.RecordError):
+        airtable_records.decode_record(bad, REQUIRED)
+
+def test_bad_records_are_quarantined_and_the_rest_decoded(quarantine_file):
+    page = {'records': [record('rec1'), {'id': 'rec2', 'fields': {}}]}
+    reminders, quarantined = airtable_records.decode_page(page, REQUIRED, 'T')
+    assert [r.record_id for r in reminders] == ['rec1']
+    assert quarantined == 1
+    entry = json.loads(quarantine_file.read_text())
+    assert (entry['table'], entry['id']) == ('T', 'rec2')
+
+def test_a_record_is_quarantined_once_across_ticks_and_restarts(quarantine_file, monkeypatch):
+    page = {'records': [{'id': 'rec2', 'fields': {}}]}
+    for _ in range(3):
+        airtable_records.decode_page(page, REQUIRED, 'T')
+    # A new process reads the ids already quarantined from the file
+    monkeypatch.setattr(airtable_records, '_quarantined', None)
+    airtable_records.decode_page(page, REQUIRED, 'T')
+    airtable_records.decode_page(page, REQUIRED, 'Andere tabel')
+    lines = quarantine_file.read_text().splitlines()
+    assert [(json.loads(l)['table'], json.loads(l)['id']) for l in lines] == [('T', 'rec2'), ('Andere tabel', 'rec2')]
+
+def test_fetch_follows_the_offset_cursor(monkeypatch):
+    fake = FakeAirtable([
+        {'records': [record('rec1')], 'offset': '1'},
+        {'records': [record('rec2'), {'id': 'rec3', 'fields': {}}]},
+    ])
+    monkeypatch.setattr(airtable_records.clients, 'airtable', fake)
+    reminders, quarantined = airtable_records.fetch_reminders('https://api.airtable.com/v0/base/T', {}, REQUIRED, 'T')
+    assert [r.record_id for r in reminders] == ['rec1', 'rec2']
+    assert quarantined == 1
+    assert fake.offsets == [None, '1']
+
+def test_deletes_go_out_in_batches_of_ten(monkeypatch):
+    fake = FakeAirtable([])
+    monkeypatch.setattr(airtable_records.clients, 'airtable', fake)
+    for i in range(23):
+        airtable_records.queue_delete('https://api.airtable.com/v0/base/T', {}, f"rec{i}")
+    assert [len(batch) for batch in fake.deleted] == [10, 10]
+    assert airtable_records.flush_deletes() == 3
+    assert [len(batch) for batch in fake.deleted] == [10, 10, 3]
+
+def test_failed_deletes_stay_queued_for_the_next_flush(monkeypatch):
+    fake = FakeAirtable([], delete_status=503)
+    monkeypatch.setattr(airtable_records.clients, 'airtable', fake)
+    airtable_records.queue_delete('https://api.airtable.com/v0/base/T', {}, 'rec1')
+    assert airtable_records.flush_deletes() == 0
+    fake.delete_status = 200
+    assert airtable_records.flush_deletes() == 1
+    assert fake.deleted == [['rec1']]
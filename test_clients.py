@@ -0,0 +1,98 @@
+import time
+import threading
+import pytest
+import clients
+
+def failing_breaker(threshold=3, reset_timeout=60.0):
+    breaker = clients.CircuitBreaker('test', failure_threshold=threshold, reset_timeout=reset_timeout)
+    for _ in range(threshold):
+        breaker.before_call()
+        breaker.record_failure()
+    return breaker
+
+def expire(breaker):
+    # Pretend the reset timeout has passed without sleeping
+    breaker.opened_at -= breaker.reset_timeout
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = clients.CircuitBreaker('test', failure_threshold=3)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == 'closed'
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert breaker.trips == 1
+
+def test_success_resets_the_failure_count():
+    breaker = clients.CircuitBreaker('test', failure_threshold=3)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+
+def test_open_breaker_fails_fast_with_retry_after():
+    breaker = failing_breaker(reset_timeout=60.0)
+    with pytest.raises(clients.CircuitOpenError) as info:
+        breaker.before_call()
+    assert 0 < info.value.retry_after <= 60.0
+
+def test_half_open_lets_one_probe_through():
+    breaker = failing_breaker()
+    expire(breaker)
+    breaker.before_call()
+    assert breaker.state == 'half_open'
+    with pytest.raises(clients.CircuitOpenError):
+        breaker.before_call()
+
+def test_successful_probe_closes_the_circuit():
+    breaker = failing_breaker()
+    expire(breaker)
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    breaker.before_call()
+
+def test_failed_probe_reopens_the_circuit():
+    breaker = failing_breaker()
+    expire(breaker)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert breaker.trips == 2
+    with pytest.raises(clients.CircuitOpenError):
+        breaker.before_call()
+
+def test_released_probe_lets_the_next_caller_probe():
+    breaker = failing_breaker()
+    expire(breaker)
+    breaker.before_call()
+    breaker.release_probe()
+    breaker.before_call()
+    assert breaker.state == 'half_open'
+
+def test_rate_limiter_serves_the_higher_priority_first():
+    limiter = clients.RateLimiter(rate=5, per=1.0)
+    limiter.tokens = 0
+    order = []
+
+    def take(level):
+        with clients.priority(level):
+            limiter.acquire()
+        order.append(level)
+
+    low = threading.Thread(target=take, args=(1,))
+    high = threading.Thread(target=take, args=(8,))
+    low.start()
+    time.sleep(0.05)
+    high.start()
+    low.join(5)
+    high.join(5)
+    assert order == [8, 1]
+
+def test_priority_is_restored_after_the_block():
+    with clients.priority(8):
+        with clients.priority(4):
+            assert clients.current_priority() == 4
+        assert clients.current_priority() == 8
+    assert clients.current_priority() == 0
@@ -0,0 +1,43 @@
+import coalesce
+
+MERGE_FIELDS = ['werkbonnummer', 'defect']
+
+def row(phone, werkbon, defect, datum='2026-10-20', reparatieduur=30):
+    return {'mobielnummer': phone, 'werkbonnummer': werkbon, 'defect': defect,
+            'datum': datum, 'tijdvak': '08:00 - 12:00', 'reparatieduur': reparatieduur, 'naam': 'Jansen'}
+
+def group(rows):
+    return coalesce.group_by_resident(rows, MERGE_FIELDS, keep_separate=('datum', 'tijdvak'),
+                                      sum_fields=['reparatieduur'])
+
+def test_rows_of_one_resident_become_one_message():
+    merged = group([row('0612345678', 'WB1', 'Lekkage'), row('+31612345678', 'WB2.0', 'Kozijn')])
+    assert len(merged) == 1
+    assert merged[0]['werkbonnummer'] == 'WB1, WB2.0'
+    assert merged[0]['defect'] == 'Lekkage, Kozijn'
+    assert merged[0]['naam'] == 'Jansen'
+
+def test_durations_of_merged_rows_are_added_up():
+    merged = group([row('0612345678', 'WB1', 'Lekkage', reparatieduur=30.0),
+                    row('0612345678', 'WB2', 'Kozijn', reparatieduur='45')])
+    assert merged[0]['reparatieduur'] == '75'
+
+def test_non_numeric_durations_are_joined():
+    assert coalesce.sum_values(['1 uur', 30, None]) == '1 uur, 30'
+
+def test_other_appointments_stay_separate():
+    merged = group([row('0612345678', 'WB1', 'Lekkage'),
+                    row('0612345678', 'WB2', 'Kozijn', datum='2026-10-21')])
+    assert [m['werkbonnummer'] for m in merged] == ['WB1', 'WB2']
+
+def test_rows_without_phone_are_never_merged():
+    merged = group([row(None, 'WB1', 'Lekkage'), row(None, 'WB2', 'Kozijn')])
+    assert len(merged) == 2
+
+def test_single_row_is_left_alone():
+    merged = group([row('0612345678', 'WB1', 'Lekkage', reparatieduur=30.0)])
+    assert merged[0]['reparatieduur'] == 30.0
+
+def test_join_drops_duplicates_and_empty_values():
+    assert coalesce.join_values(['A', 'nan', None, 'B', 'A', 3.0]) == 'A, B, 3'
+    assert coalesce.split_values('A, B,3') == ['A', 'B', '3']
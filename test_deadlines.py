@@ -0,0 +1,41 @@
+import time
+from datetime import datetime, date, time as dtime, timezone
+import deadlines
+
+def test_parse_time_reads_the_start_of_a_tijdvak():
+    assert deadlines.parse_time('08:30') == dtime(8, 30)
+    assert deadlines.parse_time('8.30') == dtime(8, 30)
+    assert deadlines.parse_time('13:00 - 17:00') == dtime(13, 0)
+    assert deadlines.parse_time('25:00') is None
+    assert deadlines.parse_time('ochtend') is None
+
+def test_parse_date_accepts_workbook_and_airtable_formats():
+    assert deadlines.parse_date('2026-10-20') == date(2026, 10, 20)
+    assert deadlines.parse_date('20-10-2026') == date(2026, 10, 20)
+    assert deadlines.parse_date(datetime(2026, 10, 20, 9)) == date(2026, 10, 20)
+    assert deadlines.parse_date('NaT') is None
+
+def test_deadline_is_start_minus_margin_in_dutch_time():
+    # 08:00 in Amsterdam is 06:00 UTC in summer time
+    deadline = deadlines.row_deadline('2026-07-01', '08:00 - 12:00', margin_minutes=10)
+    assert deadline == datetime(2026, 7, 1, 5, 50, tzinfo=timezone.utc).timestamp()
+
+def test_deadline_follows_the_switch_to_winter_time():
+    # 08:00 in Amsterdam is 07:00 UTC after the last Sunday of October
+    deadline = deadlines.row_deadline('2026-10-26', '08:00', margin_minutes=0)
+    assert deadline == datetime(2026, 10, 26, 7, 0, tzinfo=timezone.utc).timestamp()
+
+def test_deadline_uses_the_default_time_without_a_usable_time():
+    assert deadlines.row_deadline('2026-10-26', 'ochtend', margin_minutes=0) == \
+        deadlines.row_deadline('2026-10-26', deadlines.DEADLINE_DEFAULT_TIME, margin_minutes=0)
+    assert deadlines.row_deadline(None, '08:00') is None
+
+def test_earliest_and_expired():
+    assert deadlines.earliest(None, 20, 10) == 10
+    assert deadlines.earliest(None, None) is None
+    assert deadlines.expired(time.time() - 1)
+    assert not deadlines.expired(time.time() + 60)
+    assert not deadlines.expired(None)
+
+def test_rows_without_deadline_sort_last():
+    assert sorted([None, 20, 10], key=deadlines.sort_key) == [10, 20, None]
@@ -0,0 +1,113 @@
+import pytest
+import requests
+import ledger
+import ticket_index
+
+@pytest.fixture
+def send_ledger(tmp_path, monkeypatch):
+    instance = ledger.SendLedger(str(tmp_path / 'ledger.sqlite'))
+    monkeypatch.setattr(ledger, '_ledger', instance)
+    return instance
+
+def key(reference='WB1', phone='0612345678'):
+    return ledger.message_key('Bevestiging', 42, phone, reference, '2026-10-20')
+
+def test_phone_formats_share_one_key():
+    assert key(phone='0612345678') == key(phone='+31612345678') == key(phone='31612345678')
+
+def test_unsent_message_is_not_skipped(send_ledger):
+    assert not ledger.already_sent(key())
+    assert ledger.unfinished_ticket(key()) is None
+
+def test_message_with_unwritten_fields_resumes_on_its_ticket(send_ledger):
+    ledger.record_sent(key(), ticket_id=7, completed=False)
+    assert not ledger.already_sent(key())
+    assert ledger.unfinished_ticket(key()) == 7
+    ledger.record_completed(key())
+    assert ledger.already_sent(key())
+    assert ledger.unfinished_ticket(key()) is None
+
+def test_unfinished_message_without_ticket_is_not_sent_again(send_ledger):
+    ledger.record_sent(key(), ticket_id=None, completed=False)
+    assert ledger.already_sent(key())
+
+def test_ledger_survives_a_restart(tmp_path, send_ledger):
+    ledger.record_sent(key(), ticket_id=7, completed=False)
+    reopened = ledger.SendLedger(str(tmp_path / 'ledger.sqlite'))
+    assert reopened.unfinished_ticket(key()) == 7
+
+def test_expired_entries_are_purged(send_ledger):
+    send_ledger.record(key(), ticket_id=7)
+    send_ledger.ttl = -send_ledger.ttl
+    assert send_ledger.lookup(key()) is None
+    assert send_ledger.purge() == 1
+
+class FakeResponse:
+    def __init__(self, status, data=None):
+        self.status_code = status
+        self.data = data or {}
+        self.text = str(self.data)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code}", response=self)
+
+    def json(self):
+        return self.data
+
+class FakeTrengo:
+    """Stands in for clients.trengo; custom field calls fail while `down` is set."""
+
+    def __init__(self):
+        self.sessions = 0
+        self.fields = []
+        self.down = False
+
+    def post(self, url, json=None, **kwargs):
+        if url.endswith('/wa_sessions'):
+            self.sessions += 1
+            return FakeResponse(200, {'message': {'ticket_id': 500 + self.sessions}})
+        if self.down:
+            return FakeResponse(503)
+        self.fields.append((url, json['custom_field_id']))
+        return FakeResponse(200)
+
+def test_interrupted_send_finishes_its_fields_without_a_second_message(send_ledger, tmp_path, monkeypatch):
+    import PreWonenBevestiging as pipeline
+    trengo = FakeTrengo()
+    monkeypatch.setattr(pipeline.clients, 'trengo', trengo)
+    monkeypatch.setattr(pipeline.ticket_index, '_index', ticket_index.TicketIndex(str(tmp_path / 'index.sqlite')))
+    monkeypatch.setenv('TRENGO_API_KEY', 'test')
+    monkeypatch.setenv('WHATSAPP_TEMPLATE_ID_PW_BEVESTIGING', '42')
+    row = dict(naam_bewoner='Jansen', taaktype='Reparatie', dag='maandag', datum='2026-10-20',
+               tijdvak='08:00 - 12:00', reparatieduur='60', dp_nummer='DP1', mobielnummer='0612345678',
+               locatie='Keuken', element='Kraan', defect='Lekt', werkbonnummer='WB1', binnen_of_buiten='Binnen')
+
+    trengo.down = True
+    with pytest.raises(requests.exceptions.HTTPError):
+        pipeline.send_whatsapp_message(**row)
+    trengo.down = False
+    pipeline.send_whatsapp_message(**row)
+    pipeline.send_whatsapp_message(**row)
+
+    assert trengo.sessions == 1
+    assert {url for url, _ in trengo.fields} == {'https://app.trengo.com/api/v2/tickets/501/custom_fields'}
+    assert len(trengo.fields) == len(pipeline.CUSTOM_FIELDS)
+
+def test_coalesced_message_has_one_key_per_werkbon_in_sorted_order():
+    keys = ledger.message_keys('Bevestiging', 42, '0612345678', 'WB2, WB1', '2026-10-20')
+    assert keys == [key('WB1'), key('WB2')]
+    assert keys == ledger.message_keys('Bevestiging', 42, '0612345678', 'WB1,WB2', '2026-10-20')
+
+def test_coalesced_message_is_sent_again_only_for_a_new_werkbon(send_ledger):
+    ledger.record_sent(ledger.message_keys('Bevestiging', 42, '0612345678', 'WB1, WB2', '2026-10-20'), 7)
+    assert ledger.already_sent(ledger.message_keys('Bevestiging', 42, '0612345678', 'WB2, WB1', '2026-10-20'))
+    assert not ledger.already_sent(ledger.message_keys('Bevestiging', 42, '0612345678', 'WB1, WB3', '2026-10-20'))
+
+def test_interrupted_coalesced_send_resumes_only_for_the_same_werkbons(send_ledger):
+    interrupted = ledger.message_keys('Bevestiging', 42, '0612345678', 'WB1, WB2', '2026-10-20')
+    ledger.record_sent(interrupted, 7, completed=False)
+    assert ledger.unfinished_ticket(ledger.message_keys('Bevestiging', 42, '0612345678', 'WB2, WB1', '2026-10-20')) == 7
+    later = ledger.message_keys('Bevestiging', 42, '0612345678', 'WB1, WB3', '2026-10-20')
+    assert not ledger.already_sent(later)
+    assert ledger.unfinished_ticket(later) is None
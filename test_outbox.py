@@ -0,0 +1,125 @@
+import requests
+import pytest
+import clients
+import outbox
+
+@pytest.fixture
+def box(tmp_path, monkeypatch):
+    for pipeline, priority_class in (('Herinnering', 'reminder'), ('Feedback', 'feedback')):
+        monkeypatch.setitem(outbox._handlers, pipeline, lambda **payload: None)
+        monkeypatch.setitem(outbox._classes, pipeline, priority_class)
+    return outbox.Outbox(str(tmp_path / 'outbox.sqlite'))
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.exceptions.HTTPError(f"{status}", response=response)
+
+def test_claim_marks_the_message_sending(box):
+    box.enqueue_many('Herinnering', [{'naam': 'a'}])
+    message_id, pipeline, payload, attempts, deadline = box.claim()
+    assert (pipeline, payload, attempts, deadline) == ('Herinnering', {'naam': 'a'}, 0, None)
+    assert box.counts() == {'sending': 1}
+    assert box.claim() is None
+
+def test_recover_requeues_interrupted_messages(box):
+    box.enqueue_many('Herinnering', [{'naam': 'a'}])
+    box.claim()
+    assert box.recover() == 1
+    assert box.claim()[2] == {'naam': 'a'}
+
+def test_deliver_one_sends_through_the_registered_handler(box, monkeypatch):
+    received = []
+    monkeypatch.setitem(outbox._handlers, 'Herinnering', lambda **payload: received.append(payload))
+    box.enqueue_many('Herinnering', [{'naam': 'a'}])
+    assert box.deliver_one() == 'sent'
+    assert received == [{'naam': 'a'}]
+    assert box.counts() == {'sent': 1}
+
+def test_deliver_one_retries_server_errors_and_gives_up_on_client_errors(box, monkeypatch):
+    def server_error(**payload):
+        raise http_error(503)
+    def client_error(**payload):
+        raise http_error(400)
+    monkeypatch.setitem(outbox._handlers, 'Herinnering', server_error)
+    monkeypatch.setitem(outbox._handlers, 'Feedback', client_error)
+    box.enqueue_many('Herinnering', [{'naam': 'a'}])
+    box.enqueue_many('Feedback', [{'naam': 'b'}])
+    assert sorted([box.deliver_one(), box.deliver_one()]) == ['failed', 'retry']
+    assert box.counts() == {'pending': 1, 'failed': 1}
+
+def test_retry_waits_with_exponential_backoff(box, monkeypatch):
+    monkeypatch.setattr(outbox, 'OUTBOX_BACKOFF_SECONDS', 30)
+    monkeypatch.setattr(outbox, 'OUTBOX_BACKOFF_MAX_SECONDS', 100)
+    assert [outbox.backoff_delay(n) for n in (1, 2, 3, 4)] == [30, 60, 100, 100]
+    box.enqueue_many('Herinnering', [{'naam': 'a'}])
+    message_id, _, _, attempts, _ = box.claim()
+    assert box.mark_failed(message_id, attempts + 1, 'timeout')
+    assert box.claim() is None
+
+def test_gives_up_after_the_maximum_attempts(box, monkeypatch):
+    monkeypatch.setattr(outbox, 'OUTBOX_MAX_ATTEMPTS', 2)
+    box.enqueue_many('Herinnering', [{'naam': 'a'}])
+    message_id = box.claim()[0]
+    assert not box.mark_failed(message_id, 2, 'timeout')
+    assert box.counts() == {'failed': 1}
+
+def test_drain_delivers_every_due_message_with_worker_threads(box, monkeypatch):
+    received = []
+    monkeypatch.setitem(outbox._handlers, 'Herinnering', lambda **payload: received.append(payload['n']))
+    box.enqueue_many('Herinnering', [{'n': i} for i in range(20)])
+    stats = box.drain(pipelines=['Herinnering'], workers=4)
+    assert stats['sent'] == 20
+    assert sorted(received) == list(range(20))
+
+def test_deliver_one_defers_while_the_circuit_is_open(box, monkeypatch):
+    def circuit_open(**payload):
+        raise clients.CircuitOpenError('trengo', 30)
+    monkeypatch.setitem(outbox._handlers, 'Herinnering', circuit_open)
+    box.enqueue_many('Herinnering', [{'naam': 'a'}])
+    assert box.deliver_one() == 'deferred'
+    assert box.counts() == {'pending': 1}
+    # Not due again until the breaker's retry_after has passed
+    assert box.claim() is None
+
+def test_claim_takes_the_earliest_deadline_first(box):
+    box.enqueue_many('Herinnering', [{'naam': 'geen'}, {'naam': 'laat'}, {'naam': 'vroeg'}],
+                     due=[None, 2e9, 1.9e9])
+    assert [box.claim()[2]['naam'] for _ in range(3)] == ['vroeg', 'laat', 'geen']
+
+def test_deliver_one_expires_a_message_past_its_deadline(box, tmp_path, monkeypatch):
+    monkeypatch.setattr(outbox.deadlines, 'EXPIRED_REPORT_FILE', str(tmp_path / 'expired.jsonl'))
+    box.enqueue_many('Herinnering', [{'naam': 'a'}], due=[1.0])
+    assert box.deliver_one() == 'expired'
+    assert box.counts() == {'expired': 1}
+    assert (tmp_path / 'expired.jsonl').read_text().count('\n') == 1
+
+def test_weighted_round_robin_follows_the_class_weights(box, monkeypatch):
+    monkeypatch.setattr(outbox, 'CLASS_WEIGHTS', {'reminder': 3, 'feedback': 1})
+    box.enqueue_many('Herinnering', [{'n': i} for i in range(20)])
+    box.enqueue_many('Feedback', [{'n': i} for i in range(20)])
+    served = [box.claim()[1] for _ in range(8)]
+    assert served.count('Herinnering') == 6
+    assert served.count('Feedback') == 2
+
+def test_low_priority_class_waits_while_the_backlog_is_large(box, monkeypatch):
+    monkeypatch.setattr(outbox, 'OUTBOX_SHED_BACKLOG', 2)
+    monkeypatch.setattr(outbox, 'OUTBOX_SHED_CLASSES', ['feedback'])
+    box.enqueue_many('Herinnering', [{'n': i} for i in range(4)])
+    box.enqueue_many('Feedback', [{'n': 0}])
+    served = [box.claim()[1] for _ in range(3)]
+    assert served == ['Herinnering'] * 3
+    assert box.shed_count == 2
+    # Backlog down to one reminder: feedback gets its turn again
+    assert {box.claim()[1], box.claim()[1]} == {'Herinnering', 'Feedback'}
+
+def test_handler_calls_carry_the_priority_of_their_class(box, monkeypatch):
+    monkeypatch.setattr(outbox, 'CLASS_WEIGHTS', {'reminder': 8, 'feedback': 1})
+    seen = []
+    monkeypatch.setitem(outbox._handlers, 'Herinnering', lambda **payload: seen.append(clients.current_priority()))
+    monkeypatch.setitem(outbox._handlers, 'Feedback', lambda **payload: seen.append(clients.current_priority()))
+    box.enqueue_many('Feedback', [{'n': 0}])
+    box.enqueue_many('Herinnering', [{'n': 0}])
+    box.deliver_one()
+    box.deliver_one()
+    assert seen == [8, 1]
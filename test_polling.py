@@ -0,0 +1,56 @@
+import pytest
+import polling
+
+def poller(**kwargs):
+    return polling.AdaptivePoller('test', min_interval=60, max_interval=600, backoff=2.0, jitter=0, **kwargs)
+
+def test_empty_polls_back_off_up_to_the_maximum():
+    p = poller()
+    intervals = []
+    for _ in range(6):
+        p.record(False)
+        intervals.append(p.interval)
+    assert intervals == [120, 240, 480, 600, 600, 600]
+
+def test_a_hit_resets_to_the_minimum_interval():
+    p = poller()
+    for _ in range(4):
+        p.record(False)
+    p.record(True)
+    assert p.interval == 60
+    assert p.next_delay() == 60
+    assert (p.polls, p.hits, p.hit_rate) == (5, 1, 0.2)
+
+def test_jitter_stays_within_the_interval_bounds():
+    p = polling.AdaptivePoller('test', min_interval=60, max_interval=600, jitter=0.5)
+    delays = [p.next_delay() for _ in range(200)]
+    assert min(delays) >= 60
+    p.interval = 600
+    assert max(p.next_delay() for _ in range(200)) <= 600
+
+class FakeScheduler:
+    def __init__(self):
+        self.jobs = {}
+        self.next_run = {}
+
+    def add_job(self, func, trigger, seconds, id, **kwargs):
+        self.jobs[id] = (func, seconds)
+
+    def modify_job(self, job_id, next_run_time):
+        self.next_run[job_id] = next_run_time
+
+def test_adaptive_job_reschedules_after_a_failed_run():
+    scheduler = FakeScheduler()
+    p = poller()
+
+    def fails():
+        p.record(False)
+        raise ConnectionError("mailbox onbereikbaar")
+
+    polling.add_adaptive_job(scheduler, 'test', fails, p)
+    run, max_interval = scheduler.jobs['test']
+    assert max_interval == 600
+    with pytest.raises(ConnectionError):
+        run()
+    assert 'test' in scheduler.next_run
+    assert p.interval == 120
@@ -0,0 +1,134 @@
+import threading
+from datetime import date, timedelta
+import pytest
+import requests
+import airtable_records
+import ledger
+import reminders
+import ticket_index
+import ZZZ_VestedaHerinnering1H as herinnering1h
+
+class FakeResponse:
+    def __init__(self, status, data=None):
+        self.status_code = status
+        self.data = data or {}
+        self.text = str(self.data)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code}", response=self)
+
+    def json(self):
+        return self.data
+
+class FakeTrengo:
+    """Stands in for clients.trengo; answers every message with `status`."""
+
+    def __init__(self, status=200):
+        self.status = status
+        self.sent = []
+
+    def post(self, url, json=None, **kwargs):
+        self.sent.append(json['recipient_phone_number'])
+        return FakeResponse(self.status, {'message': {'ticket_id': 700 + len(self.sent)}})
+
+def reminder(record_id='rec1', days_ahead=2, phone='0612345678'):
+    return airtable_records.Reminder(
+        record_id=record_id, naam_bewoner='Jansen', mobielnummer=phone, monteur='Piet',
+        datum_bezoek=(date.today() + timedelta(days=days_ahead)).isoformat(), dagnaam='maandag',
+        begintijd='08:00', eindtijd='09:00', reparatieduur='60', taaknummer=int(record_id[3:] or 0)
+    )
+
+@pytest.fixture
+def deleted(tmp_path, monkeypatch):
+    monkeypatch.setattr(ledger, '_ledger', ledger.SendLedger(str(tmp_path / 'ledger.sqlite')))
+    monkeypatch.setattr(ticket_index, '_index', ticket_index.TicketIndex(str(tmp_path / 'index.sqlite')))
+    monkeypatch.setenv('TRENGO_API_KEY', 'test')
+    records = []
+    monkeypatch.setattr(herinnering1h, 'delete_airtable_record', records.append)
+    return records
+
+def test_record_is_deleted_after_a_successful_send(deleted, monkeypatch):
+    trengo = FakeTrengo(200)
+    monkeypatch.setattr(herinnering1h.clients, 'trengo', trengo)
+    assert herinnering1h.process_record(reminder('rec1'))
+    assert trengo.sent == ['31612345678']
+    assert deleted == ['rec1']
+
+@pytest.mark.parametrize('status', [429, 503])
+def test_record_stays_in_airtable_when_trengo_refuses(deleted, monkeypatch, status):
+    monkeypatch.setattr(herinnering1h.clients, 'trengo', FakeTrengo(status))
+    with pytest.raises(requests.exceptions.HTTPError):
+        herinnering1h.process_record(reminder('rec1'))
+    assert deleted == []
+    assert not ledger.already_sent(ledger.message_key(
+        herinnering1h.PIPELINE_NAME, herinnering1h.WHATSAPP_TEMPLATE_ID, '0612345678', 1, reminder().datum_bezoek))
+
+def test_record_past_its_deadline_is_deleted_unsent(deleted, tmp_path, monkeypatch):
+    monkeypatch.setattr(herinnering1h.deadlines, 'EXPIRED_REPORT_FILE', str(tmp_path / 'expired.jsonl'))
+    trengo = FakeTrengo(200)
+    monkeypatch.setattr(herinnering1h.clients, 'trengo', trengo)
+    assert not herinnering1h.process_record(reminder('rec1', days_ahead=-1))
+    assert trengo.sent == []
+    assert deleted == ['rec1']
+
+class FakeTable:
+    """Stands in for one ZZZ reminder module: a table to fetch and a send per record."""
+
+    def __init__(self, name, reminders, sent, barrier=None, fails=False):
+        self.PIPELINE_NAME = name
+        self.reminders = reminders
+        self.sent = sent
+        self.barrier = barrier
+        self.fails = fails
+
+    def get_airtable_data(self):
+        if self.barrier:
+            # Only passes when every table is fetched at the same time
+            self.barrier.wait()
+        if self.fails:
+            raise ConnectionError("Airtable onbereikbaar")
+        return list(self.reminders)
+
+    def process_record(self, reminder, run_deadline=None):
+        self.sent.append(reminder.record_id)
+        return True
+
+@pytest.fixture
+def tick(tmp_path, monkeypatch):
+    """Sets the (table, priority) pairs one reminders tick fetches."""
+    monkeypatch.setattr(reminders.jobs, 'LOCK_DIR', str(tmp_path / 'locks'))
+    return lambda *sources: monkeypatch.setattr(reminders, 'REMINDER_SOURCES', list(sources))
+
+def test_tick_fetches_every_table_concurrently(tick):
+    barrier = threading.Barrier(4, timeout=5)
+    sent = []
+    tick(*[(FakeTable(f"T{i}", [reminder(f"rec{i}")], sent, barrier), 0) for i in range(4)])
+    reminders.process_data()
+    assert sorted(sent) == ['rec0', 'rec1', 'rec2', 'rec3']
+
+def test_tick_sends_1h_first_then_earliest_deadline(tick):
+    sent = []
+    tick((FakeTable('Bevestiging4H', [reminder('rec1', days_ahead=1)], sent), 1),
+         (FakeTable('Herinnering1H', [reminder('rec2', days_ahead=3), reminder('rec3', days_ahead=2)], sent), 0))
+    reminders.process_data()
+    assert sent == ['rec3', 'rec2', 'rec1']
+
+def test_tick_sends_the_other_tables_when_one_fetch_fails(tick):
+    sent = []
+    tick((FakeTable('Stuk', [reminder('rec1')], sent, fails=True), 0),
+         (FakeTable('Heel', [reminder('rec2')], sent), 0))
+    reminders.process_data()
+    assert sent == ['rec2']
+
+def test_tick_skips_a_table_a_standalone_run_is_sending(tick):
+    sent = []
+    busy = FakeTable('Bezet', [reminder('rec1')], sent)
+    tick((busy, 0), (FakeTable('Vrij', [reminder('rec2')], sent), 0))
+    lock = reminders.jobs.get_lock('Bezet')
+    assert lock.acquire()
+    try:
+        reminders.process_data()
+    finally:
+        lock.release()
+    assert sent == ['rec2']
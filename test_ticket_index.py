@@ -0,0 +1,178 @@
+import os
+import threading
+import importlib.util
+from urllib.parse import urlparse, parse_qs
+import pytest
+import requests
+import ticket_index
+
+class FakeResponse:
+    def __init__(self, status, data=None):
+        self.status_code = status
+        self.data = data or {}
+        self.text = str(self.data)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code}", response=self)
+
+    def json(self):
+        return self.data
+
+class FakeTrengo:
+    """Stands in for clients.trengo; serves the ticket list newest first, `per_page` tickets a page."""
+
+    max_concurrency = 4
+
+    def __init__(self, tickets, per_page=2):
+        self.tickets = sorted(tickets, key=lambda t: t['id'], reverse=True)
+        self.per_page = per_page
+        self.fetched = []
+        self.posted = []
+        self.failing_pages = set()
+        self._lock = threading.Lock()
+
+    def get(self, url, params=None, **kwargs):
+        page = int((params or {}).get('page') or parse_qs(urlparse(url).query)['page'][0])
+        with self._lock:
+            self.fetched.append(page)
+        if page in self.failing_pages:
+            return FakeResponse(503)
+        last_page = max(1, -(-len(self.tickets) // self.per_page))
+        start = (page - 1) * self.per_page
+        links = {'next': f"https://app.trengo.com/api/v2/tickets?page={page + 1}" if page < last_page else None}
+        return FakeResponse(200, {'data': self.tickets[start:start + self.per_page],
+                                  'links': links, 'meta': {'last_page': last_page}})
+
+    def post(self, url, json=None, **kwargs):
+        self.posted.append((url.replace('https://app.trengo.com/api/v2/', ''), json))
+        if url.endswith('/wa_sessions'):
+            return FakeResponse(200, {'message': {'ticket_id': json.get('ticket_id') or 99}})
+        return FakeResponse(200)
+
+def ticket(ticket_id, werkbon=None, phone=None, status='OPEN'):
+    fields = [{'custom_field_id': ticket_index.WERKBON_FIELD_ID, 'value': werkbon}] if werkbon else []
+    return {'id': ticket_id, 'status': status, 'contact': {'id': 900 + ticket_id, 'phone': phone},
+            'custom_field_values': fields}
+
+@pytest.fixture
+def index(tmp_path):
+    return ticket_index.TicketIndex(str(tmp_path / 'index.sqlite'))
+
+@pytest.fixture
+def trengo(monkeypatch):
+    fake = FakeTrengo([ticket(i, werkbon=f"WB{i}") for i in range(1, 11)])
+    monkeypatch.setattr(ticket_index.clients, 'trengo', fake)
+    monkeypatch.setenv('TRENGO_API_KEY', 'test')
+    return fake
+
+def test_first_refresh_is_a_full_rebuild(index, trengo):
+    assert index.rebuilt_at() is None
+    assert index.refresh() == 5
+    assert index.rebuilt_at() is not None
+    assert index.werkbon_count() == (10, 10)
+
+def test_refresh_stops_at_the_first_page_with_a_known_ticket(index, trengo):
+    index.refresh()
+    trengo.tickets[:0] = [ticket(12, werkbon='WB12'), ticket(11, werkbon='WB11'), ticket(13, werkbon='WB13')]
+    trengo.tickets.sort(key=lambda t: t['id'], reverse=True)
+    trengo.fetched.clear()
+    # Page 1 holds 13 and 12, page 2 holds 11 and the already listed 10
+    assert index.refresh() == 2
+    assert trengo.fetched == [1, 2]
+    assert index.tickets_for_werkbon('WB11') == [11]
+
+def test_tickets_only_sent_to_do_not_stop_a_refresh(index, trengo):
+    index.refresh()
+    trengo.tickets.insert(0, ticket(11, werkbon='WB11'))
+    trengo.tickets.insert(0, ticket(12, werkbon='WB12'))
+    trengo.fetched.clear()
+    # Our own send of ticket 12 is in the index, but not yet as listed
+    index.record_sent(12, werkbon='WB12', phone='0612345678')
+    assert not index.is_known(12)
+    index.refresh()
+    assert trengo.fetched == [1, 2]
+
+def test_an_index_filled_only_by_sends_still_gets_a_full_rebuild(index, trengo):
+    index.record_sent(10, werkbon='WB10', phone='0612345678')
+    assert index.refresh() == 5
+    assert index.werkbon_count() == (10, 10)
+
+def test_lookup_phone_matches_every_dutch_notation(index):
+    index.record_api_tickets([ticket(5, phone='+31612345678')])
+    assert index.lookup_phone('06-12345678')[:2] == (905, 5)
+    assert index.lookup_phone('0031612345678')[:2] == (905, 5)
+
+def test_rebuild_fetches_every_page_once(index, trengo):
+    assert index.rebuild(workers=3) == 5
+    assert sorted(trengo.fetched) == [1, 2, 3, 4, 5]
+    assert index.tickets_for_werkbon('WB1') == [1]
+
+def test_rebuild_with_a_failing_page_is_not_marked_complete(index, trengo):
+    trengo.failing_pages = {3}
+    with pytest.raises(requests.exceptions.HTTPError):
+        index.rebuild(workers=3)
+    assert index.rebuilt_at() is None
+    # The next refresh starts the full rebuild over
+    trengo.failing_pages = set()
+    assert index.refresh() == 5
+    assert index.rebuilt_at() is not None
+
+def test_rebuild_of_a_single_page_starts_no_workers(index, monkeypatch):
+    fake = FakeTrengo([ticket(1, werkbon='WB1')])
+    monkeypatch.setattr(ticket_index.clients, 'trengo', fake)
+    assert index.rebuild() == 1
+    assert fake.fetched == [1]
+
+def test_changed_fields_leaves_out_values_the_ticket_already_has(index):
+    index.record_api_tickets([ticket(5, werkbon='WB5')])
+    index.record_custom_fields(5, {618193: 'Lekkage'})
+    fields = {ticket_index.WERKBON_FIELD_ID: 'WB5', 618193: 'Lekkage', 618192: 'Kraan'}
+    assert index.changed_fields(5, fields) == {618192: 'Kraan'}
+    assert index.changed_fields(6, fields) == fields
+
+def test_open_ticket_is_the_newest_one_not_closed(index):
+    index.record_api_tickets([ticket(5, werkbon='WB1'), ticket(6, werkbon='WB1', status='CLOSED')])
+    assert index.open_ticket_for_werkbon('WB1') == 5
+    # A ticket we just created has no status yet and counts as open
+    index.record_sent(7, werkbon='WB1', phone='0612345678')
+    assert index.open_ticket_for_werkbon('WB1') == 7
+    assert index.open_ticket_for_werkbon('WB2') is None
+
+def load_reuse_pipeline():
+    # test.py shares its name with the standard library's test package
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test.py')
+    spec = importlib.util.spec_from_file_location('trengo_test', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def excel_row(werkbon='WB5', defect='Lekkage'):
+    return {'Werkbonnummer': werkbon, 'Mobielnummer': '0612345678', 'Naam bewoner': 'Jansen',
+            'Taaktype': 'Reparatie', 'Dag': 'maandag', 'Datum bezoek': '2026-10-20', 'Tijdvak': '08:00 - 12:00',
+            'Reparatieduur': '60', 'Locatie': 'Keuken', 'Element': 'Kraan', 'Defect': defect,
+            'Binnen of buiten': 'Binnen'}
+
+def test_follow_up_goes_into_the_open_ticket_with_only_the_changed_fields(index, trengo):
+    pipeline = load_reuse_pipeline()
+    index.record_api_tickets([ticket(5, werkbon='WB5')])
+    index.record_custom_fields(5, {618192: 'Kraan', 618193: 'Lekkage', 618205: 'Binnen', 613776: 'Keuken'})
+
+    pipeline.process_row(excel_row(defect='Kozijn'), index, reuse_tickets=True)
+
+    session, *fields = trengo.posted
+    assert session[0] == 'wa_sessions'
+    assert (session[1]['ticket_id'], session[1]['recipient_phone_number']) == (5, '0612345678')
+    assert fields == [('tickets/5/custom_fields', {'custom_field_id': 618193, 'value': 'Kozijn'})]
+    # The second run finds nothing left to change
+    trengo.posted.clear()
+    pipeline.process_row(excel_row(defect='Kozijn'), index, reuse_tickets=True)
+    assert [url for url, _ in trengo.posted] == ['wa_sessions']
+
+def test_without_reuse_a_new_ticket_is_merged_into_the_existing_one(index, trengo):
+    pipeline = load_reuse_pipeline()
+    index.record_api_tickets([ticket(5, werkbon='WB5')])
+    pipeline.process_row(excel_row(), index, reuse_tickets=False)
+    urls = [url for url, _ in trengo.posted]
+    assert urls[0] == 'wa_sessions' and urls[-1] == 'tickets/5/merge'
+    assert trengo.posted[-1][1] == {'ticket_ids': [99]}
@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta
+import pytest
+import jobs
+import metrics
+import outbox
+import runstats
+import web
+import worker
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, 'LOCK_DIR', str(tmp_path / 'locks'))
+    monkeypatch.setattr(runstats, 'RUNSTATS_FILE', str(tmp_path / 'runs.jsonl'))
+    monkeypatch.setattr(jobs, 'job_timings', {})
+    monkeypatch.setattr(outbox, '_outbox', outbox.Outbox(str(tmp_path / 'outbox.sqlite')))
+    monkeypatch.setattr(worker, 'scheduled', {'TestPipeline': 60})
+    monkeypatch.setattr(web, 'READY_GRACE_SECONDS', 0)
+    monkeypatch.setattr(web, 'STARTED_AT', datetime.now() - timedelta(hours=1))
+    return web.app.test_client()
+
+def run_pipeline(process_data):
+    try:
+        jobs.locked_job('TestPipeline', process_data)()
+    except Exception:
+        pass
+
+def succeeds():
+    pass
+
+def fails():
+    raise ConnectionError("mailbox onbereikbaar")
+
+def test_health_always_answers(client):
+    assert client.get('/health').get_json() == {'status': 'ok'}
+
+def test_ready_after_a_successful_run(client):
+    run_pipeline(succeeds)
+    response = client.get('/ready')
+    assert response.status_code == 200
+    assert response.get_json()['pipelines']['TestPipeline']['overdue'] is False
+
+def test_not_ready_while_every_run_fails(client):
+    run_pipeline(fails)
+    run_pipeline(fails)
+    response = client.get('/ready')
+    assert response.status_code == 503
+    assert response.get_json()['pipelines']['TestPipeline']['overdue'] is True
+    assert jobs.job_timings['TestPipeline']['runs'] == 2
+    assert jobs.job_timings['TestPipeline']['last_success'] is None
+
+def test_metrics_exports_runs_and_counters(client):
+    run_pipeline(succeeds)
+    metrics.count('rows_parsed', 'TestPipeline', 3)
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'pipeline_runs_total{pipeline="TestPipeline"} 1' in text
+    assert 'pipeline_rows_parsed_total{pipeline="TestPipeline"}' in text
+    assert '# TYPE api_request_duration_seconds histogram' in text
+    last_success = next(line for line in text.splitlines()
+                        if line.startswith('pipeline_last_success_timestamp_seconds{pipeline="TestPipeline"}'))
+    assert float(last_success.split()[-1]) > 0
+
+def test_failed_run_leaves_the_last_success_empty(client):
+    run_pipeline(fails)
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'pipeline_last_success_timestamp_seconds{pipeline="TestPipeline"} 0' in text
+
+def test_pipeline_that_cannot_read_its_mailbox_is_not_ready(client, monkeypatch):
+    import VestedaBevestiging
+
+    class UnreachableOutlook:
+        def download_excel_attachment(self, sender_email, subject_line):
+            raise ConnectionError("Graph onbereikbaar")
+
+    monkeypatch.setenv('SENDER_EMAIL', 'planning@example.com')
+    monkeypatch.setenv('SUBJECT_LINE_VES_BEVESTIGING', 'Bevestigingen')
+    monkeypatch.setattr(VestedaBevestiging, 'OutlookClient', UnreachableOutlook)
+    run_pipeline(VestedaBevestiging.process_data)
+    assert client.get('/ready').status_code == 503
@@ -0,0 +1,327 @@
+import os
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import clients
+import jobs
+import logs
+
+log = logs.get_logger(__name__)
+
+# Local index of Trengo tickets: werkbonnummer -> ticket IDs and
+# phone -> contact/ticket, with the last message time per ticket. It is
+# fed by every ticket a pipeline creates, and refreshed from the Trengo
+# ticket list newest-first until a ticket an earlier refresh already
+# listed is hit. Until one full rebuild has completed (recorded in the
+# meta table), a refresh is a full rebuild, so an index filled only by
+# sends or by an interrupted rebuild still gets the whole history.
+# Rebuilt from Trengo when lost, but that is a full scan; see
+# shutdown.check_state_storage for dynos.
+TICKET_INDEX_DB = os.getenv('TICKET_INDEX_DB', 'data/ticket_index.sqlite')
+WERKBON_FIELD_ID = 618194
+PER_PAGE = int(os.getenv('TRENGO_PAGE_SIZE', 25))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tickets (
+    ticket_id INTEGER PRIMARY KEY,
+    contact_id INTEGER,
+    phone TEXT,
+    status TEXT,
+    last_message_at TEXT
+);
+CREATE INDEX IF NOT EXISTS tickets_phone ON tickets (phone);
+CREATE TABLE IF NOT EXISTS werkbon_tickets (
+    werkbon TEXT NOT NULL,
+    ticket_id INTEGER NOT NULL,
+    PRIMARY KEY (werkbon, ticket_id)
+);
+CREATE TABLE IF NOT EXISTS ticket_fields (
+    ticket_id INTEGER NOT NULL,
+    field_id INTEGER NOT NULL,
+    value TEXT,
+    PRIMARY KEY (ticket_id, field_id)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Tickets in these states can receive a follow-up message. Tickets we
+# created ourselves have no status until the next refresh; they count as open.
+OPEN_STATUSES = ('OPEN', 'ASSIGNED')
+
+def trengo_headers():
+    return {
+        "Authorization": f"Bearer {os.getenv('TRENGO_API_KEY')}",
+        "Accept": "application/json"
+    }
+
+def fetch_ticket_page(page, per_page=PER_PAGE):
+    resp = clients.trengo.get(
+        "https://app.trengo.com/api/v2/tickets",
+        headers=trengo_headers(),
+        params={"page": page, "per_page": per_page}
+    )
+    resp.raise_for_status()
+    return resp.json()
+
+def iter_ticket_pages(per_page=PER_PAGE):
+    """Yields (page_number, page_json) of the Trengo ticket list, newest first."""
+    next_url = f"https://app.trengo.com/api/v2/tickets?page=1&per_page={per_page}"
+    page = 1
+    while next_url:
+        resp = clients.trengo.get(next_url, headers=trengo_headers())
+        resp.raise_for_status()
+        data = resp.json()
+        yield page, data
+        next_url = data.get("links", {}).get("next")
+        page += 1
+
+def iter_ticket_pages_parallel(per_page=PER_PAGE, workers=None):
+    """Yields (page_number, page_json) for every page, fetching pages 2..last concurrently.
+
+    The last page number is read from the first response. Pages are yielded as
+    they arrive, not in order; the Trengo rate limiter in clients.py still applies.
+    """
+    first = fetch_ticket_page(1, per_page)
+    yield 1, first
+    last_page = int(first.get("meta", {}).get("last_page") or 1)
+    if last_page < 2:
+        return
+
+    workers = workers or clients.trengo.max_concurrency
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(jobs.bind(fetch_ticket_page), page, per_page): page for page in range(2, last_page + 1)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+def normalize_phone(phone):
+    """Digits only, Dutch numbers with country code, so 06..., +316... and 316... match."""
+    if not phone:
+        return None
+    digits = ''.join(filter(str.isdigit, str(phone)))
+    if digits.startswith('00'):
+        digits = digits[2:]
+    elif digits.startswith('0'):
+        digits = '31' + digits[1:]
+    return digits or None
+
+def ticket_werkbons(ticket):
+    """Werkbonnummers in the ticket's custom field; a coalesced message carries "WB1, WB2"."""
+    for f in ticket.get("custom_field_values", []):
+        if str(f.get("custom_field_id")) == str(WERKBON_FIELD_ID):
+            werkbons = [wb.strip() for wb in str(f.get("value", "")).split(',') if wb.strip()]
+            if werkbons:
+                return werkbons
+    return []
+
+class TicketIndex:
+    def __init__(self, path=TICKET_INDEX_DB):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.executescript(SCHEMA)
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(tickets)")]
+            if 'listed' not in columns:
+                # 1 once the ticket was seen in the Trengo ticket list
+                self._conn.execute("ALTER TABLE tickets ADD COLUMN listed INTEGER NOT NULL DEFAULT 0")
+
+    def record_ticket(self, ticket_id, werkbon=None, phone=None, contact_id=None, status=None,
+                      last_message_at=None):
+        """Adds or updates a ticket; fields left as None keep their stored value."""
+        if not ticket_id:
+            return
+        with self._lock, self._conn:
+            self._conn.execute(
+                """INSERT INTO tickets (ticket_id, contact_id, phone, status, last_message_at)
+                   VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT (ticket_id) DO UPDATE SET
+                       contact_id = COALESCE(excluded.contact_id, contact_id),
+                       phone = COALESCE(excluded.phone, phone),
+                       status = COALESCE(excluded.status, status),
+                       last_message_at = COALESCE(excluded.last_message_at, last_message_at)""",
+                (int(ticket_id), contact_id, normalize_phone(phone), status, last_message_at)
+            )
+            if werkbon:
+                # A message for a coalesced resident carries "WB1, WB2"
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO werkbon_tickets (werkbon, ticket_id) VALUES (?, ?)",
+                    [(wb.strip(), int(ticket_id)) for wb in str(werkbon).split(',') if wb.strip()]
+                )
+
+    def record_sent(self, ticket_id, werkbon=None, phone=None):
+        """Records a ticket a pipeline just created or messaged."""
+        self.record_ticket(ticket_id, werkbon=werkbon, phone=phone,
+                           last_message_at=datetime.now().isoformat(timespec='seconds'))
+
+    def record_api_tickets(self, tickets):
+        """Stores one page of API tickets in a single transaction."""
+        ticket_rows = []
+        werkbon_rows = []
+        field_rows = []
+        for ticket in tickets:
+            contact = ticket.get("contact") or {}
+            ticket_rows.append((
+                int(ticket["id"]),
+                contact.get("id"),
+                normalize_phone(contact.get("phone")),
+                ticket.get("status"),
+                ticket.get("last_message_at") or ticket.get("updated_at")
+            ))
+            werkbon_rows.extend((wb, int(ticket["id"])) for wb in ticket_werkbons(ticket))
+            for f in ticket.get("custom_field_values", []):
+                field_rows.append((int(ticket["id"]), int(f.get("custom_field_id")), str(f.get("value", ""))))
+        with self._lock, self._conn:
+            self._conn.executemany(
+                """INSERT OR REPLACE INTO tickets (ticket_id, contact_id, phone, status, last_message_at, listed)
+                   VALUES (?, ?, ?, ?, ?, 1)""",
+                ticket_rows
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO werkbon_tickets (werkbon, ticket_id) VALUES (?, ?)",
+                werkbon_rows
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO ticket_fields (ticket_id, field_id, value) VALUES (?, ?, ?)",
+                field_rows
+            )
+
+    def record_custom_fields(self, ticket_id, fields):
+        """Remembers custom field values just written to a ticket ({field_id: value})."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO ticket_fields (ticket_id, field_id, value) VALUES (?, ?, ?)",
+                [(int(ticket_id), int(fid), str(value)) for fid, value in fields.items()]
+            )
+
+    def custom_fields(self, ticket_id):
+        """Returns the last known custom field values of a ticket as {field_id: value}."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT field_id, value FROM ticket_fields WHERE ticket_id = ?", (int(ticket_id),)
+            ).fetchall()
+        return {fid: value for fid, value in rows}
+
+    def changed_fields(self, ticket_id, fields):
+        """Returns only the fields whose value differs from what the ticket already has."""
+        known = self.custom_fields(ticket_id)
+        return {fid: value for fid, value in fields.items() if known.get(int(fid)) != str(value)}
+
+    def is_known(self, ticket_id):
+        """True if an earlier refresh or rebuild listed the ticket; our own sends do not count."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM tickets WHERE ticket_id = ? AND listed = 1", (int(ticket_id),)
+            ).fetchone()
+        return row is not None
+
+    def is_empty(self):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM tickets LIMIT 1").fetchone() is None
+
+    def rebuilt_at(self):
+        """When the last full rebuild completed, or None if none has."""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'rebuilt_at'").fetchone()
+        return row[0] if row else None
+
+    def tickets_for_werkbon(self, werkbon):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT ticket_id FROM werkbon_tickets WHERE werkbon = ? ORDER BY ticket_id",
+                (str(werkbon).strip(),)
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def open_ticket_for_werkbon(self, werkbon):
+        """Returns the newest open ticket for a werkbonnummer, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                f"""SELECT t.ticket_id FROM werkbon_tickets w JOIN tickets t ON t.ticket_id = w.ticket_id
+                    WHERE w.werkbon = ? AND (t.status IS NULL OR t.status IN ({','.join('?' * len(OPEN_STATUSES))}))
+                    ORDER BY t.ticket_id DESC LIMIT 1""",
+                (str(werkbon).strip(), *OPEN_STATUSES)
+            ).fetchone()
+        return row[0] if row else None
+
+    def lookup_phone(self, phone):
+        """Returns (contact_id, ticket_id, last_message_at) of the newest ticket for a phone number."""
+        with self._lock:
+            return self._conn.execute(
+                """SELECT contact_id, ticket_id, last_message_at FROM tickets
+                   WHERE phone = ? ORDER BY ticket_id DESC LIMIT 1""",
+                (normalize_phone(phone),)
+            ).fetchone()
+
+    def werkbon_count(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT werkbon) FROM werkbon_tickets"
+            ).fetchone()
+
+    def rebuild(self, workers=None):
+        """Full rescan of all Trengo tickets with parallel page fetching; returns pages fetched."""
+        pages = 0
+        for page, data in iter_ticket_pages_parallel(workers=workers):
+            self.record_api_tickets(data.get("data", []))
+            pages += 1
+            if pages % 50 == 0:
+                log.info(f"Ticket index: {pages} pagina's verwerkt")
+        # Only a rebuild that got through every page counts as complete
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('rebuilt_at', ?)",
+                (datetime.now().isoformat(timespec='seconds'),)
+            )
+        return pages
+
+    def refresh(self, max_pages=None):
+        """Pages through Trengo newest-first and stops at the first page with a known ticket.
+
+        Until a full rebuild has completed this is a full (parallel) rebuild.
+        Returns the number of pages fetched.
+        """
+        if self.rebuilt_at() is None:
+            return self.rebuild()
+
+        pages = 0
+        for page, data in iter_ticket_pages():
+            pages += 1
+            tickets = data.get("data", [])
+            hit_known = any(self.is_known(ticket["id"]) for ticket in tickets)
+            self.record_api_tickets(tickets)
+            if hit_known or (max_pages and pages >= max_pages):
+                break
+        return pages
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_index():
+    """Returns the process-wide ticket index."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = TicketIndex()
+        return _index
+
+def record_sent(ticket_id, werkbon=None, phone=None):
+    """Feeds a newly created or messaged ticket into the index; never fails the send."""
+    try:
+        get_index().record_sent(ticket_id, werkbon=werkbon, phone=phone)
+    except Exception as e:
+        log.warning(f"Waarschuwing: ticket {ticket_id} niet in index opgeslagen: {str(e)}")
+
+if __name__ == "__main__":
+    # python ticket_index.py rebuild  -> full parallel rescan of all tickets
+    index = get_index()
+    if sys.argv[1:] == ['rebuild']:
+        pages = index.rebuild()
+    else:
+        pages = index.refresh()
+    tickets, werkbons = index.werkbon_count()
+    log.info(f"Ticket index bijgewerkt ({pages} pagina's): {tickets} tickets voor {werkbons} werkbonnummers")
@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+# Span tracing: one trace per pipeline run (jobs.locked_job), a span per
+# row and stage, and a child span per HTTP call (clients.ServiceClient), so
+# a slow row shows whether the time went to a token refresh, the limiter,
+# wa_sessions or the custom_fields posts. Spans outside a run are not
+# recorded. When TRACING is on, each finished run is appended to TRACE_FILE
+# as one OTLP/JSON ExportTraceServiceRequest per line, the format of the
+# OpenTelemetry file exporter, so no collector is needed to load it later.
+TRACING = os.getenv('TRACING', '0').lower() not in {'0', 'false', 'no', 'off'}
+TRACE_FILE = os.getenv('TRACE_FILE', 'traces/traces.jsonl')
+SERVICE_NAME = os.getenv('TRACE_SERVICE_NAME', 'trengotest')
+
+# OTLP span kinds and status codes
+KIND_INTERNAL = 1
+KIND_CLIENT = 3
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_current = threading.local()
+_pending = {}
+_pending_lock = threading.Lock()
+_write_lock = threading.Lock()
+
+class Span:
+    def __init__(self, name, trace_id, parent_id=None, kind=KIND_INTERNAL, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.status = STATUS_OK
+        self.status_message = ''
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def error(self, message):
+        self.status = STATUS_ERROR
+        self.status_message = message
+
+    def to_otlp(self):
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': [_attribute(k, v) for k, v in self.attributes.items() if v is not None],
+            'status': {'code': self.status, 'message': self.status_message} if self.status == STATUS_ERROR
+                      else {'code': self.status},
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+class _NoSpan:
+    """Stands in for a span when nothing is traced, so callers need no checks."""
+
+    def set(self, **attributes):
+        pass
+
+    def error(self, message):
+        pass
+
+NO_SPAN = _NoSpan()
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        typed = {'boolValue': value}
+    elif isinstance(value, int):
+        typed = {'intValue': str(value)}
+    elif isinstance(value, float):
+        typed = {'doubleValue': value}
+    else:
+        typed = {'stringValue': str(value)}
+    return {'key': key, 'value': typed}
+
+def current_span():
+    return getattr(_current, 'span', None)
+
+@contextmanager
+def span(name, kind=KIND_INTERNAL, root=False, **attributes):
+    """Times the block as a child of the thread's current span.
+
+    With root=True it starts a new trace (one per run). Without a current
+    span and without root=True nothing is recorded.
+    """
+    parent = current_span()
+    if not TRACING or (parent is None and not root):
+        yield NO_SPAN
+        return
+    if root:
+        current = Span(name, os.urandom(16).hex(), kind=kind, attributes=attributes)
+    else:
+        current = Span(name, parent.trace_id, parent.span_id, kind, attributes)
+    _current.span = current
+    try:
+        yield current
+    except BaseException as e:
+        current.error(f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        _current.span = parent
+        current.end_ns = time.time_ns()
+        _finish(current, is_root=root)
+
+def bind(func):
+    """Wraps func so spans it opens in another thread hang under the caller's span."""
+    parent = current_span()
+
+    def bound(*args, **kwargs):
+        previous = current_span()
+        _current.span = parent
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current.span = previous
+    return bound
+
+def _finish(finished, is_root):
+    with _pending_lock:
+        spans = _pending.setdefault(finished.trace_id, [])
+        spans.append(finished)
+        if not is_root:
+            return
+        del _pending[finished.trace_id]
+    export(spans)
+
+def export(spans):
+    """Appends the spans of one trace to TRACE_FILE as an OTLP/JSON request."""
+    request = {
+        'resourceSpans': [{
+            'resource': {'attributes': [_attribute('service.name', SERVICE_NAME)]},
+            'scopeSpans': [{
+                'scope': {'name': 'tracing'},
+                'spans': [s.to_otlp() for s in spans]
+            }]
+        }]
+    }
+    try:
+        os.makedirs(os.path.dirname(TRACE_FILE) or '.', exist_ok=True)
+        with _write_lock, open(TRACE_FILE, 'a') as f:
+            f.write(json.dumps(request, default=str) + '\n')
+    except OSError as e:
+        # Tracing must never fail a run
+        logging.getLogger(__name__).warning(f"Trace niet weggeschreven: {str(e)}")
@@ -0,0 +1,207 @@
+import os
+from datetime import datetime
+from flask import Flask, Response, abort, jsonify, request
+from apscheduler.schedulers.background import BackgroundScheduler
+import clients
+import jobs
+import logs
+import metrics
+import outbox
+import polling
+import sampler
+import shutdown
+import worker
+
+log = logs.get_logger(__name__)
+
+# Metrics and health endpoints for the pipelines, served by gunicorn (see
+# gunicorn.conf.py and the web entry in the Procfile):
+#   /metrics  Prometheus text format
+#   /health   liveness: the process answers
+#   /ready    readiness: 503 when a pipeline has not completed a run within
+#             its maximum interval plus READY_GRACE_SECONDS
+#   /debug/sampler  stack sampler (sampler.py): GET shows the collapsed
+#             stacks so far, POST ?action=start[&seconds=N] or ?action=stop.
+#             Only with the X-Debug-Token header matching DEBUG_TOKEN.
+# The counters live in process memory, so the scheduler runs inside the
+# web process (WEB_RUN_SCHEDULER, on by default) and the web dyno is the
+# only process type in the Procfile that schedules pipelines. Job locks and
+# the send ledger are local to one dyno, so a second scheduler elsewhere
+# (python worker.py) would send every message twice; use worker.py only
+# where no web process runs, e.g. locally. On Heroku use a dyno type that
+# does not sleep, or the pipelines stop with it.
+WEB_RUN_SCHEDULER = os.getenv('WEB_RUN_SCHEDULER', '1').lower() not in {'0', 'false', 'no', 'off'}
+READY_GRACE_SECONDS = float(os.getenv('READY_GRACE_SECONDS', 600))
+DEBUG_TOKEN = os.getenv('DEBUG_TOKEN')
+
+STARTED_AT = datetime.now()
+
+app = Flask(__name__)
+_scheduler = None
+
+def start_scheduler():
+    """Starts the pipeline scheduler in a background thread of this process."""
+    global _scheduler
+    if not WEB_RUN_SCHEDULER or _scheduler is not None:
+        return
+    _scheduler = worker.build_scheduler(BackgroundScheduler)
+    if not _scheduler.get_jobs():
+        log.warning("Waarschuwing: geen pipelines ingeschakeld")
+    log.info("Starting scheduler...")
+    _scheduler.start()
+
+def stop_scheduler():
+    """Stops scheduling, lets running jobs finish and runs the shutdown hooks."""
+    if _scheduler is None:
+        return
+    shutdown.request_stop(_scheduler, "Web proces stopt")
+    shutdown.finish()
+
+def _labels(**labels):
+    text = ','.join(f'{key}="{str(value)}"' for key, value in labels.items())
+    return '{' + text + '}' if text else ''
+
+class _Exposition:
+    """Collects lines in the Prometheus text format."""
+
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name, kind, help_text, samples):
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            self.lines.append(f"{name}{_labels(**labels)} {value}")
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+def _timestamp(value):
+    return value.timestamp() if value else 0
+
+def render_metrics():
+    out = _Exposition()
+
+    counters = metrics.counters()
+    for name, help_text in (
+        ('rows_parsed', 'Rows read from workbooks and Airtable tables'),
+        ('messages_sent', 'WhatsApp messages delivered to Trengo'),
+        ('custom_fields_written', 'Trengo ticket custom fields written'),
+        ('duplicates_removed', 'Duplicate workbook rows dropped'),
+    ):
+        out.metric(f"pipeline_{name}_total", 'counter', help_text, [
+            ({'pipeline': pipeline}, total) for pipeline, total in sorted(counters.get(name, {}).items())
+        ])
+    out.metric('pipeline_row_failures_total', 'counter', 'Rows that failed, by stage and reason', [
+        ({'pipeline': pipeline, 'stage': name.split('.')[1], 'reason': name.split('.', 2)[2]}, total)
+        for name, totals in sorted(counters.items()) if name.startswith('failed.')
+        for pipeline, total in sorted(totals.items())
+    ])
+
+    timings = sorted(jobs.job_timings.items())
+    out.metric('pipeline_runs_total', 'counter', 'Completed pipeline runs',
+               [({'pipeline': name}, t['runs']) for name, t in timings])
+    out.metric('pipeline_skipped_runs_total', 'counter', 'Runs skipped because the previous run was still busy',
+               [({'pipeline': name}, t['skipped']) for name, t in timings])
+    out.metric('pipeline_last_success_timestamp_seconds', 'gauge', 'End of the last run that did not raise',
+               [({'pipeline': name}, _timestamp(t['last_success'])) for name, t in timings])
+    out.metric('pipeline_last_duration_seconds', 'gauge', 'Duration of the last run',
+               [({'pipeline': name}, t['last_duration'] or 0) for name, t in timings])
+    pollers = polling.metrics()
+    out.metric('pipeline_poll_interval_seconds', 'gauge', 'Current adaptive poll interval',
+               [({'pipeline': p['name']}, p['interval_seconds']) for p in pollers])
+    out.metric('pipeline_polls_total', 'counter', 'Polls of the source (mailbox or Airtable table)',
+               [({'pipeline': p['name']}, p['polls']) for p in pollers])
+    out.metric('pipeline_poll_hits_total', 'counter', 'Polls that found new work',
+               [({'pipeline': p['name']}, p['hits']) for p in pollers])
+    out.metric('pipeline_poll_hit_rate', 'gauge', 'Recent fraction of polls that found new work',
+               [({'pipeline': p['name']}, round(p['hit_rate'], 4)) for p in pollers])
+
+    services = (clients.trengo, clients.graph, clients.airtable)
+    out.metric('api_throttled_seconds_total', 'counter', 'Seconds spent waiting for the client-side rate limiter',
+               [({'service': c.name}, round(c.limiter.throttled_seconds, 3)) for c in services])
+    out.metric('api_circuit_open', 'gauge', '1 while the circuit breaker is open or half-open',
+               [({'service': c.name}, int(c.breaker.state != 'closed')) for c in services])
+    out.metric('api_circuit_breaker_trips_total', 'counter', 'Times the circuit breaker opened',
+               [({'service': c.name}, c.breaker.trips) for c in services])
+
+    try:
+        box = outbox.get_outbox()
+        depth = box.counts_by_pipeline()
+        shed = box.shed_count
+    except Exception as e:
+        log.warning(f"Outbox niet leesbaar voor metrics: {str(e)}")
+        depth, shed = {}, 0
+    out.metric('outbox_messages', 'gauge', 'Messages in the outbox by status',
+               [({'pipeline': pipeline, 'status': status}, n) for (pipeline, status), n in sorted(depth.items())])
+    out.metric('outbox_shed_total', 'counter', 'Times low-priority classes were held back for a large backlog',
+               [({}, shed)])
+
+    histograms = metrics.calls.snapshot()
+    buckets, sums, counts, statuses, sizes = [], [], [], [], []
+    for (service, endpoint), h in histograms:
+        labels = {'service': service, 'endpoint': endpoint}
+        cumulative = 0
+        for bound, n in zip(metrics.LATENCY_BUCKETS + ('+Inf',), h.bucket_counts):
+            cumulative += n
+            buckets.append(({**labels, 'le': bound}, cumulative))
+        sums.append((labels, round(h.total_seconds, 6)))
+        counts.append((labels, h.count))
+        sizes.append((labels, h.bytes))
+        statuses.extend(({**labels, 'status': status}, n) for status, n in sorted(h.statuses.items()))
+    out.lines.append('# HELP api_request_duration_seconds Latency of outbound API calls')
+    out.lines.append('# TYPE api_request_duration_seconds histogram')
+    out.lines.extend(f"api_request_duration_seconds_bucket{_labels(**l)} {v}" for l, v in buckets)
+    out.lines.extend(f"api_request_duration_seconds_sum{_labels(**l)} {v}" for l, v in sums)
+    out.lines.extend(f"api_request_duration_seconds_count{_labels(**l)} {v}" for l, v in counts)
+    out.metric('api_responses_total', 'counter', 'Outbound API calls by status code or error', statuses)
+    out.metric('api_response_bytes_total', 'counter', 'Response body bytes received', sizes)
+    return out.text()
+
+def readiness():
+    """Returns (ready, details): per scheduled pipeline the seconds since its last completed run."""
+    now = datetime.now()
+    details = {}
+    ready = not shutdown.requested()
+    for name, interval in sorted(worker.scheduled.items()):
+        last = jobs.job_timings.get(name, {}).get('last_success') or STARTED_AT
+        age = (now - last).total_seconds()
+        overdue = age > interval + READY_GRACE_SECONDS
+        ready = ready and not overdue
+        details[name] = {'seconds_since_success': round(age), 'max_interval': interval, 'overdue': overdue}
+    return ready, details
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/health')
+def health():
+    return jsonify(status='ok')
+
+@app.route('/ready')
+def ready():
+    is_ready, details = readiness()
+    return jsonify(ready=is_ready, pipelines=details), 200 if is_ready else 503
+
+@app.route('/debug/sampler', methods=['GET', 'POST'])
+def sampler_endpoint():
+    if not DEBUG_TOKEN or request.headers.get('X-Debug-Token') != DEBUG_TOKEN:
+        abort(404)
+    if request.method == 'GET':
+        return Response(sampler.sampler.collapsed(), mimetype='text/plain')
+    action = request.args.get('action')
+    if action == 'start':
+        seconds = request.args.get('seconds', type=float)
+        started = sampler.sampler.start(duration=seconds)
+        return jsonify(running=True, started=started)
+    if action == 'stop':
+        return jsonify(running=False, file=sampler.sampler.stop())
+    abort(400)
+
+if __name__ == "__main__":
+    start_scheduler()
+    try:
+        app.run(host='0.0.0.0', port=int(os.getenv('PORT', 8000)))
+    finally:
+        stop_scheduler()
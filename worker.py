@@ -0,0 +1,97 @@
+import os
+import sys
+import importlib
+from apscheduler.schedulers.blocking import BlockingScheduler
+from apscheduler.executors.pool import ThreadPoolExecutor
+import jobs
+import logs
+import polling
+import sampler
+import shutdown
+
+log = logs.get_logger(__name__)
+
+# Every pipeline runs as a job in this one process. They share the HTTP
+# clients and Graph token cache from clients.py. On Heroku the scheduler
+# runs inside the web process (web.py, the only scheduling entry in the
+# Procfile); run this script only where no web process runs, or every
+# pipeline runs twice.
+#
+# Per job (NAME is the key below, upper-cased):
+#   PIPELINE_<NAME>_ENABLED        "0" disables the job
+#   PIPELINE_<NAME>_MIN_INTERVAL   minutes between runs right after work was found
+#   PIPELINE_<NAME>_INTERVAL       maximum minutes between runs while idle
+#   PIPELINE_<NAME>_MISFIRE_GRACE_TIME  seconds a late run may still start
+# A job never overlaps with itself: runs are locked per pipeline module,
+# also against the same script started by hand (see jobs.py).
+# WORKER_THREADS sets the size of the shared thread pool.
+PIPELINES = {
+    'pwBevestiging': {'module': 'PreWonenBevestiging', 'min_interval': 2, 'interval': 30},
+    'pwHerinnering': {'module': 'PreWonenHerinnering', 'min_interval': 2, 'interval': 30},
+    'pwFoto': {'module': 'PreWonenFotoVerzoek', 'min_interval': 2, 'interval': 30},
+    'pwFeedback': {'module': 'PreWonenFeedback', 'min_interval': 2, 'interval': 30},
+    'pwZelfstandigPlannen': {'module': 'AutomatischPlannen', 'min_interval': 2, 'interval': 30},
+    'vesBevestiging': {'module': 'VestedaBevestiging', 'min_interval': 2, 'interval': 30},
+    'vesHerinnering': {'module': 'VestedaHerinnering', 'min_interval': 2, 'interval': 30},
+    'vesFoto': {'module': 'VestedaFotoVerzoek', 'min_interval': 2, 'interval': 30},
+    'vesFeedback': {'module': 'VestedaFeedback', 'min_interval': 2, 'interval': 30},
+    'pwBevestiging4H': {'enabled': False, 'module': 'ZZZ_PreWonenBevestiging4H', 'min_interval': 5, 'interval': 30},
+    'pwHerinnering1H': {'enabled': False, 'module': 'ZZZ_PreWonenHerinnering1H', 'min_interval': 5, 'interval': 30},
+    'vesBevestiging4H': {'enabled': False, 'module': 'ZZZ_VestedaBevestiging4H', 'min_interval': 5, 'interval': 30},
+    'vesHerinnering1H': {'enabled': False, 'module': 'ZZZ_VestedaHerinnering1H', 'min_interval': 5, 'interval': 30},
+    # Fetches the four reminder tables above in one tick; enable either this
+    # job or the separate ZZZ jobs
+    'reminders': {'module': 'reminders', 'min_interval': 5, 'interval': 30},
+}
+
+def job_setting(name, key, default):
+    return os.getenv(f"PIPELINE_{name.upper()}_{key}", default)
+
+def is_enabled(name, config):
+    default = '1' if config.get('enabled', True) else '0'
+    return job_setting(name, 'ENABLED', default).lower() not in {'0', 'false', 'no', 'off'}
+
+# Scheduled pipelines: module name (the job lock and timing name) -> maximum
+# seconds between runs. web.py reports a pipeline as not ready once it has
+# gone longer than this without a completed run.
+scheduled = {}
+
+def build_scheduler(scheduler_class=BlockingScheduler):
+    shutdown.check_state_storage()
+    executors = {'default': ThreadPoolExecutor(int(os.getenv('WORKER_THREADS', 8)))}
+    scheduler = scheduler_class(executors=executors, job_defaults=jobs.JOB_DEFAULTS)
+
+    for name, config in PIPELINES.items():
+        if not is_enabled(name, config):
+            log.info(f"Pipeline {name} uitgeschakeld")
+            continue
+
+        module = importlib.import_module(config['module'])
+        min_interval = float(job_setting(name, 'MIN_INTERVAL', config['min_interval']))
+        interval = float(job_setting(name, 'INTERVAL', config['interval']))
+        misfire_grace_time = int(job_setting(name, 'MISFIRE_GRACE_TIME', jobs.JOB_DEFAULTS['misfire_grace_time']))
+
+        # Pipelines record hits under their module name (PIPELINE_NAME)
+        poller = polling.get_poller(config['module'], min_interval=min_interval * 60, max_interval=interval * 60)
+        polling.add_adaptive_job(
+            scheduler,
+            name,
+            jobs.locked_job(config['module'], module.process_data),
+            poller,
+            misfire_grace_time=misfire_grace_time
+        )
+        scheduled[config['module']] = interval * 60
+        log.info(f"Pipeline {name} gepland: elke {min_interval:g}-{interval:g} minuten")
+
+    return scheduler
+
+if __name__ == "__main__":
+    scheduler = build_scheduler()
+    if not scheduler.get_jobs():
+        log.error("ERROR: Geen pipelines ingeschakeld")
+        sys.exit(1)
+    shutdown.install(scheduler)
+    sampler.install()
+    log.info("Starting scheduler...")
+    scheduler.start()
+    shutdown.finish()